@@ -0,0 +1,168 @@
+import os
+
+import sys
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+import socket
+import time
+from typing import List
+
+import psycopg2
+import redis
+from kombu.utils import json
+
+import config
+import storage
+from storage.flag_cache import FlagRecord
+from storage.write_behind import ATTACKS_STREAM, WRITERS_GROUP, WRITER_STATS_KEY
+
+# Milliseconds to wait for new entries in a single read
+BLOCK_TIMEOUT = 1000
+
+# Entries delivered to another writer and not acknowledged for this
+# number of milliseconds are claimed, e.g. the writer container was replaced
+CLAIM_IDLE_TIME = 30000
+
+RETRY_DELAY = 1
+
+STATS_INTERVAL = 60
+
+
+class AttackWriter:
+    """Applies attacks accepted in write-behind mode to the database
+
+        Reads entries of the attacks stream as a member of the consumer group,
+        applies each read batch with a single recalculate_rating_bulk call
+        in stream order, then acknowledges and deletes the entries. On start
+        the entries delivered to this consumer before a crash are replayed,
+        and stale entries of other consumers are claimed periodically.
+        Replaying is safe, as the procedure skips (flag_id, attacker_id) pairs
+        already present in the database. Events and first bloods of attacks
+        applied right before a crash might be lost, the rating is not.
+
+        Run a single instance to apply attacks in the order they were accepted.
+    """
+
+    def __init__(self, consumer: str, batch_size: int):
+        self.consumer = consumer
+        self.batch_size = batch_size
+        self.redis = storage.get_redis_storage()
+        self._last_stats = time.monotonic()
+
+    def create_group(self):
+        try:
+            self.redis.xgroup_create(ATTACKS_STREAM, WRITERS_GROUP, id='0', mkstream=True)
+        except redis.ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def read(self, last_id: str, block=None) -> list:
+        """Read entries after "last_id", "0" reads entries delivered to this consumer
+        and not acknowledged, ">" reads new entries"""
+        result = self.redis.xreadgroup(
+            WRITERS_GROUP,
+            self.consumer,
+            {ATTACKS_STREAM: last_id},
+            count=self.batch_size,
+            block=block,
+        )
+        if not result:
+            return []
+
+        _stream, entries = result[0]
+        return entries
+
+    def claim_stale(self) -> list:
+        """Take over entries other consumers failed to acknowledge in time"""
+        pending = self.redis.xpending_range(
+            ATTACKS_STREAM,
+            WRITERS_GROUP,
+            min='-',
+            max='+',
+            count=self.batch_size,
+        )
+        stale = [
+            entry['message_id'] for entry in pending
+            if entry['consumer'] != self.consumer and entry['time_since_delivered'] >= CLAIM_IDLE_TIME
+        ]
+        if not stale:
+            return []
+
+        return self.redis.xclaim(ATTACKS_STREAM, WRITERS_GROUP, self.consumer, CLAIM_IDLE_TIME, stale)
+
+    @staticmethod
+    def parse_attacks(entries: list) -> List[tuple]:
+        attacks = []
+        for _entry_id, fields in entries:
+            attacker_id = int(fields['attacker_id'])
+            round = int(fields['round'])
+            for flag_id, team_id, task_id, flag_round in json.loads(fields['flags']):
+                flag = FlagRecord(id=flag_id, team_id=team_id, task_id=task_id, round=flag_round)
+                attacks.append((attacker_id, flag, round))
+        return attacks
+
+    def apply(self, entries: list, replayed: bool = False):
+        if not entries:
+            return
+
+        attacks = self.parse_attacks(entries)
+        applied = storage.teams.apply_attacks_bulk(attacks)
+
+        entry_ids = [entry_id for entry_id, _fields in entries]
+        with self.redis.pipeline(transaction=True) as pipeline:
+            pipeline.xack(ATTACKS_STREAM, WRITERS_GROUP, *entry_ids)
+            pipeline.xdel(ATTACKS_STREAM, *entry_ids)
+            pipeline.hincrby(WRITER_STATS_KEY, 'applied', applied)
+            pipeline.hincrby(WRITER_STATS_KEY, 'batches', 1)
+            if replayed:
+                pipeline.hincrby(WRITER_STATS_KEY, 'replayed', len(entries))
+            pipeline.hset(WRITER_STATS_KEY, 'last_applied_id', entry_ids[-1])
+            pipeline.execute()
+
+    def replay(self):
+        """Apply entries delivered to this consumer before a restart"""
+        entries = self.read('0')
+        while entries:
+            self.apply(entries, replayed=True)
+            entries = self.read('0')
+
+    def report_if_needed(self):
+        now = time.monotonic()
+        if now - self._last_stats < STATS_INTERVAL:
+            return
+        self._last_stats = now
+
+        lag = storage.write_behind.get_lag()
+        print(
+            f'Attacks not applied: {lag["length"]} ({lag["pending"]} pending), '
+            f'lag: {lag["lag"]:.3f}s, applied: {lag["applied"]}, replayed entries: {lag["replayed"]}'
+        )
+
+    def run(self):
+        self.create_group()
+        self.replay()
+
+        print(f'Started attack writer {self.consumer}')
+
+        while True:
+            self.apply(self.claim_stale(), replayed=True)
+            self.apply(self.read('>', block=BLOCK_TIMEOUT))
+            self.report_if_needed()
+
+
+def main():
+    writer_config = config.get_write_behind_config()
+    writer = AttackWriter(consumer=socket.gethostname(), batch_size=writer_config['batch_size'])
+
+    while True:
+        try:
+            writer.run()
+        except (redis.ConnectionError, redis.TimeoutError, psycopg2.Error) as e:
+            print(f'Failed to apply attacks, entries will be replayed: {e}')
+        time.sleep(RETRY_DELAY)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+"""Load generator for the broadcaster
+
+Opens N server-sent-events connections, publishes a number of events
+to the game events channel in redis and measures how fast every client
+received them. Run it for several connection counts, e.g.:
+
+    ./benchmark.py --port 5001 --connections 100 1000 5000 --server-pid <pid>
+
+With --server-pid (broadcaster running on the same host) CPU time
+of the broadcaster is measured, and the number of clients a single core
+can serve at the given event rate is estimated from it. Pin the broadcaster
+to one core (taskset -c 0) for the estimate to be accurate. Raise the open
+files limit (ulimit -n) for large connection counts, and run the benchmark
+on another core or host, as the clients are heavier than the server.
+"""
+
+import os
+
+import sys
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+import argparse
+import asyncio
+import json
+import time
+
+import storage
+
+EVENT_NAME = 'benchmark'
+CONNECT_BATCH = 200
+
+
+def get_cpu_time(pid: int) -> float:
+    """Get user + system CPU seconds of the process from procfs"""
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+class Client:
+    def __init__(self):
+        self.received = 0
+        self.latencies = []
+        self.done = asyncio.Event()
+        self.expected = 0
+
+    async def connect(self, host: str, port: int, stream: str):
+        reader, writer = await asyncio.open_connection(host, port, limit=16 * 1024 * 1024)
+        writer.write(f'GET /api/events/?stream={stream} HTTP/1.1\r\nHost: {host}\r\n\r\n'.encode())
+        head = await reader.readuntil(b'\r\n\r\n')
+        if not head.startswith(b'HTTP/1.1 200'):
+            raise ValueError(f'Unexpected response: {head!r}')
+        return reader, writer
+
+    async def run(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                frame = await reader.readuntil(b'\n\n')
+                if not frame.startswith(f'event: {EVENT_NAME}\n'.encode()):
+                    continue
+
+                data = frame.split(b'data: ', 1)[1]
+                self.latencies.append(time.time() - json.loads(data)['ts'])
+                self.received += 1
+                if self.received >= self.expected:
+                    self.done.set()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self.done.set()
+        finally:
+            writer.close()
+
+
+async def run_round(args, connections: int):
+    clients = [Client() for _ in range(connections)]
+    for client in clients:
+        client.expected = args.events
+
+    streams = []
+    for i in range(0, connections, CONNECT_BATCH):
+        batch = clients[i:i + CONNECT_BATCH]
+        streams += await asyncio.gather(*[client.connect(args.host, args.port, args.stream) for client in batch])
+
+    tasks = [asyncio.ensure_future(client.run(*stream)) for client, stream in zip(clients, streams)]
+
+    # let the broadcaster send init frames and register clients
+    await asyncio.sleep(1)
+
+    redis = storage.get_redis_storage()
+    channel = storage.game_events.get_channel()
+    padding = 'x' * args.payload
+
+    cpu_started = get_cpu_time(args.server_pid) if args.server_pid else None
+    started = time.monotonic()
+
+    for _ in range(args.events):
+        data = json.dumps({'ts': time.time(), 'padding': padding})
+        redis.publish(channel, storage.game_events.encode_frame(EVENT_NAME, data))
+        await asyncio.sleep(1 / args.rate)
+
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(*[client.done.wait() for client in clients]),
+            timeout=args.timeout,
+        )
+    except asyncio.TimeoutError:
+        pass
+
+    # rates are divided by elapsed time, which can be zero for an empty run
+    elapsed = max(time.monotonic() - started, 1e-9)
+    cpu = get_cpu_time(args.server_pid) - cpu_started if args.server_pid else None
+
+    for task in tasks:
+        task.cancel()
+
+    latencies = sorted(latency for client in clients for latency in client.latencies)
+    received = len(latencies)
+    return received, latencies, elapsed, cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark broadcaster fan-out')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5001)
+    parser.add_argument('--stream', type=str, default='full')
+    parser.add_argument('--connections', type=int, nargs='+', default=[100, 500, 1000, 5000])
+    parser.add_argument('--events', type=int, default=50, help='Number of events to publish')
+    parser.add_argument('--rate', type=float, default=10, help='Events published per second')
+    parser.add_argument('--payload', type=int, default=1024, help='Event data size in bytes')
+    parser.add_argument('--timeout', type=float, default=30, help='Seconds to wait for delivery')
+    parser.add_argument('--server-pid', type=int, help='Broadcaster pid to measure CPU time of')
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+
+    print(
+        f'{"connections":>12} {"frames":>10} {"seconds":>10} {"frames/sec":>12} '
+        f'{"p50 ms":>8} {"p99 ms":>8} {"cpu %":>8} {"clients/core":>13}'
+    )
+    for connections in args.connections:
+        received, latencies, elapsed, cpu = loop.run_until_complete(run_round(args, connections))
+
+        p50 = latencies[len(latencies) // 2] * 1000 if latencies else 0
+        p99 = latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0
+        cpu_usage = cpu / elapsed if cpu is not None else None
+        per_core = f'{connections / cpu_usage:>13.0f}' if cpu_usage else f'{"-":>13}'
+        cpu_percent = f'{cpu_usage * 100:>8.1f}' if cpu_usage is not None else f'{"-":>8}'
+
+        print(
+            f'{connections:>12} {received:>10} {elapsed:>10.3f} {received / elapsed:>12.1f} '
+            f'{p50:>8.1f} {p99:>8.1f} {cpu_percent} {per_core}'
+        )
+
+
+if __name__ == '__main__':
+    main()
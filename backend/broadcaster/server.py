@@ -0,0 +1,270 @@
+import os
+
+import sys
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+import asyncio
+from collections import Counter
+from typing import Optional
+from urllib.parse import urlsplit, parse_qs
+
+import uvloop
+
+import storage
+from storage.game import SCOREBOARD_FULL_ROOM, SCOREBOARD_DELTA_ROOM
+from storage.game_events import get_channel, encode_frame
+
+BACKLOG = 4096
+
+EVENTS_PATH = '/api/events/'
+
+MAX_REQUEST_SIZE = 8192
+REQUEST_TIMEOUT = 10
+
+# Clients with more unsent data than this are disconnected,
+# reconnecting EventSource receives the full scoreboard again
+MAX_CLIENT_BUFFER = 4 * 1024 * 1024
+
+# Comment frames keep idle connections open through proxies
+KEEPALIVE_INTERVAL = 15
+KEEPALIVE_FRAME = b': keepalive\n\n'
+
+STATS_INTERVAL = 60
+
+RESUBSCRIBE_DELAY = 1
+
+FULL_STREAM = 'full'
+DELTA_STREAM = 'delta'
+
+# Scoreboard encoding requested with "format" query parameter, as in webapi
+COLUMNAR_FORMAT = 'columnar'
+
+# Streams receiving events of each redis channel
+CHANNEL_STREAMS = {
+    get_channel(): [FULL_STREAM, DELTA_STREAM],
+    get_channel(SCOREBOARD_FULL_ROOM): [FULL_STREAM],
+    get_channel(SCOREBOARD_DELTA_ROOM): [DELTA_STREAM],
+}
+
+RESPONSE_HEADERS = (
+    b'HTTP/1.1 200 OK\r\n'
+    b'Content-Type: text/event-stream\r\n'
+    b'Cache-Control: no-cache\r\n'
+    b'Connection: close\r\n'
+    b'X-Accel-Buffering: no\r\n'
+    b'\r\n'
+)
+
+
+class EventStreamProtocol(asyncio.Protocol):
+    """Single server-sent-events client. Only the request head is parsed,
+    after that the connection is write-only and frames are written by Broadcaster"""
+
+    def __init__(self, broadcaster: 'Broadcaster'):
+        self.broadcaster = broadcaster
+        self.transport: Optional[asyncio.Transport] = None
+        self.buffer = bytearray()
+        self.stream = None
+        self.timeout_handle = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.timeout_handle = self.broadcaster.loop.call_later(REQUEST_TIMEOUT, transport.close)
+
+    def respond_error(self, status: bytes):
+        self.transport.write(b'HTTP/1.1 ' + status + b'\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+        self.transport.close()
+
+    def data_received(self, data):
+        if self.stream is not None:
+            return
+
+        self.buffer.extend(data)
+        if self.buffer.find(b'\r\n\r\n') == -1:
+            if len(self.buffer) > MAX_REQUEST_SIZE:
+                self.respond_error(b'431 Request Header Fields Too Large')
+            return
+
+        self.timeout_handle.cancel()
+        request_line = bytes(self.buffer[:self.buffer.find(b'\r\n')])
+        self.buffer.clear()
+
+        try:
+            method, target, _version = request_line.decode().split(' ', 2)
+        except (UnicodeDecodeError, ValueError):
+            self.respond_error(b'400 Bad Request')
+            return
+
+        if method != 'GET':
+            self.respond_error(b'405 Method Not Allowed')
+            return
+
+        url = urlsplit(target)
+        if url.path != EVENTS_PATH:
+            self.respond_error(b'404 Not Found')
+            return
+
+        query = parse_qs(url.query)
+        stream = query.get('stream', [FULL_STREAM])[0]
+        if stream not in (FULL_STREAM, DELTA_STREAM):
+            self.respond_error(b'400 Bad Request')
+            return
+
+        self.stream = stream
+        self.transport.write(RESPONSE_HEADERS)
+        columnar = query.get('format', [''])[0] == COLUMNAR_FORMAT
+        self.broadcaster.loop.create_task(self.broadcaster.add_client(self, columnar))
+
+    def connection_lost(self, exc):
+        self.timeout_handle.cancel()
+        self.broadcaster.remove_client(self)
+
+
+class Broadcaster:
+    """Fan-out server for game events
+
+        Subscribes once to the game events channels in redis, where events
+        are published as ready server-sent-events frames (see storage.game_events),
+        and writes the same frame object to every client of the stream.
+        Each new client first receives "init_scoreboard" from the latest
+        scoreboard snapshot, frames are re-encoded only when its version changes.
+        Instances are independent, so the service scales by adding replicas behind nginx.
+    """
+
+    def __init__(self, host: str, port: int, loop):
+        self.host = host
+        self.port = port
+        self.loop = loop
+        self.clients = {FULL_STREAM: set(), DELTA_STREAM: set()}
+        self.stats = Counter()
+
+        self._init_version = None
+        self._init_frames = None
+        self._init_lock = asyncio.Lock()
+
+    async def get_init_frames(self) -> Optional[dict]:
+        """Get "init_scoreboard" frames by columnar flag for the current snapshot"""
+        version = await storage.game.get_scoreboard_version_async(self.loop)
+        if not version:
+            return None
+
+        if self._init_version != version:
+            async with self._init_lock:
+                if self._init_version != version:
+                    snapshot = await storage.game.get_scoreboard_snapshot_async(self.loop)
+                    self._init_frames = {
+                        False: encode_frame('init_scoreboard', snapshot.data, snapshot.version),
+                        True: encode_frame('init_scoreboard', snapshot.columnar, snapshot.version),
+                    }
+                    self._init_version = snapshot.version
+
+        return self._init_frames
+
+    async def add_client(self, client: EventStreamProtocol, columnar: bool):
+        """Send the scoreboard to the client and start broadcasting to it.
+        Events published in between are missed, delta clients detect it by version"""
+        frames = await self.get_init_frames()
+        if client.transport.is_closing():
+            return
+
+        if frames is not None:
+            client.transport.write(frames[columnar])
+        self.clients[client.stream].add(client.transport)
+
+    def remove_client(self, client: EventStreamProtocol):
+        if client.stream is not None:
+            self.clients[client.stream].discard(client.transport)
+
+    def broadcast(self, streams: list, frame: bytes):
+        for stream in streams:
+            clients = self.clients[stream]
+
+            slow = []
+            for transport in clients:
+                if transport.get_write_buffer_size() > MAX_CLIENT_BUFFER:
+                    slow.append(transport)
+                else:
+                    transport.write(frame)
+
+            for transport in slow:
+                clients.discard(transport)
+                transport.abort()
+
+            self.stats['frames'] += len(clients)
+            self.stats['dropped'] += len(slow)
+
+    def disconnect_all(self):
+        for clients in self.clients.values():
+            for transport in clients:
+                transport.close()
+            clients.clear()
+
+    async def read_channel(self, channel):
+        streams = CHANNEL_STREAMS[channel.name.decode()]
+        while await channel.wait_message():
+            frame = await channel.get()
+            self.broadcast(streams, frame)
+
+    async def listen(self):
+        """Forward game events from redis to clients, resubscribing on errors.
+        Clients are disconnected after a failure, as they could miss events"""
+        while True:
+            try:
+                redis = await storage.get_async_redis_storage(self.loop, always_create_new=True)
+                try:
+                    channels = await redis.subscribe(*CHANNEL_STREAMS.keys())
+                    await asyncio.gather(*[self.read_channel(channel) for channel in channels])
+                finally:
+                    redis.close()
+            except (ConnectionError, OSError) as e:
+                print(f'Game events subscription failed: {e}')
+
+            self.disconnect_all()
+            await asyncio.sleep(RESUBSCRIBE_DELAY)
+
+    async def keepalive(self):
+        while True:
+            await asyncio.sleep(KEEPALIVE_INTERVAL)
+            self.broadcast([FULL_STREAM, DELTA_STREAM], KEEPALIVE_FRAME)
+
+    async def report_stats(self):
+        while True:
+            await asyncio.sleep(STATS_INTERVAL)
+            stats, self.stats = self.stats, Counter()
+            clients = sum(len(clients) for clients in self.clients.values())
+            print(f'Clients: {clients}, frames sent: {stats["frames"]}, slow clients dropped: {stats["dropped"]}')
+
+    async def serve_forever(self):
+        server = await self.loop.create_server(
+            lambda: EventStreamProtocol(self),
+            host=self.host,
+            port=self.port,
+            backlog=BACKLOG,
+            reuse_port=True,
+        )
+
+        print(f'Started broadcaster on port {self.port}')
+
+        self.loop.create_task(self.listen())
+        self.loop.create_task(self.keepalive())
+        self.loop.create_task(self.report_stats())
+
+        async with server:
+            await server.serve_forever()
+
+
+def main():
+    host = '0.0.0.0'
+    port = int(os.environ.get('BROADCASTER_PORT', 5001))
+
+    uvloop.install()
+    loop = asyncio.get_event_loop()
+
+    broadcaster = Broadcaster(host, port, loop)
+    loop.run_until_complete(broadcaster.serve_forever())
+
+
+if __name__ == '__main__':
+    main()
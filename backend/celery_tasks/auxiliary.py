@@ -32,11 +32,11 @@ def startup(**_kwargs):
                     logger.info(f"Initializing game_state with {game_state.to_dict()}")
                     pipeline.set('game_state', game_state.to_json())
                     pipeline.execute()
+                    storage.game.publish_scoreboard_snapshot(game_state)
 
-                    storage.get_wro_sio_manager().emit(
+                    storage.game_events.emit(
                         event='update_scoreboard',
-                        data={'data': game_state.to_json()},
-                        namespace='/game_events',
+                        data=game_state.to_json(),
                     )
 
 
@@ -65,9 +65,9 @@ def start_game():
             logger.info(f"Initializing game_state with {game_state.to_dict()}")
             pipeline.set('game_state', game_state.to_json())
             pipeline.execute()
+            storage.game.publish_scoreboard_snapshot(game_state)
 
-            storage.get_wro_sio_manager().emit(
+            storage.game_events.emit(
                 event='update_scoreboard',
-                data={'data': game_state.to_json()},
-                namespace='/game_events',
+                data=game_state.to_json(),
             )
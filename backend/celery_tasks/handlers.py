@@ -2,13 +2,31 @@ from celery import shared_task
 from celery.utils.log import get_task_logger
 from typing import List
 
-import storage.tasks
+import storage
 from helplib import models, checkers
 from helplib.types import TaskStatus, Action
 
 logger = get_task_logger(__name__)
 
 
+def finish_teamtask(team: models.Team, task: models.Task, round: int):
+    """Count the checker chain finished and publish round results if it was the last one"""
+    if not storage.game.mark_teamtask_done(round=round, team_id=team.id, task_id=task.id):
+        return
+
+    if storage.game.claim_round_publish(round):
+        logger.info(f'All checks for round {round} finished, publishing scoreboard')
+        storage.game.publish_game_state(round)
+
+
+@shared_task
+def round_deadline_handler(round: int):
+    """Publish round results if some checker chains didn't finish in time"""
+    if storage.game.claim_round_publish(round):
+        logger.warning(f'Round {round} deadline reached before all checks finished, publishing scoreboard')
+        storage.game.publish_game_state(round)
+
+
 @shared_task
 def exception_callback(result, exc, traceback):
     action_name = result.task.split('.')[-1].split('_')[0].upper()
@@ -42,6 +60,7 @@ def exception_callback(result, exc, traceback):
         checker_verdict=verdict,
         round=round,
     )
+    finish_teamtask(team=team, task=task, round=round)
     return verdict
 
 
@@ -88,4 +107,5 @@ def checker_results_handler(
         checker_verdict=result_verdict,
         round=round,
     )
+    finish_teamtask(team=team, task=task, round=round)
     return result_verdict
@@ -6,6 +6,7 @@ from celery import Task
 from celery.utils.log import get_task_logger
 from typing import Optional
 
+import celery_tasks.handlers
 import celery_tasks.modes
 import storage
 from helplib import locking
@@ -15,6 +16,25 @@ logger = get_task_logger(__name__)
 _FULL_UPDATE_ROUND_TYPES = ['full', 'puts']
 _GS_UPDATE_ROUND_TYPES = ['full', 'puts', 'check_gets']
 
+# Round types for which game state is published as soon as all checks are finished,
+# the update at the start of the next round is a fallback for them
+_TRACKED_ROUND_TYPES = ['full']
+
+# Extra time for a checker chain above checker timeouts before the round
+# results are published without waiting for the rest of the chains
+DEADLINE_MARGIN = 5
+
+
+def get_round_deadline(tasks: list, round_time: int) -> int:
+    """Get the time in seconds all checker chains of the round are expected to finish in.
+    Chain runs check, then puts in parallel, then gets one by one, each action is limited
+    by "checker_timeout + 5" seconds"""
+    longest_chain = max(
+        ((task.checker_timeout + 5) * (2 + task.gets) for task in tasks),
+        default=0,
+    )
+    return min(longest_chain + DEADLINE_MARGIN, round_time)
+
 
 def get_round_processor(round_type: str, task_id: Optional[int] = None):
     """Get RoundProcessor instance for specified round type"""
@@ -39,36 +59,47 @@ class RoundProcessor(Task):
     def should_update_game_state(self):
         return self.round_type in _GS_UPDATE_ROUND_TYPES
 
-    @staticmethod
-    def update_game_state(current_round):
+    def should_track_round(self):
+        return self.round_type in _TRACKED_ROUND_TYPES
+
+    def update_game_state(self, current_round):
         if not current_round:
             return
 
-        game_state = storage.game.construct_latest_game_state(round=current_round)
+        if self.should_track_round() and not storage.game.claim_round_publish(current_round):
+            # attacks accepted after the barrier published the round
+            # are sent now, instead of after the next round ends
+            logger.info(f'Scoreboard for round {current_round} was already published, publishing changes')
+            storage.game.publish_game_state(current_round, only_changed=True)
+            return
 
         logger.info(f'Publishing scoreboard for round {current_round}')
-        with storage.get_redis_storage().pipeline(transaction=True) as pipeline:
-            pipeline.set('game_state', game_state.to_json())
-            pipeline.execute()
-
-        storage.get_wro_sio_manager().emit(
-            event='update_scoreboard',
-            data={'data': game_state.to_json()},
-            namespace='/game_events',
-        )
+        storage.game.publish_game_state(current_round)
 
     @staticmethod
-    def update_round(finished_round):
+    def update_round(finished_round, fencing_token):
+        """Update round in DB and redis, return False if the lock
+        was lost and a newer round processor has updated it"""
         logger.info(f'Updating round to {finished_round + 1}')
 
+        updated = storage.game.update_real_round_in_db(
+            new_round=finished_round + 1,
+            fencing_token=fencing_token,
+        )
+        if not updated:
+            return False
+
         storage.game.set_round_start(round=finished_round + 1)
-        storage.game.update_real_round_in_db(new_round=finished_round + 1)
 
         # Might think there's a RC here (I thought so too)
         # But all teamtasks with round >= real_round are updated in the attack handler
         # So both old and new teamtasks will be updated properly
         with storage.get_redis_storage().pipeline(transaction=True) as pipeline:
-            pipeline.set('real_round', finished_round + 1).execute()
+            pipeline.set('real_round', finished_round + 1)
+            pipeline.publish(storage.game.ROUND_UPDATES_CHANNEL, finished_round + 1)
+            pipeline.execute()
+
+        return True
 
     def run(self, *args, **kwargs):
         """Process new round
@@ -83,12 +114,14 @@ class RoundProcessor(Task):
             return
 
         with storage.get_redis_storage().pipeline(transaction=True) as pipeline:
-            with locking.acquire_redis_lock(pipeline, 'round_update:lock'):
+            with locking.acquire_redis_lock(pipeline, storage.game.ROUND_UPDATE_LOCK) as fencing_token:
                 current_round = storage.game.get_real_round_from_db()
                 round_to_check = current_round
 
                 if self.should_update_round():
-                    self.update_round(current_round)
+                    if not self.update_round(current_round, fencing_token):
+                        logger.warning(f'Round lock was lost (fencing token {fencing_token}), exiting')
+                        return
                     round_to_check = current_round + 1
 
         if not round_to_check:
@@ -103,6 +136,15 @@ class RoundProcessor(Task):
         tasks = storage.tasks.get_tasks()
         random.shuffle(tasks)
 
+        if self.should_track_round():
+            storage.game.start_round_tracking(round=round_to_check, chains=len(teams) * len(tasks))
+
+            game_config = storage.game.get_current_global_config()
+            celery_tasks.handlers.round_deadline_handler.apply_async(
+                args=(round_to_check,),
+                countdown=get_round_deadline(tasks, game_config.round_time),
+            )
+
         args = itertools.product(teams, tasks, [round_to_check])
 
         if self.round_type == 'full':
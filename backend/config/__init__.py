@@ -22,6 +22,34 @@ def get_db_config() -> dict:
     }
 
 
+def get_flag_rate_limit_config() -> dict:
+    """Get per-team flag submission rate limit settings,
+    rate of 0 (the default) disables the limit"""
+    return {
+        'rate': float(os.environ.get('FLAG_RATE_LIMIT', 0)),
+        'burst': int(os.environ.get('FLAG_RATE_BURST', 2000)),
+        'shared': os.environ.get('FLAG_RATE_LIMIT_SHARED', '1') == '1',
+        'replicas': int(os.environ.get('FLAG_SUBMITTER_REPLICAS', 1)),
+    }
+
+
+def get_write_behind_config() -> dict:
+    """Get write-behind settings for accepted flags, when enabled submitters
+    answer right after the redis check and attack_writer updates the database"""
+    return {
+        'enabled': os.environ.get('FLAGS_WRITE_BEHIND', '0') == '1',
+        'batch_size': int(os.environ.get('FLAGS_WRITE_BEHIND_BATCH', 500)),
+    }
+
+
+def get_game_events_config() -> dict:
+    """Get game events settings, events are always published for the broadcaster,
+    socket.io clients receive them unless disabled"""
+    return {
+        'socketio': os.environ.get('SOCKETIO_EVENTS', '1') == '1',
+    }
+
+
 def get_broker_url() -> str:
     """Get broker url for RabbitMQ from config"""
     amqp_host = os.environ['RABBITMQ_HOST']
@@ -0,0 +1,186 @@
+import os
+
+import sys
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, BASE_DIR)
+
+import asyncio
+import uvloop
+from typing import List
+
+import storage
+from helplib import exceptions, flags
+
+BACKLOG = 1024
+RECV_SIZE = 4096
+MAX_BUFFER_SIZE = 1000
+
+# Maximum number of flags processed for one connection at once.
+# New data is not read from the socket until the current batch is answered,
+# so the kernel buffers of a flooding client fill up and TCP slows it down.
+MAX_BATCH_SIZE = 100
+
+# Maximum number of batches processed concurrently by the whole server
+MAX_INFLIGHT_BATCHES = 500
+
+# Transport write buffer limits, "drain" blocks while the client doesn't read responses
+WRITE_HIGH_WATER = 64 * 1024
+WRITE_LOW_WATER = 16 * 1024
+
+TOKEN_TIMEOUT = 30
+
+
+class AsyncFlagSubmitter:
+    def __init__(self, host: str, port: int, loop):
+        self.host = host
+        self.port = port
+        self.loop = loop
+        self.inflight = asyncio.Semaphore(MAX_INFLIGHT_BATCHES)
+        self.rate_limiter = storage.rate_limit.get_team_rate_limiter()
+
+    @staticmethod
+    async def read_lines(reader: asyncio.StreamReader, buffer: bytearray) -> List[bytes]:
+        """Read from the stream until at least one line is complete
+
+            :param reader: client stream reader
+            :param buffer: bytearray with incomplete line from previous reads, updated inplace
+            :return: list of complete lines, empty list if the client disconnected
+        """
+        while True:
+            data = await reader.read(RECV_SIZE)
+            if not data:
+                return []
+
+            buffer.extend(data)
+            *lines, rest = buffer.split(b'\n')
+            buffer[:] = rest
+
+            if len(buffer) > MAX_BUFFER_SIZE:
+                lines.append(bytes(buffer))
+                buffer.clear()
+
+            if lines:
+                return lines
+
+    async def process_flags(self, team_id: int, lines: List[bytes]) -> bytes:
+        flag_strs = []
+        for line in lines:
+            try:
+                flag_strs.append(line.decode().strip())
+            except UnicodeDecodeError:
+                flag_strs.append(None)
+
+        round = await storage.game.get_real_round_async(self.loop)
+        if round == -1:
+            return b'Game is unavailable\n' * len(flag_strs)
+
+        async with self.inflight:
+            results = await storage.teams.handle_attacks_batch_async(
+                attacker_id=team_id,
+                flag_strs=[flag_str for flag_str in flag_strs if flag_str is not None],
+                round=round,
+                loop=self.loop,
+            )
+
+        results = iter(results)
+        response = []
+        for flag_str in flag_strs:
+            if flag_str is None:
+                response.append(b'Invalid flag\n')
+                continue
+
+            result = next(results)
+            if isinstance(result, exceptions.FlagSubmitException):
+                response.append(str(result).encode() + b'\n')
+            else:
+                response.append((flags.accepted_message(result) + '\n').encode())
+
+        return b''.join(response)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        writer.transport.set_write_buffer_limits(high=WRITE_HIGH_WATER, low=WRITE_LOW_WATER)
+        buffer = bytearray()
+
+        try:
+            writer.write(b'Welcome! Please, enter your team token:\n')
+
+            lines = await asyncio.wait_for(self.read_lines(reader, buffer), timeout=TOKEN_TIMEOUT)
+            if not lines:
+                return
+
+            token, lines = lines[0], lines[1:]
+            try:
+                token = token.decode().strip()
+            except UnicodeDecodeError:
+                token = None
+
+            team_id = None
+            if token:
+                team_id = await storage.teams.get_team_id_by_token_async(token, self.loop)
+
+            if not team_id:
+                writer.write(b'Invalid team token\n')
+                await writer.drain()
+                return
+
+            writer.write(b'Now enter your flags, one in a line:\n')
+
+            while True:
+                if not lines:
+                    lines = await self.read_lines(reader, buffer)
+                    if not lines:
+                        break
+
+                batch, lines = lines[:MAX_BATCH_SIZE], lines[MAX_BATCH_SIZE:]
+                await self.rate_limiter.wait_async(team_id, len(batch), self.loop)
+                writer.write(await self.process_flags(team_id, batch))
+                await writer.drain()
+
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def report_stats(self):
+        """Periodically report throttling stats, counters are copied on the loop
+        and written with sync redis client in the executor"""
+        while True:
+            await asyncio.sleep(storage.rate_limit.REPORT_INTERVAL)
+            report = self.rate_limiter.take_report()
+            if report is not None:
+                await self.loop.run_in_executor(None, self.rate_limiter.write_report, *report)
+
+    async def serve_forever(self):
+        server = await asyncio.start_server(
+            self.handle,
+            host=self.host,
+            port=self.port,
+            backlog=BACKLOG,
+            limit=RECV_SIZE * 4,
+        )
+
+        print(f'Started async TCP server on port {self.port}')
+
+        self.loop.create_task(self.report_stats())
+
+        async with server:
+            await server.serve_forever()
+
+
+def main():
+    host = '0.0.0.0'
+    port = 31340
+
+    # cache is warmed and updated in a background thread, lookups don't block the loop
+    storage.flag_cache.enable()
+
+    uvloop.install()
+    loop = asyncio.get_event_loop()
+
+    server = AsyncFlagSubmitter(host, port, loop)
+    loop.run_until_complete(server.serve_forever())
+
+
+if __name__ == '__main__':
+    main()
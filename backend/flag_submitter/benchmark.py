@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+"""Load generator for line-based flag submitters
+
+Opens N simultaneous connections to a submitter, sends team token and then
+a number of flags on each of them, and measures how many flag responses
+per second the server produced. Run it for several connection counts
+to see how the submitter scales, e.g.:
+
+    ./benchmark.py --port 31339 --token <token> --connections 1 10 100 500
+
+By default random (invalid) flags in the correct format are sent, which
+still go through the whole validation path. Pass --flags-file with one flag
+per line to benchmark accepted flags instead.
+"""
+
+import argparse
+import asyncio
+import secrets
+import string
+import time
+
+ALPHABET = string.ascii_uppercase + string.digits
+
+
+def random_flag() -> str:
+    return f"{''.join(secrets.choice(ALPHABET) for _ in range(31))}="
+
+
+async def run_client(host: str, port: int, token: str, flags: list) -> int:
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        await reader.readline()
+        writer.write(f'{token}\n'.encode())
+        greeting = await reader.readline()
+        if b'enter your flags' not in greeting:
+            raise ValueError(f'Unexpected greeting: {greeting!r}')
+
+        writer.write(''.join(f'{flag}\n' for flag in flags).encode())
+        await writer.drain()
+
+        responses = 0
+        while responses < len(flags):
+            line = await reader.readline()
+            if not line:
+                break
+            responses += 1
+
+        return responses
+    finally:
+        writer.close()
+
+
+async def run_round(host: str, port: int, token: str, connections: int, flags_per_connection: int, flags: list):
+    batches = []
+    for i in range(connections):
+        if flags:
+            start = (i * flags_per_connection) % len(flags)
+            batch = (flags[start:] + flags[:start])[:flags_per_connection]
+        else:
+            batch = [random_flag() for _ in range(flags_per_connection)]
+        batches.append(batch)
+
+    started = time.monotonic()
+    results = await asyncio.gather(
+        *[run_client(host, port, token, batch) for batch in batches],
+        return_exceptions=True,
+    )
+    elapsed = time.monotonic() - started
+
+    answered = sum(result for result in results if isinstance(result, int))
+    failed = sum(1 for result in results if isinstance(result, BaseException))
+    return answered, failed, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark flag submitter throughput')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=31339)
+    parser.add_argument('--token', type=str, required=True, help='Team token to submit flags with')
+    parser.add_argument('--connections', type=int, nargs='+', default=[1, 10, 50, 100, 500])
+    parser.add_argument('--flags', type=int, default=200, help='Number of flags per connection')
+    parser.add_argument('--flags-file', type=str, help='File with flags to submit, one per line')
+    args = parser.parse_args()
+
+    flags = []
+    if args.flags_file:
+        with open(args.flags_file) as f:
+            flags = [line.strip() for line in f if line.strip()]
+
+    loop = asyncio.get_event_loop()
+
+    print(f'{"connections":>12} {"flags":>10} {"failed":>8} {"seconds":>10} {"flags/sec":>12}')
+    for connections in args.connections:
+        answered, failed, elapsed = loop.run_until_complete(
+            run_round(args.host, args.port, args.token, connections, args.flags, flags)
+        )
+        print(f'{connections:>12} {answered:>10} {failed:>8} {elapsed:>10.3f} {answered / elapsed:>12.1f}')
+
+
+if __name__ == '__main__':
+    main()
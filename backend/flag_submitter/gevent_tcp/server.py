@@ -6,67 +6,123 @@ import os
 import sys
 import gevent.pool
 import gevent.server
+from typing import List, Optional
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 sys.path.insert(0, BASE_DIR)
 
 import storage
-from helplib import exceptions
+from helplib import exceptions, flags
+
+
+RECV_SIZE = 4096
+MAX_BUFFER_SIZE = 1000
+
+rate_limiter = None
+
+
+def read_lines(socket, buffer: bytearray) -> Optional[List[bytes]]:
+    """Receive data from socket and return all complete lines buffered so far
+
+        :param socket: socket to read from
+        :param buffer: bytearray with incomplete line from previous reads, updated inplace
+        :return: list of lines or None if the client disconnected
+    """
+    while True:
+        try:
+            data = socket.recv(RECV_SIZE)
+        except ConnectionError:
+            return None
+
+        if not data:
+            return None
+
+        buffer.extend(data)
+        *lines, rest = buffer.split(b'\n')
+        buffer[:] = rest
+
+        if len(buffer) > MAX_BUFFER_SIZE:
+            lines.append(bytes(buffer))
+            buffer.clear()
+
+        if lines:
+            return lines
 
 
 def handle(socket, address):
     print('Accepted connection from:', address)
 
     socket.sendall(b'Welcome! Please, enter your team token:\n')
-    rfile = socket.makefile(mode='rb')
+    buffer = bytearray()
 
-    token = rfile.readline()
+    lines = read_lines(socket, buffer)
+    if lines is None:
+        return
+
+    token, lines = lines[0], lines[1:]
     try:
         token = token.decode().strip()
     except UnicodeDecodeError:
         socket.sendall(b'Invalid team token\n')
-        rfile.close()
         return
 
     team_id = storage.teams.get_team_id_by_token(token)
 
     if not team_id:
         socket.sendall(b'Invalid team token\n')
-        rfile.close()
         return
 
     socket.sendall(b'Now enter your flags, one in a line:\n')
 
     while True:
-        flag_data = rfile.readline()
-        if not flag_data:
-            print(f'Client {address} disconnected')
-            break
-
-        try:
-            flag_str = flag_data.decode().strip()
-        except UnicodeDecodeError:
-            socket.sendall(b'Invalid flag\n')
-            continue
+        if not lines:
+            lines = read_lines(socket, buffer)
+            if lines is None:
+                print(f'Client {address} disconnected')
+                break
+
+        flag_strs = []
+        responses = []
+        for flag_data in lines:
+            try:
+                flag_strs.append(flag_data.decode().strip())
+            except UnicodeDecodeError:
+                flag_strs.append(None)
+        lines = []
+
+        # flags wait for the team's tokens, new data is not read meanwhile
+        rate_limiter.wait(team_id, len(flag_strs))
 
         round = storage.game.get_real_round()
 
         if round == -1:
-            socket.sendall(b'Game is unavailable\n')
+            socket.sendall(b'Game is unavailable\n' * len(flag_strs))
+            continue
 
-        try:
-            attacker_delta = storage.teams.handle_attack(
-                attacker_id=team_id,
-                flag_str=flag_str,
-                round=round,
-            )
-        except exceptions.FlagSubmitException as e:
-            socket.sendall(str(e).encode() + b'\n')
-        else:
-            socket.sendall(f'Flag accepted! Earned {attacker_delta} flag points!\n'.encode())
+        results = iter(storage.teams.handle_attacks_batch(
+            attacker_id=team_id,
+            flag_strs=[flag_str for flag_str in flag_strs if flag_str is not None],
+            round=round,
+        ))
+
+        for flag_str in flag_strs:
+            if flag_str is None:
+                responses.append(b'Invalid flag\n')
+                continue
+
+            result = next(results)
+            if isinstance(result, exceptions.FlagSubmitException):
+                responses.append(str(result).encode() + b'\n')
+            else:
+                responses.append((flags.accepted_message(result) + '\n').encode())
+
+        socket.sendall(b''.join(responses))
 
 
 if __name__ == '__main__':
+    storage.flag_cache.enable()
+    rate_limiter = storage.rate_limit.get_team_rate_limiter()
+
     pool = gevent.pool.Pool(10000)
     server = gevent.server.StreamServer(('0.0.0.0', 31337), handle, spawn=pool)
     server.serve_forever()
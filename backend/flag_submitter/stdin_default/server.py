@@ -7,7 +7,7 @@ BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__fil
 sys.path.insert(0, BASE_DIR)
 
 import storage
-from helplib import exceptions
+from helplib import exceptions, flags
 
 print('Welcome! Please, enter your team token:')
 token = input().strip()
@@ -47,7 +47,7 @@ while True:
         print(e)
     else:
         flags_correct += 1
-        print(f'Flag accepted! Earned {attacker_delta} flag points!')
+        print(flags.accepted_message(attacker_delta))
 
     flags_submitted += 1
     end_time = time.time()
@@ -5,103 +5,285 @@ import sys
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 sys.path.insert(0, BASE_DIR)
 
-import select
+import selectors
 import socket
-import queue
-from typing import Tuple, ByteString, Optional
+import time
+from collections import deque
+from typing import List, Optional
 
 import storage
-from helplib import exceptions
+from helplib import exceptions, flags
 
-BACKLOG = 5
+BACKLOG = 1024
 MAX_BUFFER_SIZE = 1000
+RECV_SIZE = 4096
+
+# Maximum number of flags of one team processed in a single scheduling pass,
+# teams with queued flags are served round-robin
+FAIR_BATCH_SIZE = 100
+
+# Socket is not read while the client has more queued flags than this
+MAX_PENDING_FLAGS = 5000
+
+
+class ClientState:
+    """Per-connection state of the SocketServer"""
+    __slots__ = ('sock', 'address', 'buffer', 'outgoing', 'pending', 'team_id', 'closing', 'paused', 'registered')
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.buffer = bytearray()
+        self.outgoing = deque()
+        self.pending = deque()
+        self.team_id: Optional[int] = None
+        self.closing = False
+        self.paused = False
+        self.registered = False
 
 
 class SocketServer:
     def __init__(self, host: str, port: int):
         self.host = host
         self.port = port
-        self.inputs = []
-        self.outputs = []
-        self.message_queues = {}
-        self.client_states = {}
-        self.buffers = {}
-
-    @staticmethod
-    def read_string(sock) -> Tuple[Optional[str], bool]:
-        try:
-            data = sock.recv(128).decode()
-            if not data:
-                raise ValueError
-        except (ValueError, UnicodeDecodeError, ConnectionResetError):
-            return None, False
-        return data, True
-
-    def clear(self, sock):
-        del self.message_queues[sock]
-        del self.client_states[sock]
-        del self.buffers[sock]
-        sock.close()
-        if sock in self.inputs:
-            self.inputs.remove(sock)
-        if sock in self.outputs:
-            self.outputs.remove(sock)
-
-    def write_to_sock(self, sock, message: ByteString):
-        if sock not in self.outputs:
-            self.outputs.append(sock)
-        self.message_queues[sock].put(message)
-
-    def set_sock_break(self, sock):
-        self.client_states[sock]['break'] = True
-
-    def get_sock_break(self, sock) -> Optional[bool]:
-        return self.client_states[sock].get('break')
-
-    def set_sock_team(self, sock, team_value: bool):
-        self.client_states[sock]['team'] = team_value
-
-    def set_sock_team_id(self, sock, team_id: int):
-        self.client_states[sock]['team_id'] = team_id
-
-    def get_sock_team_id(self, sock) -> Optional[int]:
-        return self.client_states[sock].get('team_id')
-
-    def handle_string(self, sock, string: str):
-        team_initialized = self.client_states[sock]['team']
-
-        if not team_initialized:
-            team_token = string
-
-            team_id = storage.teams.get_team_id_by_token(team_token)
-            if not team_id:
-                self.write_to_sock(sock, b'Invalid team token\n')
-                self.set_sock_break(sock)
+        self.selector = selectors.DefaultSelector()
+        self.clients = {}
+        self.rate_limiter = storage.rate_limit.get_team_rate_limiter()
+
+        # team id -> clients of the team with pending flags
+        self.team_queues = {}
+        # team id -> monotonic time when the team gets new tokens
+        self.throttled_until = {}
+
+    def accept(self, listen_socket):
+        conn, addr = listen_socket.accept()
+
+        print('Accepted connection from:', addr)
+
+        conn.setblocking(False)
+        state = ClientState(conn, addr)
+        self.clients[conn] = state
+        self.update_events(state)
+
+        self.write_to_sock(state, b'Welcome! Please, enter your team token:\n')
+
+    def update_events(self, state: ClientState):
+        """Register socket for reading unless paused and for writing if there's data to send"""
+        events = 0
+        if not state.paused:
+            events |= selectors.EVENT_READ
+        if state.outgoing:
+            events |= selectors.EVENT_WRITE
+
+        if not events:
+            if state.registered:
+                self.selector.unregister(state.sock)
+                state.registered = False
+        elif state.registered:
+            self.selector.modify(state.sock, events, state)
+        else:
+            self.selector.register(state.sock, events, state)
+            state.registered = True
+
+    def clear(self, state: ClientState):
+        if state.registered:
+            self.selector.unregister(state.sock)
+        del self.clients[state.sock]
+        state.sock.close()
+
+        if state.pending:
+            self.drop_pending(state)
+            queue = self.team_queues[state.team_id]
+            queue.remove(state)
+            if not queue:
+                del self.team_queues[state.team_id]
+                self.throttled_until.pop(state.team_id, None)
+
+    def drop_pending(self, state: ClientState):
+        self.rate_limiter.add_queued(state.team_id, -len(state.pending))
+        state.pending.clear()
+
+    def write_to_sock(self, state: ClientState, message: bytes):
+        state.outgoing.append(memoryview(message))
+        if len(state.outgoing) == 1:
+            self.update_events(state)
+
+    def set_sock_break(self, state: ClientState):
+        state.closing = True
+
+    def flush(self, state: ClientState):
+        """Send as much of the outgoing queue as the socket accepts,
+        keeping the unsent part of a partially written message"""
+        while state.outgoing:
+            message = state.outgoing[0]
+            try:
+                sent = state.sock.send(message)
+            except BlockingIOError:
+                return
+            except ConnectionError:
+                self.clear(state)
+                return
+
+            if sent < len(message):
+                state.outgoing[0] = message[sent:]
                 return
 
-            self.write_to_sock(sock, b'Now enter your flags, one in a line:\n')
-            self.set_sock_team(sock, True)
-            self.set_sock_team_id(sock, team_id)
+            state.outgoing.popleft()
+
+        if state.closing:
+            self.clear(state)
         else:
-            flag_str = string
+            self.update_events(state)
 
-            round = storage.game.get_real_round()
-            if round == -1:
-                self.write_to_sock(sock, b'Game is unavailable\n')
-                self.set_sock_break(sock)
-                return
+    def read(self, state: ClientState):
+        try:
+            data = state.sock.recv(RECV_SIZE)
+        except BlockingIOError:
+            return
+        except ConnectionError:
+            data = b''
+
+        if not data:
+            self.clear(state)
+            return
+
+        if state.closing:
+            return
+
+        buffer = state.buffer
+        buffer.extend(data)
+
+        end = buffer.rfind(b'\n')
+        if end != -1:
+            lines = bytes(memoryview(buffer)[:end]).split(b'\n')
+            del buffer[:end + 1]
+        else:
+            lines = []
+
+        if len(buffer) > MAX_BUFFER_SIZE:
+            lines.append(bytes(buffer))
+            buffer.clear()
+
+        if lines:
+            self.handle_strings(state, lines)
 
-            team_id = self.get_sock_team_id(sock)
+    def handle_token(self, state: ClientState, team_token: bytes):
+        try:
+            team_id = storage.teams.get_team_id_by_token(team_token.decode().strip())
+        except UnicodeDecodeError:
+            team_id = None
+
+        if not team_id:
+            self.write_to_sock(state, b'Invalid team token\n')
+            self.set_sock_break(state)
+            return
+
+        self.write_to_sock(state, b'Now enter your flags, one in a line:\n')
+        state.team_id = team_id
+
+    def handle_flags(self, state: ClientState, lines: List[bytes]):
+        round = storage.game.get_real_round()
+        if round == -1:
+            self.write_to_sock(state, b'Game is unavailable\n')
+            self.set_sock_break(state)
+            return
+
+        flag_strs = []
+        for line in lines:
             try:
-                attacker_delta = storage.teams.handle_attack(
-                    attacker_id=team_id,
-                    flag_str=flag_str,
-                    round=round,
-                )
-            except exceptions.FlagSubmitException as e:
-                self.write_to_sock(sock, str(e).encode() + b'\n')
+                flag_strs.append(line.decode().strip())
+            except UnicodeDecodeError:
+                flag_strs.append(None)
+
+        results = iter(storage.teams.handle_attacks_batch(
+            attacker_id=state.team_id,
+            flag_strs=[flag_str for flag_str in flag_strs if flag_str is not None],
+            round=round,
+        ))
+
+        response = []
+        for flag_str in flag_strs:
+            if flag_str is None:
+                response.append(b'Invalid flag\n')
+                continue
+
+            result = next(results)
+            if isinstance(result, exceptions.FlagSubmitException):
+                response.append(str(result).encode() + b'\n')
+            else:
+                response.append((flags.accepted_message(result) + '\n').encode())
+
+        self.write_to_sock(state, b''.join(response))
+
+    def enqueue_flags(self, state: ClientState, lines: List[bytes]):
+        """Put received flags to the team queue, they're processed by "schedule"
+        as the team's rate limit allows"""
+        if not state.pending:
+            self.team_queues.setdefault(state.team_id, deque()).append(state)
+
+        state.pending.extend(lines)
+        self.rate_limiter.add_queued(state.team_id, len(lines))
+
+        if len(state.pending) > MAX_PENDING_FLAGS:
+            state.paused = True
+            self.update_events(state)
+
+    def schedule(self) -> Optional[float]:
+        """Process one batch of queued flags for each team that has tokens
+
+            :return: timeout for the next select call, None if no flags are queued
+        """
+        now = time.monotonic()
+        timeout = None
+
+        for team_id in list(self.team_queues):
+            throttled_until = self.throttled_until.get(team_id, 0)
+            if throttled_until > now:
+                wait = throttled_until - now
+                timeout = wait if timeout is None else min(timeout, wait)
+                continue
+
+            queue = self.team_queues[team_id]
+            state = queue.popleft()
+
+            count = min(len(state.pending), FAIR_BATCH_SIZE)
+            granted, wait = self.rate_limiter.acquire(team_id, count)
+
+            if granted:
+                lines = [state.pending.popleft() for _ in range(granted)]
+                self.rate_limiter.add_queued(team_id, -granted)
+                self.handle_flags(state, lines)
+
+            if wait:
+                self.throttled_until[team_id] = now + wait
+                self.rate_limiter.add_throttled_time(team_id, wait)
+
+            # nobody will read responses for a closing connection
+            if state.closing:
+                self.drop_pending(state)
+            elif state.pending:
+                queue.append(state)
+
+            if state.paused and len(state.pending) <= MAX_PENDING_FLAGS // 2 and not state.closing:
+                state.paused = False
+                self.update_events(state)
+
+            if not queue:
+                del self.team_queues[team_id]
+                self.throttled_until.pop(team_id, None)
             else:
-                self.write_to_sock(sock, f'Flag accepted! Earned {attacker_delta} flag points!\n'.encode())
+                timeout = wait if timeout is None else min(timeout, wait)
+
+        return timeout
+
+    def handle_strings(self, state: ClientState, lines: List[bytes]):
+        """Process all complete lines received from the socket at once"""
+        if state.team_id is None:
+            self.handle_token(state, lines[0])
+            lines = lines[1:]
+
+        if lines and not state.closing:
+            self.enqueue_flags(state, lines)
 
     def serve_forever(self):
         listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -113,75 +295,30 @@ class SocketServer:
 
         print(f'Started TCP server on port {self.port}')
 
-        self.inputs.append(listen_socket)
-
-        while self.inputs:
-            readable, writable, exceptional = select.select(
-                self.inputs,
-                self.outputs,
-                self.inputs,
-            )
-
-            for sock in exceptional:
-                if sock in readable:
-                    readable.remove(sock)
-                if sock in readable:
-                    writable.remove(sock)
-                self.clear(sock)
-
-            for sock in writable:
-                try:
-                    next_msg = self.message_queues[sock].get_nowait()
-                except queue.Empty:
-                    self.outputs.remove(sock)
-                else:
-                    sock.send(next_msg)
-                finally:
-                    if self.get_sock_break(sock):
-                        self.clear(sock)
-
-            for sock in readable:
-                if sock is listen_socket:
-                    conn, addr = sock.accept()
-
-                    print('Accepted connection from:', addr)
-
-                    conn.setblocking(False)
-                    self.inputs.append(conn)
-                    self.outputs.append(conn)
-                    self.message_queues[conn] = queue.Queue()
-                    self.client_states[conn] = {}
-                    self.buffers[conn] = ''
-
-                    self.write_to_sock(conn, b'Welcome! Please, enter your team token:\n')
-                    self.set_sock_team(conn, False)
-                elif self.get_sock_break(sock):
-                    continue
-                else:
-                    new_data, ok = self.read_string(sock)
-                    if not ok:
-                        self.clear(sock)
-                        continue
-
-                    self.buffers[sock] += new_data
+        self.selector.register(listen_socket, selectors.EVENT_READ, None)
 
-                    position = self.buffers[sock].find('\n')
-                    while position != -1:
-                        data = self.buffers[sock][:position]
-                        self.handle_string(sock, data)
+        while True:
+            timeout = self.schedule()
+            for key, mask in self.selector.select(timeout):
+                state = key.data
+                if state is None:
+                    self.accept(key.fileobj)
+                    continue
 
-                        self.buffers[sock] = self.buffers[sock][position + 1:]
-                        position = self.buffers[sock].find('\n')
+                if mask & selectors.EVENT_READ:
+                    self.read(state)
 
-                    if len(self.buffers[sock]) > MAX_BUFFER_SIZE:
-                        self.handle_string(sock, self.buffers[sock])
-                        self.buffers[sock] = ''
+                # the client might have been cleared while reading
+                if mask & selectors.EVENT_WRITE and state.sock in self.clients:
+                    self.flush(state)
 
 
 def main():
     host = '0.0.0.0'
     port = 31339
 
+    storage.flag_cache.enable()
+
     server = SocketServer(host, port)
     server.serve_forever()
 
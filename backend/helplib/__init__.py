@@ -1,9 +1,11 @@
 from helplib import (
+    bloom,
     exceptions,
     checkers,
     commands,
     flags,
     locking,
     models,
+    scripts,
     types,
 )
@@ -0,0 +1,44 @@
+import hashlib
+import math
+
+
+class BloomFilter:
+    """Simple Bloom filter over strings
+
+        Answers "definitely not in set" or "probably in set".
+        Uses double hashing of a single blake2b digest to get "hash_count" bit positions.
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        """
+            :param capacity: expected number of elements
+            :param error_rate: desired false positive probability at full capacity
+        """
+        capacity = max(capacity, 1)
+        self.capacity = capacity
+        self.size = max(int(-capacity * math.log(error_rate) / (math.log(2) ** 2)), 8)
+        self.hash_count = max(int(round(self.size / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, value: str):
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hash_count))
+
+    def add(self, value: str):
+        for pos in self._positions(value):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, value: str) -> bool:
+        bits = self.bits
+        return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(value))
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def overfilled(self) -> bool:
+        return self.count > self.capacity
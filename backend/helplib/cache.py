@@ -1,7 +1,18 @@
-import aioredis
-import redis
+import asyncio
+import time
 from typing import Callable, Optional, Iterable
 
+# Cache is filled by a single process holding the lease "{cache_key}:lease",
+# others poll for the cached flag with exponential backoff.
+# Lease expires in case the holder dies, then the next process takes it.
+LEASE_TIMEOUT = 30
+POLL_INTERVAL = 0.005
+MAX_POLL_INTERVAL = 0.2
+
+
+def _lease_key(cache_key: str) -> str:
+    return f'{cache_key}:lease'
+
 
 def cache_helper(pipeline,
                  cache_key: str,
@@ -10,7 +21,16 @@ def cache_helper(pipeline,
                  cache_kwargs: Optional[dict] = None,
                  on_cached: Optional[Callable] = None,
                  on_cached_args: Optional[Iterable] = None,
-                 on_cached_kwargs: Optional[dict] = None):
+                 on_cached_kwargs: Optional[dict] = None) -> bool:
+    """Make sure the data is cached, filling the cache in a single process (single-flight)
+
+        If "cache_key" exists, that's a single EXISTS request. Otherwise the process
+        that takes the lease calls "cache_func", which adds commands to the transactional
+        "pipeline", and executes them together with lease release. Other processes
+        wait until the cached flag appears.
+
+        :return: True if the cache was filled by this call
+    """
     if cache_args is None:
         cache_args = tuple()
     if cache_kwargs is None:
@@ -20,48 +40,125 @@ def cache_helper(pipeline,
     if on_cached_kwargs is None:
         on_cached_kwargs = dict()
 
-    was_changed = False
-    while True:
-        try:
-            pipeline.watch(cache_key)
-            cached = pipeline.exists(cache_key)
+    lease_key = _lease_key(cache_key)
+    delay = POLL_INTERVAL
 
-            pipeline.multi()
+    cached, = pipeline.exists(cache_key).execute()
+    while not cached:
+        pipeline.set(lease_key, 1, nx=True, ex=LEASE_TIMEOUT)
+        pipeline.exists(cache_key)
+        leased, cached = pipeline.execute()
 
-            if not cached:
-                was_changed = True
+        if leased and cached:
+            pipeline.delete(lease_key).execute()
+        elif leased:
+            try:
                 cache_func(*cache_args, **cache_kwargs)
-            elif on_cached is not None:
-                on_cached(*on_cached_args, **on_cached_kwargs)
+                pipeline.delete(lease_key)
+                pipeline.execute()
+            except Exception:
+                # drop commands of the failed fill and let the waiters take the lease
+                pipeline.reset()
+                pipeline.delete(lease_key).execute()
+                raise
+            return True
+        elif not cached:
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_POLL_INTERVAL)
+            cached, = pipeline.exists(cache_key).execute()
 
-            pipeline.execute()
-        except redis.WatchError:
-            continue
-        else:
-            break
+    if on_cached is not None:
+        on_cached(*on_cached_args, **on_cached_kwargs)
+        pipeline.execute()
 
-    return was_changed
+    return False
 
 
-async def async_cache_helper(redis_aio, cache_key, cache_func, cache_args=None, cache_kwargs=None):
+async def async_cache_helper(redis_aio, cache_key, cache_func, cache_args=None, cache_kwargs=None) -> bool:
+    """Asynchronous version of cache_helper, "cache_func" gets
+    the transaction to add commands to in "redis" keyword argument"""
     if cache_args is None:
         cache_args = tuple()
     if cache_kwargs is None:
         cache_kwargs = dict()
 
-    while True:
-        try:
-            await redis_aio.watch(cache_key)
-            cached = await redis_aio.exists(cache_key)
+    lease_key = _lease_key(cache_key)
+    delay = POLL_INTERVAL
 
+    cached = await redis_aio.exists(cache_key)
+    while not cached:
+        tr = redis_aio.multi_exec()
+        tr.set(lease_key, 1, expire=LEASE_TIMEOUT, exist=redis_aio.SET_IF_NOT_EXIST)
+        tr.exists(cache_key)
+        leased, cached = await tr.execute()
+
+        if leased and cached:
+            await redis_aio.delete(lease_key)
+        elif leased:
             tr = redis_aio.multi_exec()
             cache_kwargs['redis'] = tr
-            if not cached:
+            try:
                 await cache_func(*cache_args, **cache_kwargs)
+                tr.delete(lease_key)
+                await tr.execute()
+            except Exception:
+                # the transaction is not executed, so only the lease is released
+                await redis_aio.delete(lease_key)
+                raise
+            return True
+        elif not cached:
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_POLL_INTERVAL)
+            cached = await redis_aio.exists(cache_key)
+
+    return False
+
+
+def cached_read(pipeline,
+                cache_key: str,
+                cache_func: Callable,
+                read: Callable,
+                cache_args: Optional[Iterable] = None,
+                cache_kwargs: Optional[dict] = None) -> list:
+    """Read cached data checking the cached flag in the same round trip,
+    the cache is filled (see cache_helper) and the data is read again only on miss
+
+        :param read: function adding read commands to the pipeline passed to it
+        :return: results of the read commands
+    """
+    pipeline.exists(cache_key)
+    read(pipeline)
+    cached, *results = pipeline.execute()
+    if cached:
+        return results
+
+    cache_helper(
+        pipeline=pipeline,
+        cache_key=cache_key,
+        cache_func=cache_func,
+        cache_args=cache_args,
+        cache_kwargs=cache_kwargs,
+    )
+    read(pipeline)
+    return pipeline.execute()
+
+
+async def async_cached_read(redis_aio, cache_key, cache_func, read, cache_args=None, cache_kwargs=None) -> list:
+    """Asynchronous version of cached_read, "read" gets aioredis transaction"""
+    tr = redis_aio.multi_exec()
+    tr.exists(cache_key)
+    read(tr)
+    cached, *results = await tr.execute()
+    if cached:
+        return results
 
-            await tr.execute()
-            await redis_aio.unwatch()
-        except (aioredis.MultiExecError, aioredis.WatchVariableError):
-            continue
-        else:
-            break
+    await async_cache_helper(
+        redis_aio=redis_aio,
+        cache_key=cache_key,
+        cache_func=cache_func,
+        cache_args=cache_args,
+        cache_kwargs=cache_kwargs,
+    )
+    tr = redis_aio.multi_exec()
+    read(tr)
+    return await tr.execute()
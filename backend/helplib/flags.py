@@ -1,5 +1,6 @@
 import secrets
 import string
+from typing import List, Optional
 
 import storage
 from helplib import models
@@ -30,7 +31,73 @@ def generate_flag(service: str, team_id: int, task_id: int, round: int) -> model
 
 
 def try_add_stolen_flag_by_str(flag_str: str, attacker: int, round: int) -> models.Flag:
-    """Check flag wrapper, fetching flag using its string value, then runs try_add_stolen_flag from storage"""
-    flag = storage.flags.get_flag_by_str(flag_str=flag_str, round=round)
-    storage.flags.try_add_stolen_flag(flag=flag, attacker=attacker, round=round)
+    """Check flag by its string value and add it to stolen flags of the attacker
+
+        :raises FlagSubmitException: if the flag was rejected
+    """
+    (flag, error), = storage.flags.accept_flags_by_str_batch(flag_strs=[flag_str], attacker=attacker, round=round)
+    if error is not None:
+        raise error
     return flag
+
+
+def accepted_message(points: Optional[float]) -> str:
+    """Get submitter response for accepted flag, points are None in write-behind mode,
+    as the rating is recalculated after the response"""
+    if points is None:
+        return 'Flag accepted!'
+    return f'Flag accepted! Earned {points} flag points!'
+
+
+def try_add_stolen_flags_by_str_batch(flag_strs: List[str],
+                                      attacker: int,
+                                      round: int,
+                                      write_behind: bool = False) -> List[tuple]:
+    """Batch version of try_add_stolen_flag_by_str
+
+        Definitely invalid, too old, own and recently rejected flags are answered from
+        the local flag cache (if it's enabled) without redis requests,
+        the rest are checked with a single redis call.
+        With "write_behind" accepted flags are also added to the attacks stream.
+
+        :return: list of (flag, error) pairs in the order of "flag_strs",
+                 error is None if the flag was accepted
+    """
+    prechecked = storage.flag_cache.precheck(attacker=attacker, flag_strs=flag_strs, round=round)
+    to_check = [flag_str for flag_str, error in zip(flag_strs, prechecked) if error is None]
+
+    checked = storage.flags.accept_flags_by_str_batch(
+        flag_strs=to_check,
+        attacker=attacker,
+        round=round,
+        write_behind=write_behind,
+    )
+    storage.flag_cache.remember_rejected(attacker=attacker, flag_strs=to_check, errors=[e for _, e in checked])
+
+    return _merge_prechecked(prechecked, checked)
+
+
+async def try_add_stolen_flags_by_str_batch_async(flag_strs: List[str],
+                                                  attacker: int,
+                                                  round: int,
+                                                  loop,
+                                                  write_behind: bool = False) -> List[tuple]:
+    """Asynchronous version of try_add_stolen_flags_by_str_batch"""
+    prechecked = storage.flag_cache.precheck(attacker=attacker, flag_strs=flag_strs, round=round)
+    to_check = [flag_str for flag_str, error in zip(flag_strs, prechecked) if error is None]
+
+    checked = await storage.flags.accept_flags_by_str_batch_async(
+        flag_strs=to_check,
+        attacker=attacker,
+        round=round,
+        loop=loop,
+        write_behind=write_behind,
+    )
+    storage.flag_cache.remember_rejected(attacker=attacker, flag_strs=to_check, errors=[e for _, e in checked])
+
+    return _merge_prechecked(prechecked, checked)
+
+
+def _merge_prechecked(prechecked: list, checked: list) -> List[tuple]:
+    checked = iter(checked)
+    return [(None, error) if error is not None else next(checked) for error in prechecked]
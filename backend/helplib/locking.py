@@ -1,28 +1,141 @@
+import logging
 import os
+import random
+import threading
+import time
 from contextlib import contextmanager
 
+import redis
+
 from helplib import exceptions
 
+logger = logging.getLogger(__name__)
 
-@contextmanager
-def acquire_redis_lock(pipeline, name, timeout=5000):
-    try:
-        while True:
+# Waiting processes sleep for a random time up to the current delay,
+# the delay doubles after each failed attempt (exponential backoff with full jitter)
+MIN_BACKOFF = 0.005
+MAX_BACKOFF = 0.5
+
+# Sets the lock and increments the fencing counter "{name}:fencing" atomically,
+# so every holder gets a token greater than the tokens of all previous holders
+_ACQUIRE_SCRIPT = """
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    return redis.call('INCR', KEYS[2])
+end
+return 0
+"""
+
+# Release and renewal only touch the lock if it's still held with our nonce,
+# an expired lock taken by another process is left alone
+_RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+_RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+def _fencing_key(name: str) -> str:
+    return f'{name}:fencing'
+
+
+def _eval(pipeline, script: str, keys: list, args: list):
+    """Run the script through the pipeline, commands buffered before are executed with it"""
+    pipeline.eval(script, len(keys), *keys, *args)
+    return pipeline.execute()[-1]
+
+
+class _LeaseRenewer(threading.Thread):
+    """Extends the lock every third of its timeout while the holder is running"""
+
+    def __init__(self, client: redis.Redis, name: str, nonce: str, timeout: int):
+        super(_LeaseRenewer, self).__init__(daemon=True)
+        self.client = client
+        self.name = name
+        self.nonce = nonce
+        self.timeout = timeout
+        self.stopped = threading.Event()
+        self.lost = False
+
+    def run(self):
+        while not self.stopped.wait(self.timeout / 3000):
             try:
-                nonce = os.urandom(10)
-                unlocked = pipeline.set(name, nonce, nx=True, px=timeout)
-                if pipeline.transaction:
-                    unlocked, = unlocked.execute()
-
-                if not unlocked:
-                    raise exceptions.LockedException
-            except exceptions.LockedException:
+                renewed = self.client.eval(_RENEW_SCRIPT, 1, self.name, self.nonce, self.timeout)
+            except redis.RedisError as e:
+                logger.warning(f'Failed to renew lock {self.name}: {e}')
                 continue
-            else:
-                break
 
-        yield True
+            if not renewed:
+                self.lost = True
+                logger.warning(f'Lock {self.name} expired before renewal')
+                return
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def try_acquire_redis_lock(pipeline, name: str, nonce: str, timeout: int = 5000) -> int:
+    """Make a single attempt to take the lock
+
+        :return: fencing token of the new holder
+        :raises LockedException: if the lock is held by someone else
+    """
+    token = _eval(pipeline, _ACQUIRE_SCRIPT, [name, _fencing_key(name)], [nonce, timeout])
+    if not token:
+        raise exceptions.LockedException
+    return int(token)
+
+
+def release_redis_lock(pipeline, name: str, nonce: str) -> bool:
+    """Release the lock if it's still held with "nonce"
+
+        :return: False if the lock expired before release
+    """
+    return bool(_eval(pipeline, _RELEASE_SCRIPT, [name], [nonce]))
+
+
+@contextmanager
+def acquire_redis_lock(pipeline, name, timeout=5000, renew=True):
+    """Hold distributed lock "name" for the duration of the context
+
+        Waiting processes back off with jitter instead of spinning on redis.
+        While the lock is held, it's renewed in a background thread, so holders
+        running longer than "timeout" milliseconds keep it. The lock can still
+        be lost (e.g. the holder is paused for longer than "timeout"), so writes
+        guarded by it should check the fencing token, which is yielded by the context
+        and grows with each acquisition.
+    """
+    nonce = os.urandom(10).hex()
+    delay = MIN_BACKOFF
+
+    while True:
+        try:
+            token = try_acquire_redis_lock(pipeline, name, nonce, timeout)
+        except exceptions.LockedException:
+            time.sleep(random.uniform(0, delay))
+            delay = min(delay * 2, MAX_BACKOFF)
+        else:
+            break
+
+    renewer = None
+    if renew:
+        client = redis.Redis(connection_pool=pipeline.connection_pool)
+        renewer = _LeaseRenewer(client, name, nonce, timeout)
+        renewer.start()
+
+    try:
+        yield token
     finally:
-        res = pipeline.delete(name)
-        if pipeline.transaction:
-            res.execute()
+        if renewer is not None:
+            renewer.stop()
+
+        if not release_redis_lock(pipeline, name, nonce):
+            logger.warning(f'Lock {name} (fencing token {token}) expired while held')
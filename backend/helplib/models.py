@@ -192,6 +192,44 @@ class Flag(Model):
         )
 
 
+class FirstBlood(Model):
+    """Model representing the first accepted attack on a task"""
+    task_id: int
+    attacker_id: int
+    victim_id: int
+    flag_id: int
+    round: int
+    submit_time: datetime.datetime
+
+    def __init__(self,
+                 task_id: int,
+                 attacker_id: int,
+                 victim_id: int,
+                 flag_id: int,
+                 round: int,
+                 submit_time: datetime.datetime):
+        super(FirstBlood, self).__init__()
+        self.task_id = task_id
+        self.attacker_id = attacker_id
+        self.victim_id = victim_id
+        self.flag_id = flag_id
+        self.round = round
+        self.submit_time = submit_time
+
+    def to_dict(self):
+        return {
+            'task_id': self.task_id,
+            'attacker_id': self.attacker_id,
+            'victim_id': self.victim_id,
+            'flag_id': self.flag_id,
+            'round': self.round,
+            'submit_time': self.submit_time,
+        }
+
+    def __str__(self):
+        return f"FirstBlood(task {self.task_id} by team {self.attacker_id} on round {self.round})"
+
+
 class GameState(Model):
     """Model representing game state
 
@@ -207,6 +245,19 @@ class GameState(Model):
         self.round = round
         self.team_tasks = team_tasks
 
+    # columns of the compact encoding with their types, messages are stored separately
+    COLUMNS = (
+        ('id', int),
+        ('team_id', int),
+        ('task_id', int),
+        ('score', float),
+        ('status', int),
+        ('stolen', int),
+        ('lost', int),
+        ('checks', int),
+        ('checks_passed', int),
+    )
+
     def to_dict(self):
         return {
             'round_start': self.round_start,
@@ -214,6 +265,48 @@ class GameState(Model):
             'team_tasks': self.team_tasks
         }
 
+    def to_columnar_dict(self):
+        """Compact representation with an array for each teamtask field
+        instead of a dict for each teamtask, messages are replaced by indices in the "messages" table"""
+        columns = {name: [] for name, _ in self.COLUMNS}
+        message_column = []
+        messages = []
+        message_indices = {}
+
+        for team_task in self.team_tasks:
+            for name, t in self.COLUMNS:
+                columns[name].append(t(team_task[name]))
+
+            message = team_task.get('message', '')
+            index = message_indices.get(message)
+            if index is None:
+                index = message_indices[message] = len(messages)
+                messages.append(message)
+            message_column.append(index)
+
+        columns['message'] = message_column
+
+        return {
+            'round_start': self.round_start,
+            'round': self.round,
+            'columns': columns,
+            'messages': messages,
+        }
+
+    @classmethod
+    def from_columnar_dict(cls, d: dict) -> 'GameState':
+        columns = d['columns']
+        messages = d['messages']
+        names = [name for name, _ in cls.COLUMNS]
+
+        team_tasks = []
+        for values in zip(*[columns[name] for name in names], columns['message']):
+            team_task = dict(zip(names, values))
+            team_task['message'] = messages[values[-1]]
+            team_tasks.append(team_task)
+
+        return cls(round_start=d['round_start'], round=d['round'], team_tasks=team_tasks)
+
     def __str__(self):
         return f"GameState for round {self.round}"
 
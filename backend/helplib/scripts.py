@@ -0,0 +1,22 @@
+import hashlib
+
+import aioredis
+
+
+class AsyncScript:
+    """aioredis counterpart of redis-py Script, runs the Lua script by its hash
+    with EVALSHA and loads it only when redis replies with NOSCRIPT"""
+
+    def __init__(self, source: str):
+        self.source = source
+        self.sha = hashlib.sha1(source.encode()).hexdigest()
+
+    async def __call__(self, redis_aio, keys: list, args: list):
+        try:
+            return await redis_aio.evalsha(self.sha, keys=keys, args=args)
+        except aioredis.errors.ReplyError as e:
+            if not str(e).startswith('NOSCRIPT'):
+                raise
+
+        await redis_aio.script_load(self.source)
+        return await redis_aio.evalsha(self.sha, keys=keys, args=args)
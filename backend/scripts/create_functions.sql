@@ -120,6 +120,94 @@ BEGIN
 END;
 $$ LANGUAGE plpgsql ROWS 1;
 
+CREATE OR REPLACE FUNCTION recalculate_rating_bulk(_attacker_ids INTEGER[], _flag_ids INTEGER[])
+    RETURNS TABLE
+            (
+                flag_id        INTEGER,
+                attacker_id    INTEGER,
+                attacker_delta FLOAT,
+                victim_delta   FLOAT
+            )
+AS
+$$
+#variable_conflict use_column
+DECLARE
+    hardness        FLOAT;
+    inflate         BOOLEAN;
+    attack          RECORD;
+    attacker_score  FLOAT;
+    victim_score    FLOAT;
+    _attacker_delta FLOAT;
+    _victim_delta   FLOAT;
+BEGIN
+    SELECT game_hardness, inflation FROM globalconfig WHERE id = 1 INTO hardness, inflate;
+
+--     avoid deadlocks by locking all affected teamtasks at once, ordered by (team_id, task_id)
+    PERFORM 1
+    FROM teamtasks tt
+    WHERE (tt.team_id, tt.task_id) IN (SELECT a.attacker_id, f.task_id
+                                       FROM unnest(_attacker_ids, _flag_ids) AS a (attacker_id, flag_id)
+                                                JOIN flags f ON f.id = a.flag_id
+                                       UNION
+                                       SELECT f.team_id, f.task_id
+                                       FROM flags f
+                                       WHERE f.id = ANY (_flag_ids))
+    ORDER BY tt.team_id, tt.task_id
+        FOR NO KEY UPDATE;
+
+--     apply attacks one by one in the submission order, so the result is the same
+--     as calling recalculate_rating for each flag sequentially
+    FOR attack IN SELECT a.attacker_id AS attacker_id,
+                         f.id          AS flag_id,
+                         f.team_id     AS victim_id,
+                         f.task_id     AS task_id
+                  FROM unnest(_attacker_ids, _flag_ids) WITH ORDINALITY AS a (attacker_id, flag_id, ord)
+                           JOIN flags f ON f.id = a.flag_id
+                  ORDER BY a.ord
+        LOOP
+            INSERT INTO stolenflags (attacker_id, flag_id)
+            VALUES (attack.attacker_id, attack.flag_id)
+            ON CONFLICT DO NOTHING;
+
+            IF NOT FOUND THEN
+                CONTINUE;
+            END IF;
+
+            SELECT score
+            FROM teamtasks
+            WHERE team_id = attack.attacker_id
+              AND task_id = attack.task_id
+            INTO attacker_score;
+
+            SELECT score
+            FROM teamtasks
+            WHERE team_id = attack.victim_id
+              AND task_id = attack.task_id
+            INTO victim_score;
+
+            SELECT * FROM calculate(attacker_score, victim_score, hardness, inflate) INTO _attacker_delta, _victim_delta;
+
+            UPDATE teamtasks
+            SET stolen = stolen + 1,
+                score  = score + _attacker_delta
+            WHERE team_id = attack.attacker_id
+              AND task_id = attack.task_id;
+
+            UPDATE teamtasks
+            SET lost  = lost + 1,
+                score = score + _victim_delta
+            WHERE team_id = attack.victim_id
+              AND task_id = attack.task_id;
+
+            flag_id := attack.flag_id;
+            attacker_id := attack.attacker_id;
+            attacker_delta := _attacker_delta;
+            victim_delta := _victim_delta;
+            RETURN NEXT;
+        END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
 
 CREATE OR REPLACE FUNCTION get_first_bloods()
     RETURNS TABLE
@@ -134,21 +222,16 @@ CREATE OR REPLACE FUNCTION get_first_bloods()
 AS
 $$
 BEGIN
-    RETURN QUERY WITH preprocess AS (SELECT DISTINCT ON (f.task_id) sf.id          AS attack_id,
-                                                                    sf.submit_time AS submit_time,
-                                                                    sf.attacker_id AS attacker_id,
-                                                                    f.task_id      AS task_id
-                                     FROM stolenflags sf
-                                              JOIN flags f ON f.id = sf.flag_id
-                                     ORDER BY f.task_id, sf.id)
-                 SELECT preprocess.attack_id   AS attack_id,
-                        preprocess.submit_time AS submit_time,
-                        tm.name                AS attacker_name,
-                        tk.name                AS task_name,
-                        tm.id                  AS attacker_id,
-                        tk.id                  AS task_id
-                 FROM preprocess
-                          JOIN teams tm ON tm.id = preprocess.attacker_id
-                          JOIN tasks tk ON tk.id = preprocess.task_id;
+    RETURN QUERY SELECT sf.id          AS attack_id,
+                        fb.submit_time AS submit_time,
+                        tm.name        AS attacker_name,
+                        tk.name        AS task_name,
+                        tm.id          AS attacker_id,
+                        tk.id          AS task_id
+                 FROM firstbloods fb
+                          JOIN stolenflags sf ON sf.flag_id = fb.flag_id AND sf.attacker_id = fb.attacker_id
+                          JOIN teams tm ON tm.id = fb.attacker_id
+                          JOIN tasks tk ON tk.id = fb.task_id
+                 ORDER BY fb.task_id;
 END;
 $$ LANGUAGE plpgsql;
\ No newline at end of file
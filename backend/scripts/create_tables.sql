@@ -76,6 +76,23 @@ CREATE UNLOGGED TABLE IF NOT EXISTS TeamTasksLog
     ts              TIMESTAMP WITH TIME ZONE DEFAULT now()
 );
 
+CREATE TABLE IF NOT EXISTS FirstBloods
+(
+    task_id     INTEGER PRIMARY KEY,
+    attacker_id INTEGER NOT NULL,
+    victim_id   INTEGER NOT NULL,
+    flag_id     INTEGER NOT NULL,
+    round       INTEGER NOT NULL,
+    submit_time TIMESTAMP WITH TIME ZONE DEFAULT now()
+);
+
+-- Greatest fencing token of each distributed lock seen by writes it guards
+CREATE TABLE IF NOT EXISTS LockFences
+(
+    name  VARCHAR(64) PRIMARY KEY,
+    token BIGINT NOT NULL
+);
+
 CREATE TABLE IF NOT EXISTS GlobalConfig
 (
     id            SERIAL PRIMARY KEY,
@@ -92,3 +109,6 @@ CREATE TABLE IF NOT EXISTS GlobalConfig
 
 CREATE INDEX IF NOT EXISTS idx_flags_team_round
     ON Flags (round, team_id);
+
+CREATE INDEX IF NOT EXISTS idx_teamtaskslog_team_task_round
+    ON TeamTasksLog (team_id, task_id, round);
@@ -150,10 +150,11 @@ def run():
         pipeline.set('game_state', game_state.to_json())
         pipeline.execute()
 
-    storage.get_wro_sio_manager().emit(
+    storage.game.publish_scoreboard_snapshot(game_state)
+
+    storage.game_events.emit(
         event='update_scoreboard',
-        data={'data': game_state.to_json()},
-        namespace='/game_events',
+        data=game_state.to_json(),
     )
 
 
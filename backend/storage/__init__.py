@@ -1,5 +1,8 @@
-from contextlib import contextmanager
+import asyncio
+import threading
+from contextlib import contextmanager, asynccontextmanager
 
+import aiopg
 import aioredis
 import redis
 import socketio
@@ -12,21 +15,36 @@ from storage import (
     flags,
     caching,
     teams,
+    flag_cache,
+    rate_limit,
+    attack_events,
+    ranking,
+    game_events,
+    first_bloods,
+    local_cache,
+    write_behind,
 )
 
 _redis_storage = None
 _async_redis_storage = None
 _db_pool = None
+_db_pool_lock = threading.Lock()
+_async_db_pool = None
+_async_db_pool_lock = None
 _async_sio_manager = None
 _sio_wro_manager = None
 
 
 def get_db_pool():
+    """Get database connection pool, it's shared with background threads
+    (e.g. local flag cache warming), so the thread-safe pool is used"""
     global _db_pool
 
     if not _db_pool:
-        database_config = config.get_db_config()
-        _db_pool = pool.SimpleConnectionPool(minconn=1, maxconn=20, **database_config)
+        with _db_pool_lock:
+            if not _db_pool:
+                database_config = config.get_db_config()
+                _db_pool = pool.ThreadedConnectionPool(minconn=1, maxconn=20, **database_config)
 
     return _db_pool
 
@@ -46,6 +64,48 @@ def db_cursor(dict_cursor=False):
         db_pool.putconn(conn)
 
 
+async def get_async_db_pool(loop):
+    """Get async database connection pool, concurrent first calls
+    wait for a single pool to be created instead of creating their own"""
+    global _async_db_pool, _async_db_pool_lock
+
+    if not _async_db_pool:
+        if _async_db_pool_lock is None:
+            _async_db_pool_lock = asyncio.Lock(loop=loop)
+
+        async with _async_db_pool_lock:
+            if not _async_db_pool:
+                database_config = config.get_db_config()
+                _async_db_pool = await aiopg.create_pool(minsize=1, maxsize=20, loop=loop, **database_config)
+
+    return _async_db_pool
+
+
+@asynccontextmanager
+async def async_db_cursor(loop, dict_cursor=False):
+    """Async version of db_cursor, connections are in autocommit mode,
+    so wrap queries in "async_db_transaction" for transactions"""
+    db_pool = await get_async_db_pool(loop)
+    cursor_factory = extras.RealDictCursor if dict_cursor else None
+    async with db_pool.acquire() as conn:
+        async with conn.cursor(cursor_factory=cursor_factory) as curs:
+            yield conn, curs
+
+
+@asynccontextmanager
+async def async_db_transaction(curs):
+    """Run queries of the context in a READ COMMITTED transaction, as db_cursor
+    connections do. aiopg "curs.begin()" uses REPEATABLE READ, which fails
+    with serialization errors when rating updates of the same teamtasks overlap"""
+    await curs.execute('BEGIN')
+    try:
+        yield
+    except BaseException:
+        await curs.execute('ROLLBACK')
+        raise
+    await curs.execute('COMMIT')
+
+
 def get_redis_storage():
     global _redis_storage
 
@@ -0,0 +1,132 @@
+import atexit
+import logging
+import threading
+import time
+from collections import deque
+from typing import List, Optional
+
+from kombu.utils import json
+
+import storage
+
+# Attacks are aggregated for this number of seconds before publishing
+FLUSH_INTERVAL = 0.5
+
+# Maximum number of per-attack "flag_stolen" events sent in a single flush,
+# older attacks are still counted in "flags_stolen_batch"
+MAX_ATTACK_EVENTS = 1000
+
+logger = logging.getLogger(__name__)
+
+_attack_event_batcher = None
+
+
+class AttackEventBatcher:
+    """Aggregates accepted attacks per (attacker, victim, task) and
+    publishes them as a single "flags_stolen_batch" event from a background thread,
+    so the submit path never waits for the message broker
+
+        Per-attack "flag_stolen" events are only sent to socket.io listeners
+        (if enabled), at most MAX_ATTACK_EVENTS per flush. Attacks added after
+        the last flush are published on interpreter exit, so short-lived
+        processes don't lose them.
+    """
+
+    def __init__(self, flush_interval: float = FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._attacks = deque(maxlen=MAX_ATTACK_EVENTS)
+        self._thread: Optional[threading.Thread] = None
+
+    def add(self, attacker_id: int, victim_id: int, task_id: int, attacker_delta: float, victim_delta: float):
+        key = (attacker_id, victim_id, task_id)
+        with self._lock:
+            if storage.game_events.socketio_enabled():
+                self._attacks.append({
+                    'attacker_id': attacker_id,
+                    'victim_id': victim_id,
+                    'task_id': task_id,
+                    'attacker_delta': attacker_delta,
+                    'victim_delta': victim_delta,
+                })
+            entry = self._pending.get(key)
+            if entry is None:
+                self._pending[key] = [1, attacker_delta, victim_delta]
+            else:
+                entry[0] += 1
+                entry[1] += attacker_delta
+                entry[2] += victim_delta
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            attacks, self._attacks = self._attacks, deque(maxlen=MAX_ATTACK_EVENTS)
+
+        if not pending:
+            return
+
+        for attack in attacks:
+            storage.game_events.emit_socketio(event='flag_stolen', data=json.dumps(attack))
+
+        events = [
+            {
+                'attacker_id': attacker_id,
+                'victim_id': victim_id,
+                'task_id': task_id,
+                'count': count,
+                'attacker_delta': attacker_delta,
+                'victim_delta': victim_delta,
+            }
+            for (attacker_id, victim_id, task_id), (count, attacker_delta, victim_delta) in pending.items()
+        ]
+
+        storage.game_events.emit(
+            event='flags_stolen_batch',
+            data=json.dumps(events),
+        )
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Failed to publish stolen flags')
+
+    def flush_on_exit(self):
+        try:
+            self.flush()
+        except Exception:
+            logger.exception('Failed to publish stolen flags on exit')
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+            atexit.register(self.flush_on_exit)
+
+
+def get_attack_event_batcher() -> AttackEventBatcher:
+    """Get process-wide batcher, publishing thread is started on first use"""
+    global _attack_event_batcher
+
+    if _attack_event_batcher is None:
+        _attack_event_batcher = AttackEventBatcher()
+        _attack_event_batcher.start()
+
+    return _attack_event_batcher
+
+
+def add_attacks(attacker_id: int, accepted: List[tuple]):
+    """Schedule publishing of accepted attacks
+
+        :param attacker_id: id of the attacking team
+        :param accepted: list of (flag, attacker_delta, victim_delta)
+    """
+    if not accepted:
+        return
+
+    batcher = get_attack_event_batcher()
+    for flag, attacker_delta, victim_delta in accepted:
+        batcher.add(attacker_id, flag.team_id, flag.task_id, attacker_delta, victim_delta)
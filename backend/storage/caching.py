@@ -1,3 +1,7 @@
+import time
+
+from typing import List, Optional
+
 import helplib
 import storage
 from helplib import models
@@ -14,7 +18,28 @@ SELECT flag_id FROM stolenflags
 WHERE flag_id IN (SELECT id from flag_ids) AND attacker_id = %s
 """
 
-_SELECT_ALL_LAST_FLAGS_QUERY = "SELECT * from flags WHERE round >= %s"
+_SELECT_ALL_LAST_FLAGS_QUERY = "SELECT * from flags WHERE round >= %s ORDER BY round"
+
+_SELECT_RANKING_TEAMTASKS_QUERY = "SELECT team_id, task_id, score, checks, checks_passed, stolen, lost FROM teamtasks"
+
+_SELECT_ALL_FIRST_BLOODS_QUERY = "SELECT * FROM firstbloods"
+
+
+def new_cache_version() -> int:
+    """Version of freshly cached data. Current time in milliseconds is used
+    instead of a counter, so versions keep growing after redis is flushed by reset scripts"""
+    return int(time.time() * 1000)
+
+
+async def get_cache_version_async(name: str, loop) -> Optional[int]:
+    """Get version of the cached data ("teams", "tasks" or "global_config"),
+    it changes each time the data is cached from the database
+
+        :return: version or None if the data wasn't cached yet
+    """
+    redis_aio = await storage.get_async_redis_storage(loop)
+    version = await redis_aio.get(f'{name}:version')
+    return int(version) if version is not None else None
 
 
 def cache_teams(pipeline):
@@ -34,11 +59,26 @@ def cache_teams(pipeline):
     for team in teams:
         pipeline.set(f'team:token:{team.token}', team.id)
     pipeline.set('teams:cached', 1)
+    pipeline.set('teams:version', new_cache_version())
+    pipeline.publish(storage.local_cache.CACHE_UPDATES_CHANNEL, 'teams')
 
 
-async def cache_teams_async(redis):
+async def cache_teams_async(loop, redis):
     """Async version of cache_teams"""
-    return cache_teams(redis)
+    async with storage.async_db_cursor(loop, dict_cursor=True) as (conn, curs):
+        await curs.execute(_SELECT_ALL_TEAMS_QUERY)
+        teams = await curs.fetchall()
+
+    teams = list(models.Team.from_dict(team) for team in teams)
+
+    redis.delete('teams', 'teams:cached')
+    if teams:
+        redis.sadd('teams', *[team.to_json() for team in teams])
+    for team in teams:
+        redis.set(f'team:token:{team.token}', team.id)
+    redis.set('teams:cached', 1)
+    redis.set('teams:version', new_cache_version())
+    redis.publish(storage.local_cache.CACHE_UPDATES_CHANNEL, 'teams')
 
 
 def cache_tasks(pipeline):
@@ -55,11 +95,23 @@ def cache_tasks(pipeline):
     if tasks:
         pipeline.sadd('tasks', *[task.to_json() for task in tasks])
     pipeline.set('tasks:cached', 1)
+    pipeline.set('tasks:version', new_cache_version())
+    pipeline.publish(storage.local_cache.CACHE_UPDATES_CHANNEL, 'tasks')
 
 
-async def cache_tasks_async(redis):
+async def cache_tasks_async(loop, redis):
     """Async version of cache_tasks"""
-    return cache_tasks(redis)
+    async with storage.async_db_cursor(loop, dict_cursor=True) as (conn, curs):
+        await curs.execute(_SELECT_ALL_TASKS_QUERY)
+        tasks = await curs.fetchall()
+
+    tasks = list(models.Task.from_dict(task) for task in tasks)
+    redis.delete('tasks', 'tasks:cached')
+    if tasks:
+        redis.sadd('tasks', *[task.to_json() for task in tasks])
+    redis.set('tasks:cached', 1)
+    redis.set('tasks:version', new_cache_version())
+    redis.publish(storage.local_cache.CACHE_UPDATES_CHANNEL, 'tasks')
 
 
 def cache_last_stolen(team_id: int, round: int, pipeline):
@@ -82,6 +134,32 @@ def cache_last_stolen(team_id: int, round: int, pipeline):
     pipeline.set(f'team:{team_id}:stolen_flags:cached', 1)
 
 
+async def cache_last_stolen_async(team_id: int, round: int, loop, redis):
+    """Async version of cache_last_stolen"""
+    game_config = await storage.game.get_current_global_config_async(loop)
+
+    async with storage.async_db_cursor(loop) as (conn, curs):
+        await curs.execute(_SELECT_LAST_STOLEN_TEAM_FLAGS_QUERY, (round - game_config.flag_lifetime, team_id))
+        flags = await curs.fetchall()
+
+    redis.delete(f'team:{team_id}:stolen_flags:cached', f'team:{team_id}:stolen_flags')
+    if flags:
+        redis.sadd(f'team:{team_id}:stolen_flags', *[flag_id for flag_id, in flags])
+    redis.set(f'team:{team_id}:stolen_flags:cached', 1)
+
+
+def get_last_flags_from_db(since_round: int) -> List[helplib.models.Flag]:
+    """Fetch all flags generated since the specified round, ordered by round
+
+        :param since_round: first round to fetch flags for
+    """
+    with storage.db_cursor(dict_cursor=True) as (conn, curs):
+        curs.execute(_SELECT_ALL_LAST_FLAGS_QUERY, (since_round,))
+        flags = curs.fetchall()
+
+    return list(helplib.models.Flag.from_dict(data) for data in flags)
+
+
 def cache_last_flags(round: int, pipeline):
     """Put all generated flags from last "flag_lifetime" rounds to cache
 
@@ -93,12 +171,9 @@ def cache_last_flags(round: int, pipeline):
     game_config = storage.game.get_current_global_config()
     expires = game_config.flag_lifetime * game_config.round_time * 2  # can be smaller
 
-    with storage.db_cursor(dict_cursor=True) as (conn, curs):
-        curs.execute(_SELECT_ALL_LAST_FLAGS_QUERY, (round - game_config.flag_lifetime,))
-        flags = curs.fetchall()
+    flag_models = get_last_flags_from_db(round - game_config.flag_lifetime)
 
     pipeline.delete('flags:cached')
-    flag_models = list(helplib.models.Flag.from_dict(data) for data in flags)
 
     if flag_models:
         pipeline.delete(*[f'team:{flag.team_id}:task:{flag.task_id}:round_flags:{flag.round}' for flag in flag_models])
@@ -114,9 +189,142 @@ def cache_last_flags(round: int, pipeline):
     pipeline.set('flags:cached', 1)
 
 
+async def cache_last_flags_async(round: int, loop, redis):
+    """Async version of cache_last_flags"""
+    game_config = await storage.game.get_current_global_config_async(loop)
+    expires = game_config.flag_lifetime * game_config.round_time * 2  # can be smaller
+
+    async with storage.async_db_cursor(loop, dict_cursor=True) as (conn, curs):
+        await curs.execute(_SELECT_ALL_LAST_FLAGS_QUERY, (round - game_config.flag_lifetime,))
+        flags = await curs.fetchall()
+
+    redis.delete('flags:cached')
+    flag_models = list(helplib.models.Flag.from_dict(data) for data in flags)
+
+    if flag_models:
+        redis.delete(*[f'team:{flag.team_id}:task:{flag.task_id}:round_flags:{flag.round}' for flag in flag_models])
+
+    for flag in flag_models:
+        redis.set(f'flag:id:{flag.id}', flag.to_json(), expire=expires)
+        redis.set(f'flag:str:{flag.flag}', flag.to_json(), expire=expires)
+
+        round_flags_key = f'team:{flag.team_id}:task:{flag.task_id}:round_flags:{flag.round}'
+        redis.sadd(round_flags_key, flag.id)
+        redis.expire(round_flags_key, expires)
+
+    redis.set('flags:cached', 1)
+
+
 def cache_global_config(pipeline):
     """Put global config to cache (without round or game_running)"""
     global_config = storage.game.get_db_global_config()
     data = global_config.to_json()
     pipeline.set('global_config', data)
     pipeline.set('global_config:cached', 1)
+    pipeline.set('global_config:version', new_cache_version())
+    pipeline.publish(storage.local_cache.CACHE_UPDATES_CHANNEL, 'global_config')
+
+
+async def cache_global_config_async(loop, redis):
+    """Async version of cache_global_config"""
+    global_config = await storage.game.get_db_global_config_async(loop)
+    data = global_config.to_json()
+    redis.set('global_config', data)
+    redis.set('global_config:cached', 1)
+    redis.set('global_config:version', new_cache_version())
+    redis.publish(storage.local_cache.CACHE_UPDATES_CHANNEL, 'global_config')
+
+
+def _build_ranking(teamtasks: List[dict]):
+    """Build per-team hashes and team totals for the ranking from teamtasks rows"""
+    teams = {}
+    totals = {}
+    for tt in teamtasks:
+        team = teams.setdefault(tt['team_id'], {'stolen': 0, 'lost': 0})
+        prefix = f'{tt["task_id"]}:'
+        contribution = tt['score'] * tt['checks_passed'] / max(tt['checks'], 1)
+
+        team[prefix + 'score'] = tt['score']
+        team[prefix + 'checks'] = tt['checks']
+        team[prefix + 'checks_passed'] = tt['checks_passed']
+        team[prefix + 'stolen'] = tt['stolen']
+        team[prefix + 'lost'] = tt['lost']
+        team[prefix + 'contribution'] = contribution
+        team['stolen'] += tt['stolen']
+        team['lost'] += tt['lost']
+
+        totals[tt['team_id']] = totals.get(tt['team_id'], 0) + contribution
+
+    return teams, totals
+
+
+def cache_ranking(pipeline):
+    """Put team score totals and per-task score, stolen and lost counts from "teamtasks" table to cache
+
+    Just adds commands to pipeline stack, don't forget to execute afterwards
+    """
+    with storage.db_cursor(dict_cursor=True) as (conn, curs):
+        curs.execute(_SELECT_RANKING_TEAMTASKS_QUERY)
+        teamtasks = curs.fetchall()
+
+    teams, totals = _build_ranking(teamtasks)
+
+    pipeline.delete(storage.ranking.RANKING_KEY, *[storage.ranking.team_key(team_id) for team_id in teams])
+    for team_id, data in teams.items():
+        pipeline.hmset(storage.ranking.team_key(team_id), data)
+    if totals:
+        pipeline.zadd(storage.ranking.RANKING_KEY, totals)
+    pipeline.set(storage.ranking.RANKING_CACHED_KEY, 1)
+
+
+async def cache_ranking_async(loop, redis):
+    """Async version of cache_ranking"""
+    async with storage.async_db_cursor(loop, dict_cursor=True) as (conn, curs):
+        await curs.execute(_SELECT_RANKING_TEAMTASKS_QUERY)
+        teamtasks = await curs.fetchall()
+
+    teams, totals = _build_ranking(teamtasks)
+
+    redis.delete(storage.ranking.RANKING_KEY, *[storage.ranking.team_key(team_id) for team_id in teams])
+    for team_id, data in teams.items():
+        redis.hmset_dict(storage.ranking.team_key(team_id), data)
+    for team_id, total in totals.items():
+        redis.zadd(storage.ranking.RANKING_KEY, total, team_id)
+    redis.set(storage.ranking.RANKING_CACHED_KEY, 1)
+
+
+def cache_first_bloods(pipeline):
+    """Put "firstbloods" table data from database to cache
+
+    Just adds commands to pipeline stack, don't forget to execute afterwards
+    """
+    with storage.db_cursor(dict_cursor=True) as (conn, curs):
+        curs.execute(_SELECT_ALL_FIRST_BLOODS_QUERY)
+        first_bloods = curs.fetchall()
+
+    first_bloods = list(models.FirstBlood.from_dict(first_blood) for first_blood in first_bloods)
+
+    pipeline.delete(storage.first_bloods.FIRST_BLOODS_KEY)
+    if first_bloods:
+        pipeline.hmset(
+            storage.first_bloods.FIRST_BLOODS_KEY,
+            {first_blood.task_id: first_blood.to_json() for first_blood in first_bloods},
+        )
+    pipeline.set(storage.first_bloods.FIRST_BLOODS_CACHED_KEY, 1)
+
+
+async def cache_first_bloods_async(loop, redis):
+    """Async version of cache_first_bloods"""
+    async with storage.async_db_cursor(loop, dict_cursor=True) as (conn, curs):
+        await curs.execute(_SELECT_ALL_FIRST_BLOODS_QUERY)
+        first_bloods = await curs.fetchall()
+
+    first_bloods = list(models.FirstBlood.from_dict(first_blood) for first_blood in first_bloods)
+
+    redis.delete(storage.first_bloods.FIRST_BLOODS_KEY)
+    if first_bloods:
+        redis.hmset_dict(
+            storage.first_bloods.FIRST_BLOODS_KEY,
+            {first_blood.task_id: first_blood.to_json() for first_blood in first_bloods},
+        )
+    redis.set(storage.first_bloods.FIRST_BLOODS_CACHED_KEY, 1)
@@ -0,0 +1,190 @@
+import datetime
+from typing import List
+
+import storage
+from helplib import models
+from helplib.cache import cache_helper, async_cache_helper, cached_read, async_cached_read
+from storage import caching
+
+# Hash task_id -> FirstBlood json, filled from first bloods
+# the database accepted, the database is the only claim
+FIRST_BLOODS_KEY = 'first_bloods'
+FIRST_BLOODS_CACHED_KEY = 'first_bloods:cached'
+
+_INSERT_FIRST_BLOOD_QUERY = """
+INSERT INTO FirstBloods (task_id, attacker_id, victim_id, flag_id, round, submit_time)
+VALUES (%s, %s, %s, %s, %s, %s)
+ON CONFLICT (task_id) DO NOTHING
+RETURNING task_id
+"""
+
+# Tasks known to have a first blood, it never changes during the game,
+# so after the first attack on a task its flags don't touch redis here
+_claimed_tasks = set()
+
+
+def _get_candidates(attacker_id: int, accepted: List[tuple], round: int) -> List[models.FirstBlood]:
+    """First accepted attack in the batch for each task without a known first blood"""
+    now = datetime.datetime.now(datetime.timezone.utc)
+    candidates = {}
+    for flag, _attacker_delta, _victim_delta in accepted:
+        if flag.task_id in _claimed_tasks or flag.task_id in candidates:
+            continue
+
+        candidates[flag.task_id] = models.FirstBlood(
+            task_id=flag.task_id,
+            attacker_id=attacker_id,
+            victim_id=flag.team_id,
+            flag_id=flag.id,
+            round=round,
+            submit_time=now,
+        )
+
+    return list(candidates.values())
+
+
+def _insert_params(first_blood: models.FirstBlood) -> tuple:
+    return (
+        first_blood.task_id,
+        first_blood.attacker_id,
+        first_blood.victim_id,
+        first_blood.flag_id,
+        first_blood.round,
+        first_blood.submit_time,
+    )
+
+
+def publish_first_blood(first_blood: models.FirstBlood):
+    storage.game_events.emit(event='first_blood', data=first_blood.to_json())
+
+
+def record_attacks(attacker_id: int, accepted: List[tuple], round: int) -> List[models.FirstBlood]:
+    """Record first bloods among accepted attacks and notify clients
+
+        The database insert with ON CONFLICT is the only claim of the task,
+        redis is filled from the inserted rows afterwards. If a process
+        died between the two steps, the first blood is missing in redis only:
+        a later attack on the task finds it in the database and drops
+        the redis cache, so it's refilled from the database.
+
+        :param attacker_id: id of the attacking team
+        :param accepted: list of (flag, attacker_delta, victim_delta)
+        :param round: round of the attacks
+        :return: list of recorded first bloods
+    """
+    candidates = _get_candidates(attacker_id, accepted, round)
+    if not candidates:
+        return []
+
+    recorded = []
+    with storage.db_cursor() as (conn, curs):
+        for first_blood in candidates:
+            curs.execute(_INSERT_FIRST_BLOOD_QUERY, _insert_params(first_blood))
+            if curs.fetchone() is not None:
+                recorded.append(first_blood)
+        conn.commit()
+
+    # tasks not recorded here already had a first blood in the database
+    recorded_tasks = {first_blood.task_id for first_blood in recorded}
+    known = [first_blood.task_id for first_blood in candidates if first_blood.task_id not in recorded_tasks]
+
+    with storage.get_redis_storage().pipeline(transaction=True) as pipeline:
+        cache_helper(
+            pipeline=pipeline,
+            cache_key=FIRST_BLOODS_CACHED_KEY,
+            cache_func=caching.cache_first_bloods,
+            cache_args=(pipeline,),
+        )
+
+        for first_blood in recorded:
+            pipeline.hsetnx(FIRST_BLOODS_KEY, first_blood.task_id, first_blood.to_json())
+        for task_id in known:
+            pipeline.hexists(FIRST_BLOODS_KEY, task_id)
+        present = pipeline.execute()[len(recorded):]
+
+    if not all(present):
+        storage.get_redis_storage().delete(FIRST_BLOODS_CACHED_KEY)
+
+    # redis is consistent with the database for these tasks now
+    _claimed_tasks.update(first_blood.task_id for first_blood in candidates)
+
+    for first_blood in recorded:
+        publish_first_blood(first_blood)
+
+    return recorded
+
+
+async def record_attacks_async(attacker_id: int,
+                               accepted: List[tuple],
+                               round: int,
+                               loop) -> List[models.FirstBlood]:
+    """Asynchronous version of record_attacks"""
+    candidates = _get_candidates(attacker_id, accepted, round)
+    if not candidates:
+        return []
+
+    recorded = []
+    async with storage.async_db_cursor(loop) as (conn, curs):
+        async with storage.async_db_transaction(curs):
+            for first_blood in candidates:
+                await curs.execute(_INSERT_FIRST_BLOOD_QUERY, _insert_params(first_blood))
+                if await curs.fetchone() is not None:
+                    recorded.append(first_blood)
+
+    recorded_tasks = {first_blood.task_id for first_blood in recorded}
+    known = [first_blood.task_id for first_blood in candidates if first_blood.task_id not in recorded_tasks]
+
+    redis_aio = await storage.get_async_redis_storage(loop)
+    await async_cache_helper(
+        redis_aio=redis_aio,
+        cache_key=FIRST_BLOODS_CACHED_KEY,
+        cache_func=caching.cache_first_bloods_async,
+        cache_args=(loop,),
+    )
+
+    tr = redis_aio.multi_exec()
+    for first_blood in recorded:
+        tr.hsetnx(FIRST_BLOODS_KEY, first_blood.task_id, first_blood.to_json())
+    for task_id in known:
+        tr.hexists(FIRST_BLOODS_KEY, task_id)
+    present = (await tr.execute())[len(recorded):]
+
+    if not all(present):
+        await redis_aio.delete(FIRST_BLOODS_CACHED_KEY)
+
+    _claimed_tasks.update(first_blood.task_id for first_blood in candidates)
+
+    for first_blood in recorded:
+        await loop.run_in_executor(None, publish_first_blood, first_blood)
+
+    return recorded
+
+
+def get_first_bloods() -> List[models.FirstBlood]:
+    """Get first blood of each task that was already attacked"""
+    with storage.get_redis_storage().pipeline(transaction=True) as pipeline:
+        first_bloods, = cached_read(
+            pipeline=pipeline,
+            cache_key=FIRST_BLOODS_CACHED_KEY,
+            cache_func=caching.cache_first_bloods,
+            cache_args=(pipeline,),
+            read=lambda p: p.hgetall(FIRST_BLOODS_KEY),
+        )
+
+    first_bloods = [models.FirstBlood.from_json(first_blood) for first_blood in first_bloods.values()]
+    return sorted(first_bloods, key=lambda first_blood: first_blood.task_id)
+
+
+async def get_first_bloods_async(loop) -> List[models.FirstBlood]:
+    """Asynchronous version of get_first_bloods"""
+    redis_aio = await storage.get_async_redis_storage(loop)
+
+    first_bloods, = await async_cached_read(
+        redis_aio=redis_aio,
+        cache_key=FIRST_BLOODS_CACHED_KEY,
+        cache_func=caching.cache_first_bloods_async,
+        cache_args=(loop,),
+        read=lambda tr: tr.hgetall(FIRST_BLOODS_KEY, encoding='utf-8'),
+    )
+    first_bloods = [models.FirstBlood.from_json(first_blood) for first_blood in first_bloods.values()]
+    return sorted(first_bloods, key=lambda first_blood: first_blood.task_id)
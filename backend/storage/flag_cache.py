@@ -0,0 +1,309 @@
+import logging
+import threading
+from collections import OrderedDict, Counter
+from typing import NamedTuple, Optional, List
+
+from kombu.utils import json
+
+import storage
+from helplib import exceptions
+from helplib.bloom import BloomFilter
+
+# Maximum number of flags stored in process memory
+MAX_SIZE = 200000
+
+# Flags older than flag_lifetime are kept for this number of rounds
+# to reject them as too old without asking redis
+KEEP_EXPIRED_ROUNDS = 2
+
+# Bloom filter is sized for this many times the number of flags
+# present on rebuild, as new flags are added to it during the round
+BLOOM_CAPACITY_FACTOR = 2
+BLOOM_ERROR_RATE = 0.001
+
+# Maximum number of rejected flags remembered for a single attacker
+MAX_REJECTED_PER_ATTACKER = 10000
+
+REJECTION_STATS_KEY = 'flag_submitter:rejections'
+
+# How often local rejection counters are added to the shared redis hash, in seconds
+REPORT_INTERVAL = 5
+
+logger = logging.getLogger(__name__)
+
+_local_flag_cache = None
+
+
+class FlagRecord(NamedTuple):
+    """Compact flag representation, has all fields required to process an attack"""
+    id: int
+    team_id: int
+    task_id: int
+    round: int
+
+    @classmethod
+    def from_flag(cls, flag) -> 'FlagRecord':
+        return cls(id=flag.id, team_id=flag.team_id, task_id=flag.task_id, round=flag.round)
+
+
+class _StatsReporter(threading.Thread):
+    """Flushes rejection counters of the cache every REPORT_INTERVAL seconds,
+    so submitter event loops never wait for redis to report them"""
+
+    def __init__(self, cache: 'LocalFlagCache'):
+        super(_StatsReporter, self).__init__(daemon=True)
+        self.cache = cache
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(REPORT_INTERVAL):
+            try:
+                self.cache.flush_stats()
+            except Exception as e:
+                logger.warning(f'Failed to report flag rejection stats: {e}')
+
+    def stop(self):
+        self.stopped.set()
+
+
+class LocalFlagCache:
+    """Process-local map from flag string to FlagRecord
+
+        Flags are immutable, so the only invalidation required is dropping
+        old rounds. The cache is rebuilt from the database when the round changes
+        and receives newly generated flags, both through redis pub/sub
+        in a background thread.
+    """
+
+    def __init__(self, max_size: int = MAX_SIZE):
+        self.max_size = max_size
+        self.round = -1
+        self.flag_lifetime = None
+        self._flags = OrderedDict()
+        self._bloom = None
+        self._rejected = {}
+        self._pubsub = None
+        self._thread = None
+        self._reporter = None
+        self._lock = threading.RLock()
+        self._pending_messages = None
+        self.stats = Counter()
+
+    def __len__(self):
+        return len(self._flags)
+
+    def add(self, flag_str: str, record: FlagRecord):
+        flags = self._flags
+        flags[flag_str] = record
+        while len(flags) > self.max_size:
+            flags.popitem(last=False)
+
+    @property
+    def bloom_trusted(self) -> bool:
+        """Negative Bloom filter answers are only trusted while the
+        subscription delivering new flags is alive"""
+        return (
+                self._bloom is not None
+                and not self._bloom.overfilled
+                and self._thread is not None
+                and self._thread.is_alive()
+        )
+
+    def precheck(self,
+                 attacker: int,
+                 flag_strs: List[str],
+                 round: int) -> List[Optional[exceptions.FlagSubmitException]]:
+        """Reject flags that are definitely invalid, too old or attacker's own
+        without touching redis or the database
+
+            :return: list with FlagSubmitException for rejected flags and None for
+                     flags that need to be checked as usual
+        """
+        rejected = self._rejected.get(attacker, {})
+        bloom = self._bloom if self.bloom_trusted else None
+        flag_lifetime = self.flag_lifetime
+
+        results = []
+        for flag_str in flag_strs:
+            reason = rejected.get(flag_str)
+            record = self._flags.get(flag_str)
+            if reason is not None:
+                self.stats['recently_rejected'] += 1
+                results.append(exceptions.FlagSubmitException(reason))
+            elif record is not None:
+                if flag_lifetime is not None and round - record.round > flag_lifetime:
+                    self.stats['too_old_rejected'] += 1
+                    results.append(exceptions.FlagSubmitException('Flag is too old'))
+                elif record.team_id == attacker:
+                    self.stats['own_rejected'] += 1
+                    results.append(exceptions.FlagSubmitException('Flag is your own'))
+                else:
+                    results.append(None)
+            elif bloom is not None and flag_str not in bloom:
+                self.stats['bloom_rejected'] += 1
+                results.append(exceptions.FlagSubmitException('Flag is invalid or too old'))
+            else:
+                results.append(None)
+
+        return results
+
+    def remember_rejected(self, attacker: int, flag_str: str, reason: str):
+        """Remember rejected flag of the attacker, all rejection reasons are permanent"""
+        self.stats['checked_rejected'] += 1
+        rejected = self._rejected.setdefault(attacker, OrderedDict())
+        rejected[flag_str] = reason
+        while len(rejected) > MAX_REJECTED_PER_ATTACKER:
+            rejected.popitem(last=False)
+
+    def flush_stats(self):
+        """Add local rejection counters to the shared redis hash and reset them"""
+        stats, self.stats = self.stats, Counter()
+        if not stats:
+            return
+
+        with storage.get_redis_storage().pipeline(transaction=False) as pipeline:
+            for reason, count in stats.items():
+                pipeline.hincrby(REJECTION_STATS_KEY, reason, count)
+            pipeline.execute()
+
+    def warm(self, round: int):
+        """Rebuild the cache with flags from the last "flag_lifetime" rounds"""
+        game_config = storage.game.get_current_global_config()
+        since_round = round - game_config.flag_lifetime - KEEP_EXPIRED_ROUNDS
+        flags = storage.caching.get_last_flags_from_db(since_round)
+
+        new_flags = OrderedDict()
+        for flag in flags[-self.max_size:]:
+            new_flags[flag.flag] = FlagRecord.from_flag(flag)
+
+        bloom = BloomFilter(
+            capacity=max(len(flags), 1000) * BLOOM_CAPACITY_FACTOR,
+            error_rate=BLOOM_ERROR_RATE,
+        )
+        for flag in flags:
+            bloom.add(flag.flag)
+
+        # swaps are atomic, readers in other threads see either the old or the new objects
+        self._flags = new_flags
+        self._bloom = bloom
+        self._rejected = {}
+        self.flag_lifetime = game_config.flag_lifetime
+        self.round = round
+
+    def _defer_until_warm(self, handler, message) -> bool:
+        """Keep a message received during the first warm, it's handled after the warm,
+        so the flags published meanwhile get into the new map and Bloom filter"""
+        with self._lock:
+            if self._pending_messages is None:
+                return False
+            self._pending_messages.append((handler, message))
+            return True
+
+    def _handle_round_update(self, message):
+        if self._defer_until_warm(self._handle_round_update, message):
+            return
+
+        try:
+            round = int(message['data'])
+        except (ValueError, TypeError):
+            return
+
+        if round > self.round:
+            self.warm(round)
+
+    def _handle_new_flag(self, message):
+        if self._defer_until_warm(self._handle_new_flag, message):
+            return
+
+        data = json.loads(message['data'])
+        if self._bloom is not None:
+            self._bloom.add(data['flag'])
+        self.add(data['flag'], FlagRecord(
+            id=data['id'],
+            team_id=data['team_id'],
+            task_id=data['task_id'],
+            round=data['round'],
+        ))
+
+    def start(self):
+        """Subscribe to round and flag updates, then warm the cache.
+        Subscription goes first so no flag generated during warming is missed,
+        messages received before the warm finishes are handled after it"""
+        if self._thread is not None:
+            return
+
+        self._pending_messages = []
+        self._pubsub = storage.get_redis_storage().pubsub(ignore_subscribe_messages=True)
+        self._pubsub.subscribe(**{
+            storage.game.ROUND_UPDATES_CHANNEL: self._handle_round_update,
+            storage.flags.NEW_FLAGS_CHANNEL: self._handle_new_flag,
+        })
+        self._thread = self._pubsub.run_in_thread(sleep_time=1, daemon=True)
+        self._reporter = _StatsReporter(self)
+        self._reporter.start()
+
+        try:
+            self.warm(storage.game.get_real_round())
+        finally:
+            # the subscription thread waits on the lock until deferred messages are handled
+            with self._lock:
+                pending, self._pending_messages = self._pending_messages, None
+                for handler, message in pending:
+                    handler(message)
+
+    def stop(self):
+        if self._thread is not None:
+            self._thread.stop()
+            self._thread = None
+        if self._reporter is not None:
+            self._reporter.stop()
+            self._reporter = None
+
+
+def enable(max_size: int = MAX_SIZE) -> LocalFlagCache:
+    """Enable process-local flag cache for flag lookups, meant to be called on submitter start"""
+    global _local_flag_cache
+
+    if _local_flag_cache is None:
+        _local_flag_cache = LocalFlagCache(max_size=max_size)
+        _local_flag_cache.start()
+
+    return _local_flag_cache
+
+
+def get_local_flag_cache() -> Optional[LocalFlagCache]:
+    """Get local flag cache if it's enabled in this process"""
+    return _local_flag_cache
+
+
+def precheck(attacker: int, flag_strs: List[str], round: int) -> List[Optional[exceptions.FlagSubmitException]]:
+    """Reject definitely invalid, too old and own flags locally,
+    returns None for each flag if the cache is disabled"""
+    if _local_flag_cache is None:
+        return [None] * len(flag_strs)
+
+    return _local_flag_cache.precheck(attacker, flag_strs, round)
+
+
+def remember_rejected(attacker: int, flag_strs: List[str], errors: List[Optional[Exception]]):
+    """Remember flags rejected by the full check (if the cache is enabled)"""
+    if _local_flag_cache is None:
+        return
+
+    for flag_str, error in zip(flag_strs, errors):
+        if error is not None:
+            _local_flag_cache.remember_rejected(attacker, flag_str, str(error))
+
+
+def get_rejection_stats() -> dict:
+    """Get rejection counters summed over all submitter processes,
+    counters of each process are at most REPORT_INTERVAL seconds behind"""
+    stats = storage.get_redis_storage().hgetall(REJECTION_STATS_KEY)
+    return {reason: int(count) for reason, count in stats.items()}
+
+
+async def get_rejection_stats_async(loop) -> dict:
+    """Asynchronous version of get_rejection_stats"""
+    redis_aio = await storage.get_async_redis_storage(loop)
+    stats = await redis_aio.hgetall(REJECTION_STATS_KEY, encoding='utf-8')
+    return {reason: int(count) for reason, count in stats.items()}
@@ -1,53 +1,227 @@
 import secrets
 
-from typing import Optional
+from typing import Optional, List, Tuple
 
 import helplib
 import storage
-from helplib.cache import cache_helper
+from helplib.cache import cache_helper, async_cache_helper, cached_read
+from helplib.scripts import AsyncScript
 from storage import caching
 
+NEW_FLAGS_CHANNEL = 'flags:new'
+
 _INSERT_FLAG_QUERY = """
 INSERT INTO flags (flag, team_id, task_id, round, flag_data, vuln_number) 
 VALUES (%s, %s, %s, %s, %s, %s) RETURNING id
 """
 
 
-def try_add_stolen_flag(flag: helplib.models.Flag, attacker: int, round: int):
-    """Check that flag is valid for current round, add it to cache, then add to db
+# Verdicts returned by _ACCEPT_FLAGS_SCRIPT for each flag
+FLAG_ACCEPTED = 0
+FLAG_INVALID = 1
+FLAG_TOO_OLD = 2
+FLAG_OWN = 3
+FLAG_ALREADY_STOLEN = 4
+
+# Returned instead of verdicts if flags or attacker's stolen flags are not cached
+CACHE_FILL_NEEDED = -1
+
+_VERDICT_MESSAGES = {
+    FLAG_INVALID: 'Flag is invalid or too old',
+    FLAG_TOO_OLD: 'Flag is too old',
+    FLAG_OWN: 'Flag is your own',
+    FLAG_ALREADY_STOLEN: 'Flag already stolen',
+}
+
+# Stolen and lost flag counters of each team and task, fields are
+# "team:{team_id}:task:{task_id}:stolen" and "team:{team_id}:task:{task_id}:lost"
+FLAG_COUNTERS_KEY = 'flags:counters'
+
+# Looks each flag up by its key, checks its age and owner, adds it
+# to the attacker's stolen flags and increments stolen/lost counters,
+# all in a single atomic call. Returns flat list of (verdict, flag json) pairs.
+# In write-behind mode accepted flags are also appended to the attacks stream,
+# so no accepted flag can miss the database. Every key is passed in KEYS:
+# flags cached flag, stolen flags cached flag, stolen flags, attacks stream,
+# counters hash, then "flag:str:{flag}" key of each flag.
+# Effects replication is required for XADD with generated id before other writes.
+_ACCEPT_FLAGS_SCRIPT = """
+redis.replicate_commands()
+
+if redis.call('EXISTS', KEYS[1]) == 0 or redis.call('EXISTS', KEYS[2]) == 0 then
+    return -1
+end
+
+local attacker = tonumber(ARGV[1])
+local round = tonumber(ARGV[2])
+local lifetime = tonumber(ARGV[3])
+
+local result = {}
+local accepted = {}
+for i = 6, #KEYS do
+    local verdict = 1
+    local flag_json = redis.call('GET', KEYS[i])
+    if flag_json then
+        local flag = cjson.decode(flag_json)
+        if round - flag['round'] > lifetime then
+            verdict = 2
+        elseif flag['team_id'] == attacker then
+            verdict = 3
+        elseif redis.call('SADD', KEYS[3], flag['id']) == 0 then
+            verdict = 4
+        else
+            redis.call('HINCRBY', KEYS[5], 'team:' .. attacker .. ':task:' .. flag['task_id'] .. ':stolen', 1)
+            redis.call('HINCRBY', KEYS[5], 'team:' .. flag['team_id'] .. ':task:' .. flag['task_id'] .. ':lost', 1)
+            accepted[#accepted + 1] = {flag['id'], flag['team_id'], flag['task_id'], flag['round']}
+            verdict = 0
+        end
+    end
+    result[#result + 1] = verdict
+    result[#result + 1] = flag_json
+end
+
+if ARGV[4] == '1' and #accepted > 0 then
+    redis.call('XADD', KEYS[4], '*', 'attacker_id', attacker, 'round', round, 'flags', cjson.encode(accepted))
+end
+return result
+"""
 
-        :param flag: Flag model instance
+_accept_flags_script_async = AsyncScript(_ACCEPT_FLAGS_SCRIPT)
+
+_accept_flags_script = None
+
+
+def _get_accept_script():
+    global _accept_flags_script
+
+    if _accept_flags_script is None:
+        _accept_flags_script = storage.get_redis_storage().register_script(_ACCEPT_FLAGS_SCRIPT)
+
+    return _accept_flags_script
+
+
+def _accept_script_params(flag_strs: List[str],
+                          attacker: int,
+                          round: int,
+                          flag_lifetime: int,
+                          write_behind: bool) -> Tuple[list, list]:
+    keys = [
+        'flags:cached',
+        f'team:{attacker}:stolen_flags:cached',
+        f'team:{attacker}:stolen_flags',
+        storage.write_behind.ATTACKS_STREAM,
+        FLAG_COUNTERS_KEY,
+        *[f'flag:str:{flag_str}' for flag_str in flag_strs],
+    ]
+    args = [attacker, round, flag_lifetime, int(write_behind)]
+    return keys, args
+
+
+def _parse_verdicts(result: list) -> List[tuple]:
+    """Convert flat script result to list of (flag, error) pairs,
+    flag is None if it wasn't found, error is None if it was accepted"""
+    checked = []
+    for verdict, flag_json in zip(result[::2], result[1::2]):
+        flag = helplib.models.Flag.from_json(flag_json) if flag_json is not None else None
+        error = None
+        if verdict != FLAG_ACCEPTED:
+            error = helplib.exceptions.FlagSubmitException(_VERDICT_MESSAGES[verdict])
+        checked.append((flag, error))
+
+    return checked
+
+
+def accept_flags_by_str_batch(flag_strs: List[str],
+                              attacker: int,
+                              round: int,
+                              write_behind: bool = False) -> List[tuple]:
+    """Check flags and add valid ones to attacker's stolen flags with a single redis call
+
+        The cache is filled and the call is repeated only if flags
+        or stolen flags of the attacker are not cached yet.
+
+        :param flag_strs: flag values
         :param attacker: attacker team id
         :param round: current round
+        :param write_behind: append accepted flags to the attacks stream (see storage.write_behind)
 
-        :raises: an instance of FlagSubmitException on validation error
+        :return: list of (flag, error) pairs in the order of "flag_strs", flag is
+                 Flag model instance or None if not found, error is None for accepted flags
+                 and FlagSubmitException instance for rejected ones
     """
+    if not flag_strs:
+        return []
+
     game_config = storage.game.get_current_global_config()
-    if round - flag.round > game_config.flag_lifetime:
-        raise helplib.exceptions.FlagSubmitException('Flag is too old')
-    if flag.team_id == attacker:
-        raise helplib.exceptions.FlagSubmitException('Flag is your own')
+    keys, args = _accept_script_params(flag_strs, attacker, round, game_config.flag_lifetime, write_behind)
 
-    with storage.get_redis_storage().pipeline(transaction=True) as pipeline:
-        # optimization of redis request count
-        cached_stolen = pipeline.exists(f'team:{attacker}:stolen_flags:cached').execute()
+    script = _get_accept_script()
+    result = script(keys=keys, args=args)
 
-        if not cached_stolen:
+    while result == CACHE_FILL_NEEDED:
+        with storage.get_redis_storage().pipeline(transaction=True) as pipeline:
+            cache_helper(
+                pipeline=pipeline,
+                cache_key='flags:cached',
+                cache_func=caching.cache_last_flags,
+                cache_args=(round, pipeline),
+            )
             cache_helper(
                 pipeline=pipeline,
                 cache_key=f'team:{attacker}:stolen_flags:cached',
                 cache_func=caching.cache_last_stolen,
                 cache_args=(attacker, round, pipeline),
             )
+        result = script(keys=keys, args=args)
 
-        is_new, = pipeline.sadd(f'team:{attacker}:stolen_flags', flag.id).execute()
+    return _parse_verdicts(result)
 
-        if not is_new:
-            raise helplib.exceptions.FlagSubmitException('Flag already stolen')
 
-        pipeline.incr(f'team:{attacker}:task:{flag.task_id}:stolen')
-        pipeline.incr(f'team:{flag.team_id}:task:{flag.task_id}:lost')
-        pipeline.execute()
+async def accept_flags_by_str_batch_async(flag_strs: List[str],
+                                          attacker: int,
+                                          round: int,
+                                          loop,
+                                          write_behind: bool = False) -> List[tuple]:
+    """Asynchronous version of accept_flags_by_str_batch"""
+    if not flag_strs:
+        return []
+
+    game_config = await storage.game.get_current_global_config_async(loop)
+    keys, args = _accept_script_params(flag_strs, attacker, round, game_config.flag_lifetime, write_behind)
+
+    redis_aio = await storage.get_async_redis_storage(loop)
+    result = await _accept_flags_script_async(redis_aio, keys, args)
+
+    while result == CACHE_FILL_NEEDED:
+        await async_cache_helper(
+            redis_aio=redis_aio,
+            cache_key='flags:cached',
+            cache_func=caching.cache_last_flags_async,
+            cache_args=(round, loop),
+        )
+        await async_cache_helper(
+            redis_aio=redis_aio,
+            cache_key=f'team:{attacker}:stolen_flags:cached',
+            cache_func=caching.cache_last_stolen_async,
+            cache_args=(attacker, round, loop),
+        )
+        result = await _accept_flags_script_async(redis_aio, keys, args)
+
+    return _parse_verdicts(result)
+
+
+def try_add_stolen_flag(flag: helplib.models.Flag, attacker: int, round: int):
+    """Check that flag is valid for current round, add it to cache, then add to db
+
+        :param flag: Flag model instance
+        :param attacker: attacker team id
+        :param round: current round
+
+        :raises: an instance of FlagSubmitException on validation error
+    """
+    (_flag, error), = accept_flags_by_str_batch(flag_strs=[flag.flag], attacker=attacker, round=round)
+    if error is not None:
+        raise error
 
 
 def add_flag(flag: helplib.models.Flag) -> helplib.models.Flag:
@@ -82,6 +256,7 @@ def add_flag(flag: helplib.models.Flag) -> helplib.models.Flag:
 
         pipeline.set(f'flag:id:{flag.id}', flag.to_json(), ex=expires)
         pipeline.set(f'flag:str:{flag.flag}', flag.to_json(), ex=expires)
+        pipeline.publish(NEW_FLAGS_CHANNEL, flag.to_json())
         pipeline.execute()
 
     return flag
@@ -97,18 +272,16 @@ def get_flag_by_field(field_name: str, field_value, round: int) -> helplib.model
         :raises: FlagSubmitException if nothing found
     """
     with storage.get_redis_storage().pipeline(transaction=True) as pipeline:
-        cached, = pipeline.exists('flags:cached').execute()
-        if not cached:
-            cache_helper(
-                pipeline=pipeline,
-                cache_key='flags:cached',
-                cache_func=caching.cache_last_flags,
-                cache_args=(round, pipeline),
-            )
-
-        pipeline.exists(f'flag:{field_name}:{field_value}')
-        pipeline.get(f'flag:{field_name}:{field_value}')
-        flag_exists, flag_json = pipeline.execute()
+        flag_exists, flag_json = cached_read(
+            pipeline=pipeline,
+            cache_key='flags:cached',
+            cache_func=caching.cache_last_flags,
+            cache_args=(round, pipeline),
+            read=lambda p: (
+                p.exists(f'flag:{field_name}:{field_value}'),
+                p.get(f'flag:{field_name}:{field_value}'),
+            ),
+        )
 
     if not flag_exists:
         raise helplib.exceptions.FlagSubmitException('Flag is invalid or too old')
@@ -149,14 +322,13 @@ def get_random_round_flag(team_id: int, task_id: int, round: int, current_round:
     """
 
     with storage.get_redis_storage().pipeline(transaction=True) as pipeline:
-        cache_helper(
+        flags, = cached_read(
             pipeline=pipeline,
             cache_key='flags:cached',
             cache_func=caching.cache_last_flags,
             cache_args=(current_round, pipeline),
+            read=lambda p: p.smembers(f'team:{team_id}:task:{task_id}:round_flags:{round}'),
         )
-
-        flags, = pipeline.smembers(f'team:{team_id}:task:{task_id}:round_flags:{round}').execute()
         try:
             flag_id = int(secrets.choice(list(flags)))
         except (ValueError, IndexError, TypeError):
@@ -1,14 +1,80 @@
+import gzip
 import time
-from typing import Optional
+from typing import Optional, NamedTuple, List
+
+from kombu.utils import json
 
 import storage
 from helplib import models
-from helplib.cache import cache_helper
+from helplib.cache import cached_read, async_cached_read
+
+ROUND_UPDATES_CHANNEL = 'round_updates'
+
+# Distributed lock held by the round processor updating the round
+ROUND_UPDATE_LOCK = 'round_update:lock'
+
+SCOREBOARD_KEY = 'scoreboard'
+SCOREBOARD_VERSION_KEY = 'scoreboard:version'
+
+# Socket.io rooms in "/game_events" namespace, clients get full game state
+# updates by default and switch to deltas with "subscribe_deltas" event
+SCOREBOARD_FULL_ROOM = 'scoreboard_full'
+SCOREBOARD_DELTA_ROOM = 'scoreboard_delta'
+
+# Stores game state and the scoreboard snapshot with the next version atomically.
+# If the expected version (ARGV[1]) is set and differs from the stored one,
+# nothing is stored and -1 is returned, so a delta is only published with
+# the version of the state it was computed against
+_PUBLISH_SCOREBOARD_SCRIPT = """
+local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+if ARGV[1] ~= '' and tonumber(ARGV[1]) ~= current then
+    return -1
+end
+
+local version = current + 1
+redis.call('SET', KEYS[1], version)
+if ARGV[2] ~= '' then
+    redis.call('SET', KEYS[3], ARGV[2])
+end
+redis.call('HSET', KEYS[2], 'version', version, 'data', ARGV[3], 'gzip', ARGV[4],
+           'columnar', ARGV[5], 'columnar_gzip', ARGV[6])
+return version
+"""
+
+# Marks (team, task) chain of the round as finished and decrements
+# the number of pending chains, each chain is counted once even if
+# its error callback is called for several failed actions.
+# Returns 1 for the call that finished the last chain.
+_MARK_TEAMTASK_DONE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+if redis.call('SADD', KEYS[2], ARGV[1]) == 0 then
+    return 0
+end
+if redis.call('DECR', KEYS[1]) == 0 then
+    return 1
+end
+return 0
+"""
+
+_publish_scoreboard_script = None
+
+_mark_teamtask_done_script = None
 
 _CURRENT_REAL_ROUND_QUERY = 'SELECT real_round FROM globalconfig WHERE id=1'
 
 _UPDATE_REAL_ROUND_QUERY = 'UPDATE globalconfig SET real_round = %s WHERE id=1'
 
+# Stores the fencing token unless a greater one was already stored,
+# the row stays locked until commit, so writers are serialized
+_CHECK_FENCING_TOKEN_QUERY = '''
+INSERT INTO LockFences (name, token) VALUES (%s, %s)
+ON CONFLICT (name) DO UPDATE SET token = EXCLUDED.token
+WHERE LockFences.token <= EXCLUDED.token
+RETURNING token
+'''
+
 _SET_GAME_RUNNING_QUERY = 'UPDATE globalconfig SET game_running = %s WHERE id=1'
 
 _GET_GAME_RUNNING_QUERY = 'SELECT game_running FROM globalconfig WHERE id=1'
@@ -58,13 +124,26 @@ def get_real_round_from_db() -> int:
     return round
 
 
-def update_real_round_in_db(new_round: int):
-    """Update real round stored in DB"""
+def update_real_round_in_db(new_round: int, fencing_token: Optional[int] = None) -> bool:
+    """Update real round stored in DB
+
+        :param fencing_token: token of ROUND_UPDATE_LOCK holder, update is rejected
+        if a holder with a greater token has already updated the round
+        :return: False if the update was rejected
+    """
 
     with storage.db_cursor() as (conn, curs):
+        if fencing_token is not None:
+            curs.execute(_CHECK_FENCING_TOKEN_QUERY, (ROUND_UPDATE_LOCK, fencing_token))
+            if curs.fetchone() is None:
+                conn.rollback()
+                return False
+
         curs.execute(_UPDATE_REAL_ROUND_QUERY, (new_round,))
         conn.commit()
 
+    return True
+
 
 def set_game_running(new_value: bool):
     """Update game_running value in db"""
@@ -91,22 +170,116 @@ def get_db_global_config() -> models.GlobalConfig:
     return models.GlobalConfig.from_dict(result)
 
 
+async def get_db_global_config_async(loop) -> models.GlobalConfig:
+    """Get global config from database as it is (asynchronous version)"""
+    async with storage.async_db_cursor(loop, dict_cursor=True) as (conn, curs):
+        await curs.execute(_GET_GLOBAL_CONFIG_QUERY)
+        result = await curs.fetchone()
+
+    return models.GlobalConfig.from_dict(result)
+
+
 def get_current_global_config() -> models.GlobalConfig:
+    """Get global config, served from the process-local cache"""
+    return storage.local_cache.get('global_config', _fetch_current_global_config)
+
+
+async def get_current_global_config_async(loop) -> models.GlobalConfig:
+    """Asynchronous version of get_current_global_config"""
+    return await storage.local_cache.get_async('global_config', lambda: _fetch_current_global_config_async(loop))
+
+
+def _fetch_current_global_config() -> models.GlobalConfig:
     """Get global config from cache is cached, otherwise cache it"""
     with storage.get_redis_storage().pipeline(transaction=True) as pipeline:
-        cache_helper(
+        result, = cached_read(
             pipeline=pipeline,
             cache_key='global_config:cached',
             cache_func=storage.caching.cache_global_config,
             cache_args=(pipeline,),
+            read=lambda p: p.get('global_config'),
         )
-
-        result, = pipeline.get('global_config').execute()
         global_config = models.GlobalConfig.from_json(result)
 
     return global_config
 
 
+async def _fetch_current_global_config_async(loop) -> models.GlobalConfig:
+    """Get global config from cache is cached, otherwise cache it (asynchronous version)"""
+    redis_aio = await storage.get_async_redis_storage(loop)
+
+    result, = await async_cached_read(
+        redis_aio=redis_aio,
+        cache_key='global_config:cached',
+        cache_func=storage.caching.cache_global_config_async,
+        cache_args=(loop,),
+        read=lambda tr: tr.get('global_config'),
+    )
+    global_config = models.GlobalConfig.from_json(result)
+
+    return global_config
+
+
+async def get_real_round_async(loop) -> int:
+    """Get real round of system (asynchronous version), returns -1 if round not in cache"""
+    redis_aio = await storage.get_async_redis_storage(loop)
+    round = await redis_aio.get('real_round')
+
+    try:
+        round = int(round)
+    except (ValueError, TypeError):
+        return -1
+    return round
+
+
+def _get_mark_teamtask_done_script():
+    global _mark_teamtask_done_script
+
+    if _mark_teamtask_done_script is None:
+        _mark_teamtask_done_script = storage.get_redis_storage().register_script(_MARK_TEAMTASK_DONE_SCRIPT)
+
+    return _mark_teamtask_done_script
+
+
+def start_round_tracking(round: int, chains: int):
+    """Start counting finished checker chains of the round
+
+        :param round: round the chains are run for
+        :param chains: number of (team, task) chains to wait for
+    """
+    game_config = get_current_global_config()
+    expires = game_config.round_time * 5
+
+    with storage.get_redis_storage().pipeline(transaction=True) as pipeline:
+        pipeline.delete(f'round:{round}:done')
+        pipeline.set(f'round:{round}:pending', chains, ex=expires)
+        pipeline.execute()
+
+
+def mark_teamtask_done(round: int, team_id: int, task_id: int) -> bool:
+    """Mark checker chain for (team, task) in the round finished
+
+        :return: True if it was the last pending chain of the round
+    """
+    with storage.get_redis_storage().pipeline(transaction=True) as pipeline:
+        mark = _get_mark_teamtask_done_script()
+        mark(keys=[f'round:{round}:pending', f'round:{round}:done'], args=[f'{team_id}:{task_id}'], client=pipeline)
+        pipeline.expire(f'round:{round}:done', get_current_global_config().round_time * 5)
+        finished, _ = pipeline.execute()
+
+    return finished == 1
+
+
+def claim_round_publish(round: int) -> bool:
+    """Claim the right to publish game state of the round,
+    so it's published once, either by the completion barrier or by a fallback
+
+        :return: True if the caller should publish the game state
+    """
+    game_config = get_current_global_config()
+    return bool(storage.get_redis_storage().set(f'round:{round}:published', 1, nx=True, ex=game_config.round_time * 5))
+
+
 def construct_game_state_from_db(round: int) -> Optional[models.GameState]:
     """Get game state for specified round with teamtasks from db"""
     teamtasks = storage.tasks.get_teamtasks_from_db()
@@ -127,6 +300,175 @@ def construct_latest_game_state(round: int) -> Optional[models.GameState]:
     return state
 
 
+class ScoreboardSnapshot(NamedTuple):
+    """Pre-serialized "init_scoreboard" payload, in the default and in the columnar format"""
+    version: int
+    data: str
+    gzip: bytes
+    columnar: str
+    columnar_gzip: bytes
+
+
+def construct_scoreboard_data(game_state: Optional[models.GameState], columnar: bool = False) -> str:
+    """Serialize game state, teams, tasks and config as sent to the scoreboard on connect
+
+        :param game_state: current game state
+        :param columnar: encode game state with GameState.to_columnar_dict
+    """
+    teams = storage.teams.get_teams()
+    tasks = storage.tasks.get_tasks()
+    game_config = get_current_global_config()
+
+    state = ''
+    if game_state:
+        state = game_state.to_columnar_dict() if columnar else game_state.to_dict()
+
+    data = {
+        'state': state,
+        'teams': [team.to_dict_for_participants() for team in teams],
+        'tasks': [task.to_dict_for_participants() for task in tasks],
+        'config': game_config.to_dict(),
+    }
+    return json.dumps(data)
+
+
+def _get_publish_scoreboard_script():
+    global _publish_scoreboard_script
+
+    if _publish_scoreboard_script is None:
+        _publish_scoreboard_script = storage.get_redis_storage().register_script(_PUBLISH_SCOREBOARD_SCRIPT)
+
+    return _publish_scoreboard_script
+
+
+def _store_scoreboard(game_state: Optional[models.GameState],
+                      base_version: Optional[int] = None) -> Optional[int]:
+    """Store game state with pre-serialized and pre-gzipped scoreboard snapshot under a new version
+
+        :param game_state: game state to store
+        :param base_version: only store if it's the current version
+        :return: version of the stored snapshot, None if the current version is not "base_version"
+    """
+    data = construct_scoreboard_data(game_state)
+    columnar = construct_scoreboard_data(game_state, columnar=True)
+
+    publish = _get_publish_scoreboard_script()
+    version = publish(
+        keys=[SCOREBOARD_VERSION_KEY, SCOREBOARD_KEY, 'game_state'],
+        args=[
+            base_version if base_version is not None else '',
+            game_state.to_json() if game_state is not None else '',
+            data,
+            gzip.compress(data.encode(), compresslevel=6),
+            columnar,
+            gzip.compress(columnar.encode(), compresslevel=6),
+        ],
+    )
+    if version == -1:
+        return None
+    return version
+
+
+def publish_scoreboard_snapshot(game_state: Optional[models.GameState]) -> int:
+    """Store game state and its scoreboard snapshot with a new version
+
+        :return: version of the stored snapshot
+    """
+    return _store_scoreboard(game_state)
+
+
+def publish_game_state(round: int, only_changed: bool = False) -> models.GameState:
+    """Construct game state for the round from the latest teamtasks,
+    store it with a scoreboard snapshot and notify clients with full and delta updates
+
+        The delta is computed against the stored state and published with its version
+        as "prev_version". If another publisher stored a state meanwhile,
+        the delta is computed again against the new one.
+
+        :param round: round of the game state
+        :param only_changed: skip the snapshot and notifications if teamtasks
+                             and round are the same as in the published state
+    """
+    game_state = construct_latest_game_state(round=round)
+
+    while True:
+        with storage.get_redis_storage().pipeline(transaction=True) as pipeline:
+            base_version, old_state = pipeline.get(SCOREBOARD_VERSION_KEY).get('game_state').execute()
+
+        base_version = int(base_version or 0)
+        if old_state is not None:
+            old_state = models.GameState.from_json(old_state)
+        teamtasks_delta = get_teamtasks_delta(old_state, game_state)
+
+        if only_changed and old_state is not None and old_state.round == game_state.round and not teamtasks_delta:
+            return game_state
+
+        version = _store_scoreboard(game_state, base_version=base_version)
+        if version is not None:
+            break
+
+    storage.ranking.reseed()
+
+    storage.game_events.emit(
+        event='update_scoreboard',
+        data=game_state.to_json(),
+        room=SCOREBOARD_FULL_ROOM,
+    )
+
+    delta = {
+        'version': version,
+        'prev_version': base_version,
+        'round': game_state.round,
+        'round_start': game_state.round_start,
+        'team_tasks': teamtasks_delta,
+    }
+    storage.game_events.emit(
+        event='update_scoreboard_delta',
+        data=json.dumps(delta),
+        room=SCOREBOARD_DELTA_ROOM,
+    )
+
+    return game_state
+
+
+def get_teamtasks_delta(old_state: Optional[models.GameState], new_state: models.GameState) -> List[dict]:
+    """Get teamtasks of the new state that differ from the old state"""
+    if old_state is None:
+        return new_state.team_tasks
+
+    old_teamtasks = {(tt['team_id'], tt['task_id']): tt for tt in old_state.team_tasks}
+    return [
+        tt for tt in new_state.team_tasks
+        if old_teamtasks.get((tt['team_id'], tt['task_id'])) != tt
+    ]
+
+
+async def get_scoreboard_version_async(loop) -> int:
+    """Get version of the current scoreboard snapshot, 0 if there's none"""
+    redis_aio = await storage.get_async_redis_storage(loop)
+    version = await redis_aio.hget(SCOREBOARD_KEY, 'version')
+    return int(version or 0)
+
+
+async def get_scoreboard_snapshot_async(loop) -> Optional[ScoreboardSnapshot]:
+    """Get current scoreboard snapshot, None if it wasn't published yet"""
+    redis_aio = await storage.get_async_redis_storage(loop)
+    version, data, compressed, columnar, columnar_compressed = await redis_aio.hmget(
+        SCOREBOARD_KEY,
+        'version', 'data', 'gzip', 'columnar', 'columnar_gzip',
+    )
+    if version is None:
+        return None
+
+    return ScoreboardSnapshot(
+        version=int(version),
+        data=data.decode(),
+        gzip=compressed,
+        columnar=columnar.decode(),
+        columnar_gzip=columnar_compressed,
+    )
+
+
 async def get_game_state_async(loop) -> Optional[models.GameState]:
     """Get game state for current round (asynchronous version)"""
     redis_pool = await storage.get_async_redis_storage(loop)
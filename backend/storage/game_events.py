@@ -0,0 +1,57 @@
+from typing import Optional
+
+import config
+import storage
+
+# Game events are published to this redis channel (or "game_events:{room}"
+# for events sent to a single room) as ready-to-send server-sent-events frames
+GAME_EVENTS_CHANNEL = 'game_events'
+
+_socketio_enabled = None
+
+
+def socketio_enabled() -> bool:
+    """Check if game events are also sent to socket.io clients by this process"""
+    global _socketio_enabled
+
+    if _socketio_enabled is None:
+        _socketio_enabled = config.get_game_events_config()['socketio']
+
+    return _socketio_enabled
+
+
+def get_channel(room: Optional[str] = None) -> str:
+    if room is None:
+        return GAME_EVENTS_CHANNEL
+    return f'{GAME_EVENTS_CHANNEL}:{room}'
+
+
+def encode_frame(event: str, data: str, event_id: Optional[int] = None) -> bytes:
+    """Encode event as a server-sent-events frame, data must be a single line (e.g. json)"""
+    frame = f'event: {event}\n'
+    if event_id is not None:
+        frame += f'id: {event_id}\n'
+    frame += f'data: {data}\n\n'
+    return frame.encode()
+
+
+def emit_socketio(event: str, data: str, room: Optional[str] = None):
+    """Send game event to socket.io clients only, if enabled"""
+    if socketio_enabled():
+        storage.get_wro_sio_manager().emit(
+            event=event,
+            data={'data': data},
+            namespace='/game_events',
+            room=room,
+        )
+
+
+def emit(event: str, data: str, room: Optional[str] = None):
+    """Send game event to the broadcaster service and, if enabled, to socket.io clients
+
+        :param event: event name
+        :param data: json-encoded event data
+        :param room: socket.io room, also selects the redis channel
+    """
+    emit_socketio(event, data, room)
+    storage.get_redis_storage().publish(get_channel(room), encode_frame(event, data))
@@ -0,0 +1,168 @@
+import asyncio
+import threading
+import time
+from collections import Counter, defaultdict
+from typing import Callable, Awaitable, Optional
+
+import storage
+
+# Names of updated cached data are published here by storage.caching
+CACHE_UPDATES_CHANNEL = 'cache:updates'
+
+# How often local hit/miss counters are added to redis, in seconds
+REPORT_INTERVAL = 10
+
+LOCAL_CACHE_STATS_KEY = 'local_cache:stats'
+
+_local_cache = None
+
+
+class LocalCache:
+    """Process-local copy of data that doesn't change during the game
+    (teams, tasks, global config), kept in front of the redis cache
+
+        Entries are dropped when storage.caching fills the redis cache again
+        and publishes the data name to CACHE_UPDATES_CHANNEL. Entries are only
+        used while the subscription delivering these messages is alive,
+        otherwise every call goes to redis.
+
+        Changes made directly in the database are not seen here (nor in the redis
+        cache) until the cache is filled again, so after editing teams, tasks or
+        global config in the database call the corresponding storage.caching function.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._generations = defaultdict(int)
+        self._pubsub = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self.stats = Counter()
+        self._last_report = time.monotonic()
+
+    @property
+    def subscribed(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def _handle_update(self, message):
+        self.invalidate(message['data'])
+
+    def invalidate(self, name: str):
+        self._generations[name] += 1
+        self._entries.pop(name, None)
+
+    def clear(self):
+        for name in list(self._entries):
+            self.invalidate(name)
+
+    def start(self):
+        """(Re)subscribe to cache updates, entries cached before are dropped
+        as updates could be missed while there was no subscription"""
+        with self._lock:
+            if self.subscribed:
+                return
+
+            self.clear()
+            self._pubsub = storage.get_redis_storage().pubsub(ignore_subscribe_messages=True)
+            self._pubsub.subscribe(**{CACHE_UPDATES_CHANNEL: self._handle_update})
+            self._thread = self._pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+    def stop(self):
+        if self._thread is not None:
+            self._thread.stop()
+            self._thread = None
+
+    def _lookup(self, name: str):
+        entry = self._entries.get(name)
+        self.stats[f'{name}:hits' if entry is not None else f'{name}:misses'] += 1
+        return entry, self._generations[name]
+
+    def _store(self, name: str, generation: int, value):
+        # value loaded before an invalidation that arrived during the load is not stored
+        if self._generations[name] == generation and self.subscribed:
+            self._entries[name] = value
+
+    def get(self, name: str, loader: Callable):
+        """Get cached value by name, calling "loader" on miss"""
+        self.report_if_needed()
+        if not self.subscribed:
+            self.start()
+
+        value, generation = self._lookup(name)
+        if value is None:
+            value = loader()
+            self._store(name, generation, value)
+        return value
+
+    async def get_async(self, name: str, loader: Callable[[], Awaitable]):
+        """Asynchronous version of get, "loader" returns an awaitable.
+        Blocking redis calls (stats report, subscription) run in the default executor"""
+        loop = asyncio.get_event_loop()
+
+        stats = self._take_report()
+        if stats:
+            loop.run_in_executor(None, self._report, stats)
+        if not self.subscribed:
+            await loop.run_in_executor(None, self.start)
+
+        value, generation = self._lookup(name)
+        if value is None:
+            value = await loader()
+            self._store(name, generation, value)
+        return value
+
+    def _take_report(self) -> Optional[Counter]:
+        """Take counters collected since the last report if REPORT_INTERVAL has passed"""
+        now = time.monotonic()
+        if now - self._last_report < REPORT_INTERVAL:
+            return None
+        self._last_report = now
+
+        stats, self.stats = self.stats, Counter()
+        return stats or None
+
+    @staticmethod
+    def _report(stats: Counter):
+        with storage.get_redis_storage().pipeline(transaction=False) as pipeline:
+            for field, count in stats.items():
+                pipeline.hincrby(LOCAL_CACHE_STATS_KEY, field, count)
+            pipeline.execute()
+
+    def report_if_needed(self):
+        """Add hit and miss counters to the shared redis hash every REPORT_INTERVAL seconds"""
+        stats = self._take_report()
+        if stats:
+            self._report(stats)
+
+
+def get_local_cache() -> LocalCache:
+    """Get process-wide local cache, subscription thread is started on first use"""
+    global _local_cache
+
+    if _local_cache is None:
+        _local_cache = LocalCache()
+
+    return _local_cache
+
+
+def get(name: str, loader: Callable):
+    return get_local_cache().get(name, loader)
+
+
+async def get_async(name: str, loader: Callable[[], Awaitable]):
+    return await get_local_cache().get_async(name, loader)
+
+
+def get_local_stats() -> dict:
+    """Get hit and miss counts of this process since the last report"""
+    return dict(get_local_cache().stats)
+
+
+def get_stats() -> dict:
+    """Get hit and miss counts summed over all processes, e.g. {"teams": {"hits": 10, "misses": 1}}"""
+    stats = storage.get_redis_storage().hgetall(LOCAL_CACHE_STATS_KEY)
+    result = defaultdict(dict)
+    for field, count in stats.items():
+        name, kind = field.rsplit(':', 1)
+        result[name][kind] = int(count)
+    return dict(result)
@@ -0,0 +1,194 @@
+from collections import defaultdict
+from typing import List
+
+import storage
+from helplib.cache import cached_read, async_cached_read
+from storage import caching
+
+RANKING_KEY = 'ranking'
+RANKING_CACHED_KEY = 'ranking:cached'
+
+# Applies increments to a team-task cell of the team hash
+# and moves the team in the ranking by the change of the cell's contribution
+# (score * sla). Increments are commutative, so concurrent attacks and checks
+# can be applied in any order. Nothing is done until the ranking is seeded
+# from the database, as the seed already includes all committed changes.
+# Changes committed while the seed is built can be missed or counted twice,
+# so the ranking is reseeded each time game state is published (see reseed).
+_UPDATE_TEAMTASK_SCRIPT = """
+if redis.call('EXISTS', KEYS[3]) == 0 then
+    return 0
+end
+
+local prefix = ARGV[2] .. ':'
+local score = tonumber(redis.call('HINCRBYFLOAT', KEYS[2], prefix .. 'score', ARGV[3]))
+local checks = redis.call('HINCRBY', KEYS[2], prefix .. 'checks', ARGV[4])
+local passed = redis.call('HINCRBY', KEYS[2], prefix .. 'checks_passed', ARGV[5])
+redis.call('HINCRBY', KEYS[2], prefix .. 'stolen', ARGV[6])
+redis.call('HINCRBY', KEYS[2], prefix .. 'lost', ARGV[7])
+redis.call('HINCRBY', KEYS[2], 'stolen', ARGV[6])
+redis.call('HINCRBY', KEYS[2], 'lost', ARGV[7])
+
+local contribution = score * passed / math.max(checks, 1)
+local old = tonumber(redis.call('HGET', KEYS[2], prefix .. 'contribution') or '0')
+redis.call('HSET', KEYS[2], prefix .. 'contribution', tostring(contribution))
+redis.call('ZINCRBY', KEYS[1], contribution - old, ARGV[1])
+return 1
+"""
+
+_update_teamtask_script = None
+
+
+def team_key(team_id: int) -> str:
+    return f'ranking:team:{team_id}'
+
+
+def _teamtask_args(team_id: int, task_id: int, score=0.0, checks=0, passed=0, stolen=0, lost=0):
+    keys = [RANKING_KEY, team_key(team_id), RANKING_CACHED_KEY]
+    args = [team_id, task_id, score, checks, passed, stolen, lost]
+    return keys, args
+
+
+def _attack_updates(attacker_id: int, accepted: List[tuple]) -> list:
+    """Aggregate accepted attacks to increments per team-task cell
+
+        :param accepted: list of (flag, attacker_delta, victim_delta)
+        :return: list of (keys, args) for the update script
+    """
+    increments = defaultdict(lambda: [0.0, 0, 0])
+    for flag, attacker_delta, victim_delta in accepted:
+        attacker = increments[(attacker_id, flag.task_id)]
+        attacker[0] += attacker_delta
+        attacker[1] += 1
+
+        victim = increments[(flag.team_id, flag.task_id)]
+        victim[0] += victim_delta
+        victim[2] += 1
+
+    return [
+        _teamtask_args(team_id, task_id, score=score, stolen=stolen, lost=lost)
+        for (team_id, task_id), (score, stolen, lost) in increments.items()
+    ]
+
+
+def _get_update_script():
+    global _update_teamtask_script
+
+    if _update_teamtask_script is None:
+        _update_teamtask_script = storage.get_redis_storage().register_script(_UPDATE_TEAMTASK_SCRIPT)
+
+    return _update_teamtask_script
+
+
+def apply_attacks(attacker_id: int, accepted: List[tuple]):
+    """Add score changes and stolen/lost counts of accepted attacks to the ranking
+
+        :param attacker_id: id of the attacking team
+        :param accepted: list of (flag, attacker_delta, victim_delta)
+    """
+    if not accepted:
+        return
+
+    script = _get_update_script()
+    with storage.get_redis_storage().pipeline(transaction=True) as pipeline:
+        for keys, args in _attack_updates(attacker_id, accepted):
+            script(keys=keys, args=args, client=pipeline)
+        pipeline.execute()
+
+
+async def apply_attacks_async(attacker_id: int, accepted: List[tuple], loop):
+    """Asynchronous version of apply_attacks"""
+    if not accepted:
+        return
+
+    redis_aio = await storage.get_async_redis_storage(loop)
+    tr = redis_aio.multi_exec()
+    for keys, args in _attack_updates(attacker_id, accepted):
+        tr.eval(_UPDATE_TEAMTASK_SCRIPT, keys=keys, args=args)
+    await tr.execute()
+
+
+def apply_check(team_id: int, task_id: int, passed: int):
+    """Count a checker run in the team-task sla
+
+        :param passed: 1 if the check was successful, 0 otherwise
+    """
+    keys, args = _teamtask_args(team_id, task_id, checks=1, passed=passed)
+    _get_update_script()(keys=keys, args=args)
+
+
+def reseed():
+    """Rebuild the ranking from the database, so the drift of increments
+    racing with the previous seed doesn't last longer than a round"""
+    with storage.get_redis_storage().pipeline(transaction=True) as pipeline:
+        caching.cache_ranking(pipeline)
+        pipeline.execute()
+
+
+def _parse_team(team_id: int, score: float, data: dict) -> dict:
+    tasks = defaultdict(dict)
+    for field, value in data.items():
+        if ':' in field:
+            task_id, name = field.split(':', 1)
+            tasks[int(task_id)][name] = value
+
+    return {
+        'team_id': team_id,
+        'score': score,
+        'stolen': int(data.get('stolen', 0)),
+        'lost': int(data.get('lost', 0)),
+        'tasks': [
+            {
+                'task_id': task_id,
+                'score': float(task['score']),
+                'sla': 100.0 * int(task['checks_passed']) / max(int(task['checks']), 1),
+                'stolen': int(task['stolen']),
+                'lost': int(task['lost']),
+            }
+            for task_id, task in sorted(tasks.items())
+        ],
+    }
+
+
+def get_ranking(limit: int) -> List[dict]:
+    """Get top "limit" teams with score totals, stolen and lost counts for each task"""
+    with storage.get_redis_storage().pipeline(transaction=True) as pipeline:
+        top, = cached_read(
+            pipeline=pipeline,
+            cache_key=RANKING_CACHED_KEY,
+            cache_func=caching.cache_ranking,
+            cache_args=(pipeline,),
+            read=lambda p: p.zrevrange(RANKING_KEY, 0, limit - 1, withscores=True),
+        )
+
+        for team_id, _score in top:
+            pipeline.hgetall(team_key(team_id))
+        teams_data = pipeline.execute()
+
+    return [
+        _parse_team(int(team_id), score, data)
+        for (team_id, score), data in zip(top, teams_data)
+    ]
+
+
+async def get_ranking_async(limit: int, loop) -> List[dict]:
+    """Asynchronous version of get_ranking"""
+    redis_aio = await storage.get_async_redis_storage(loop)
+
+    top, = await async_cached_read(
+        redis_aio=redis_aio,
+        cache_key=RANKING_CACHED_KEY,
+        cache_func=caching.cache_ranking_async,
+        cache_args=(loop,),
+        read=lambda tr: tr.zrevrange(RANKING_KEY, 0, limit - 1, withscores=True, encoding='utf-8'),
+    )
+
+    pipeline = redis_aio.pipeline()
+    for team_id, _score in top:
+        pipeline.hgetall(team_key(team_id), encoding='utf-8')
+    teams_data = await pipeline.execute()
+
+    return [
+        _parse_team(int(team_id), score, data)
+        for (team_id, score), data in zip(top, teams_data)
+    ]
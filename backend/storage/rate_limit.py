@@ -0,0 +1,226 @@
+import asyncio
+import time
+from collections import defaultdict
+from typing import Tuple, Optional
+
+import config
+import storage
+from helplib.scripts import AsyncScript
+
+# How often local throttling stats are written to redis, in seconds
+REPORT_INTERVAL = 5
+
+THROTTLING_STATS_KEY = 'flag_submitter:throttling'
+
+# Token bucket shared between all submitter replicas.
+# Grants as many of the requested tokens as available and returns
+# the number of milliseconds until the next token appears if not all were granted.
+_TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local requested = tonumber(ARGV[4])
+
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1])
+local ts = tonumber(state[2])
+if tokens == nil or ts == nil then
+    tokens = burst
+    ts = now
+end
+
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate / 1000)
+local granted = math.min(requested, math.floor(tokens))
+tokens = tokens - granted
+
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(math.max(now, ts)))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst * 1000 / rate) + 1000)
+
+local wait = 0
+if granted < requested then
+    wait = math.ceil((1 - tokens) * 1000 / rate)
+end
+return {granted, wait}
+"""
+
+_token_bucket_script_async = AsyncScript(_TOKEN_BUCKET_SCRIPT)
+
+
+class LocalTokenBucket:
+    """Process-local token bucket, used as an approximation of the shared one
+    with the rate split between submitter replicas"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.ts = time.monotonic()
+
+    def acquire(self, requested: int) -> Tuple[int, float]:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.ts) * self.rate)
+        self.ts = now
+
+        granted = min(requested, int(self.tokens))
+        self.tokens -= granted
+
+        wait = 0.0
+        if granted < requested:
+            wait = (1 - self.tokens) / self.rate
+        return granted, wait
+
+
+class TeamRateLimiter:
+    """Per-team token bucket rate limiter for flag submission
+
+        Buckets are kept in redis and shared by all submitter replicas,
+        or kept locally with "rate / replicas" if "shared" is disabled.
+        Tracks queue depth (number of flags waiting for tokens) and the total
+        time flags spent throttled for each team.
+    """
+
+    def __init__(self, rate: float, burst: int, shared: bool = True, replicas: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.shared = shared
+        self.replicas = max(replicas, 1)
+
+        self._local_buckets = {}
+        self._script = None
+
+        self.queue_depth = defaultdict(int)
+        self.throttled_time = defaultdict(float)
+        self._last_report = time.monotonic()
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def _acquire_shared(self, team_id: int, requested: int) -> Tuple[int, float]:
+        if self._script is None:
+            self._script = storage.get_redis_storage().register_script(_TOKEN_BUCKET_SCRIPT)
+
+        now = int(time.time() * 1000)
+        granted, wait = self._script(
+            keys=[f'team:{team_id}:flag_bucket'],
+            args=[self.rate, self.burst, now, requested],
+        )
+        return int(granted), int(wait) / 1000
+
+    def _acquire_local(self, team_id: int, requested: int) -> Tuple[int, float]:
+        bucket = self._local_buckets.get(team_id)
+        if bucket is None:
+            bucket = LocalTokenBucket(rate=self.rate / self.replicas, burst=max(self.burst // self.replicas, 1))
+            self._local_buckets[team_id] = bucket
+        return bucket.acquire(requested)
+
+    async def _acquire_shared_async(self, team_id: int, requested: int, loop) -> Tuple[int, float]:
+        redis = await storage.get_async_redis_storage(loop)
+
+        now = int(time.time() * 1000)
+        granted, wait = await _token_bucket_script_async(
+            redis,
+            keys=[f'team:{team_id}:flag_bucket'],
+            args=[self.rate, self.burst, now, requested],
+        )
+        return int(granted), int(wait) / 1000
+
+    def acquire(self, team_id: int, requested: int) -> Tuple[int, float]:
+        """Try to take "requested" tokens for the team
+
+            :return: tuple of granted tokens count and seconds to wait before
+                     the next token is available (0 if all tokens were granted)
+        """
+        if not self.enabled or requested <= 0:
+            return requested, 0.0
+
+        self.report_if_needed()
+        if self.shared:
+            return self._acquire_shared(team_id, requested)
+        return self._acquire_local(team_id, requested)
+
+    async def acquire_async(self, team_id: int, requested: int, loop) -> Tuple[int, float]:
+        if not self.enabled or requested <= 0:
+            return requested, 0.0
+
+        if self.shared:
+            return await self._acquire_shared_async(team_id, requested, loop)
+        return self._acquire_local(team_id, requested)
+
+    def wait(self, team_id: int, count: int):
+        """Block until "count" tokens are taken for the team, flags are never dropped.
+        Sleeps with time.sleep, which is cooperative in monkey-patched gevent submitter"""
+        self.add_queued(team_id, count)
+        remaining = count
+        try:
+            while True:
+                granted, wait = self.acquire(team_id, remaining)
+                remaining -= granted
+                if not remaining:
+                    break
+                self.add_throttled_time(team_id, wait)
+                time.sleep(wait)
+        finally:
+            self.add_queued(team_id, -count)
+
+    async def wait_async(self, team_id: int, count: int, loop):
+        self.add_queued(team_id, count)
+        remaining = count
+        try:
+            while True:
+                granted, wait = await self.acquire_async(team_id, remaining, loop)
+                remaining -= granted
+                if not remaining:
+                    break
+                self.add_throttled_time(team_id, wait)
+                await asyncio.sleep(wait)
+        finally:
+            self.add_queued(team_id, -count)
+
+    def add_queued(self, team_id: int, count: int):
+        """Account flags put into (positive count) or taken from (negative count) the team's queue"""
+        self.queue_depth[team_id] += count
+
+    def add_throttled_time(self, team_id: int, seconds: float):
+        self.throttled_time[team_id] += seconds
+
+    def take_report(self) -> Optional[Tuple[dict, dict]]:
+        """Take copies of queue depths and throttled time if REPORT_INTERVAL has passed,
+        so they can be written from another thread while the counters keep changing"""
+        now = time.monotonic()
+        if now - self._last_report < REPORT_INTERVAL:
+            return None
+        self._last_report = now
+
+        throttled, self.throttled_time = self.throttled_time, defaultdict(float)
+        return dict(self.queue_depth), throttled
+
+    @staticmethod
+    def write_report(queue_depth: dict, throttled: dict):
+        with storage.get_redis_storage().pipeline(transaction=False) as pipeline:
+            for team_id, depth in queue_depth.items():
+                pipeline.hset(THROTTLING_STATS_KEY, f'{team_id}:queue_depth', depth)
+            for team_id, seconds in throttled.items():
+                pipeline.hincrbyfloat(THROTTLING_STATS_KEY, f'{team_id}:throttled_seconds', seconds)
+            pipeline.execute()
+
+    def report_if_needed(self):
+        """Write queue depths and throttled time to redis every REPORT_INTERVAL seconds"""
+        report = self.take_report()
+        if report is not None:
+            self.write_report(*report)
+
+
+def get_team_rate_limiter() -> TeamRateLimiter:
+    """Create rate limiter with settings from config"""
+    return TeamRateLimiter(**config.get_flag_rate_limit_config())
+
+
+def get_throttling_stats() -> dict:
+    """Get throttling stats of all teams, as reported by submitters"""
+    stats = storage.get_redis_storage().hgetall(THROTTLING_STATS_KEY)
+    result = defaultdict(dict)
+    for field, value in stats.items():
+        team_id, name = field.split(':', 1)
+        result[int(team_id)][name] = float(value)
+    return dict(result)
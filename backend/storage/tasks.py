@@ -1,42 +1,71 @@
-from typing import List
+import hashlib
+from typing import List, Optional, Tuple
+
+from kombu.utils import json
 
 import storage
 from helplib import models
-from helplib.cache import cache_helper, async_cache_helper
+from helplib.cache import cached_read, async_cached_read
 from helplib.types import TaskStatus, Action
 from storage import caching
 
 _SELECT_TEAMTASKS_QUERY = "SELECT * from teamtasks"
 
+_SELECT_TEAM_HISTORY_QUERY = """
+SELECT id, round, task_id, team_id, status, stolen, lost, score, checks, checks_passed,
+       public_message, private_message, command, ts
+FROM teamtaskslog
+WHERE team_id = %(team_id)s {task_condition}
+  AND round BETWEEN %(from_round)s AND %(to_round)s
+  AND (round, id) < (%(cursor_round)s, %(cursor_id)s)
+ORDER BY round DESC, id DESC
+LIMIT %(limit)s
+"""
+
+HISTORY_PAGE_SIZE = 100
+
+# Hash with the latest teamtask row for each "team_id:task_id",
+# history of each teamtask is kept in "teamtasks:{team_id}:{task_id}" streams
+LATEST_TEAMTASKS_KEY = 'teamtasks:latest'
+
 
 def get_tasks() -> List[models.Task]:
+    """Get list of tasks registered in database, served from the process-local cache"""
+    return list(storage.local_cache.get('tasks', _fetch_tasks))
+
+
+async def get_tasks_async(loop) -> List[models.Task]:
+    """Asynchronous version of get_tasks"""
+    return list(await storage.local_cache.get_async('tasks', lambda: _fetch_tasks_async(loop)))
+
+
+def _fetch_tasks() -> List[models.Task]:
     """Get list of tasks registered in database"""
     with storage.get_redis_storage().pipeline(transaction=True) as pipeline:
-        cache_helper(
+        tasks, = cached_read(
             pipeline=pipeline,
             cache_key='tasks:cached',
             cache_func=caching.cache_tasks,
             cache_args=(pipeline,),
+            read=lambda p: p.smembers('tasks'),
         )
-
-        tasks, = pipeline.smembers('tasks').execute()
         tasks = list(models.Task.from_json(task) for task in tasks)
 
     return tasks
 
 
-async def get_tasks_async(loop) -> List[models.Task]:
+async def _fetch_tasks_async(loop) -> List[models.Task]:
     """Get list of tasks registered in the database (asynchronous version)"""
 
     redis_aio = await storage.get_async_redis_storage(loop)
 
-    await async_cache_helper(
+    tasks, = await async_cached_read(
         redis_aio=redis_aio,
         cache_key='tasks:cached',
         cache_func=caching.cache_tasks_async,
+        cache_args=(loop,),
+        read=lambda tr: tr.smembers('tasks'),
     )
-
-    tasks = await redis_aio.smembers('tasks')
     tasks = list(models.Task.from_json(task) for task in tasks)
 
     return tasks
@@ -76,34 +105,48 @@ def update_task_status(task_id: int, team_id: int, round: int, checker_verdict:
 
     data['round'] = round
     with storage.get_redis_storage().pipeline(transaction=True) as pipeline:
-        pipeline.xadd(f'teamtasks:{team_id}:{task_id}', dict(data), maxlen=50, approximate=False).execute()
+        pipeline.xadd(f'teamtasks:{team_id}:{task_id}', dict(data), maxlen=50, approximate=False)
+        pipeline.hset(LATEST_TEAMTASKS_KEY, f'{team_id}:{task_id}', json.dumps(data))
+        pipeline.execute()
+
+    storage.ranking.apply_check(team_id=team_id, task_id=task_id, passed=add)
 
 
 def get_last_teamtasks() -> List[dict]:
     """Fetch team tasks, last for each team for each task
-        :return: dictionary of team tasks or None
+        :return: list of team tasks ordered by team and task
     """
-    teams = storage.teams.get_teams()
-    tasks = storage.tasks.get_tasks()
-
-    with storage.get_redis_storage().pipeline(transaction=True) as pipeline:
-        for team in teams:
-            for task in tasks:
-                pipeline.xrevrange(f'teamtasks:{team.id}:{task.id}', count=1)
-        data = pipeline.execute()
-
-    data = sum(data, [])
+    data = storage.get_redis_storage().hgetall(LATEST_TEAMTASKS_KEY)
+    if not data:
+        data = fill_last_teamtasks_from_db()
 
-    results = []
-    for timestamp, record in data:
-        record['timestamp'] = timestamp
-        results.append(record)
+    results = [json.loads(record) for record in data.values()]
+    results.sort(key=lambda record: (int(record['team_id']), int(record['task_id'])))
 
     process_teamtasks(results)
 
     return results
 
 
+def fill_last_teamtasks_from_db() -> dict:
+    """Put current teamtasks from database to the latest teamtasks hash,
+    not overwriting rows written by checkers in the meantime
+
+        :return: contents of the hash
+    """
+    teamtasks = get_teamtasks_from_db()
+    round = storage.game.get_real_round()
+
+    with storage.get_redis_storage().pipeline(transaction=True) as pipeline:
+        for teamtask in teamtasks:
+            teamtask['round'] = round
+            pipeline.hsetnx(LATEST_TEAMTASKS_KEY, f'{teamtask["team_id"]}:{teamtask["task_id"]}', json.dumps(teamtask))
+        pipeline.hgetall(LATEST_TEAMTASKS_KEY)
+        *_, data = pipeline.execute()
+
+    return data
+
+
 def get_teamtasks_from_db() -> List[dict]:
     """Fetch current team tasks from database
         :return: dictionary of team tasks or None
@@ -133,6 +176,116 @@ def get_teamtasks_of_team(team_id: int) -> List[dict]:
     return results
 
 
+async def get_teamtasks_of_team_async(team_id: int, loop) -> List[dict]:
+    """Fetch teamtasks for team for all tasks (asynchronous version)"""
+    tasks = await get_tasks_async(loop)
+    redis_aio = await storage.get_async_redis_storage(loop)
+
+    pipeline = redis_aio.pipeline()
+    for task in tasks:
+        pipeline.xrevrange(f'teamtasks:{team_id}:{task.id}')
+    data = await pipeline.execute()
+
+    data = sum(data, [])
+    results = []
+    for timestamp, record in data:
+        # aioredis doesn't decode stream entries
+        record = {key.decode(): value.decode() for key, value in record.items()}
+        record['timestamp'] = timestamp.decode()
+        results.append(record)
+
+    return results
+
+
+def parse_history_cursor(cursor: Optional[str]) -> Optional[Tuple[int, int]]:
+    """Parse "round:id" history cursor, raises ValueError if it's malformed"""
+    if not cursor:
+        return None
+
+    round, record_id = cursor.split(':')
+    return int(round), int(record_id)
+
+
+async def get_team_history_async(team_id: int,
+                                 loop,
+                                 task_id: Optional[int] = None,
+                                 from_round: int = 0,
+                                 to_round: Optional[int] = None,
+                                 cursor: Optional[str] = None,
+                                 limit: int = HISTORY_PAGE_SIZE) -> dict:
+    """Get a page of team's teamtasks history from the log, newest first
+
+        Pages of past rounds are cached in redis with current round in the key,
+        so the cache is invalidated when the next round starts. Pages including
+        current round are not cached, as checkers keep adding records to it.
+
+        :param team_id: team to get history for
+        :param loop: event loop
+        :param task_id: only get history for this task if specified
+        :param from_round: first round of the range
+        :param to_round: last round of the range, current round if not specified
+        :param cursor: "next_cursor" of the previous page
+        :param limit: page size
+
+        :return: dict with "items" and "next_cursor" (None on the last page)
+    """
+    parsed_cursor = parse_history_cursor(cursor)
+    current_round = await storage.game.get_real_round_async(loop)
+    if to_round is None or to_round > current_round:
+        to_round = current_round
+
+    # game hasn't started yet or the range is empty
+    if to_round < 0 or to_round < from_round:
+        return {'items': [], 'next_cursor': None}
+
+    cursor_round, cursor_id = parsed_cursor or (to_round + 1, 0)
+    cacheable = min(to_round, cursor_round) < current_round
+
+    params_hash = hashlib.md5(f'{task_id}:{from_round}:{to_round}:{cursor}:{limit}'.encode()).hexdigest()
+    cache_key = f'team:{team_id}:history:{current_round}:{params_hash}'
+
+    redis_aio = await storage.get_async_redis_storage(loop)
+    if cacheable:
+        cached = await redis_aio.get(cache_key)
+        if cached is not None:
+            return json.loads(cached)
+
+    params = {
+        'team_id': team_id,
+        'task_id': task_id,
+        'from_round': from_round,
+        'to_round': to_round,
+        'cursor_round': cursor_round,
+        'cursor_id': cursor_id,
+        'limit': limit,
+    }
+    query = _SELECT_TEAM_HISTORY_QUERY.format(
+        task_condition='AND task_id = %(task_id)s' if task_id is not None else '',
+    )
+
+    async with storage.async_db_cursor(loop, dict_cursor=True) as (conn, curs):
+        await curs.execute(query, params)
+        records = await curs.fetchall()
+
+    for record in records:
+        record['ts'] = record['ts'].timestamp()
+
+    next_cursor = None
+    if len(records) == limit:
+        next_cursor = f'{records[-1]["round"]}:{records[-1]["id"]}'
+
+    page = {
+        'items': filter_teamtasks_for_participants(records),
+        'next_cursor': next_cursor,
+    }
+
+    if cacheable:
+        game_config = await storage.game.get_current_global_config_async(loop)
+        await redis_aio.set(cache_key, json.dumps(page), expire=game_config.round_time * 2)
+
+    return page
+
+
 def filter_teamtasks_for_participants(teamtasks: List[dict]) -> List[dict]:
     """Remove private message and rename public message
     to "message" for a list of teamtasks, remove 'command'
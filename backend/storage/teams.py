@@ -1,40 +1,49 @@
-from kombu.utils import json
-from typing import List, Optional
+from collections import defaultdict
+from typing import List, Optional, Union
 
 import storage
-from helplib import models, flags
-from helplib.cache import cache_helper, async_cache_helper
+from helplib import models, flags, exceptions
+from helplib.cache import cached_read, async_cached_read
 from storage import caching
 
 
 def get_teams() -> List[models.Team]:
+    """Get list of teams registered in the database, served from the process-local cache"""
+    return list(storage.local_cache.get('teams', _fetch_teams))
+
+
+async def get_teams_async(loop) -> List[models.Team]:
+    """Asynchronous version of get_teams"""
+    return list(await storage.local_cache.get_async('teams', lambda: _fetch_teams_async(loop)))
+
+
+def _fetch_teams() -> List[models.Team]:
     """Get list of teams registered in the database"""
     with storage.get_redis_storage().pipeline(transaction=True) as pipeline:
-        cache_helper(
+        teams, = cached_read(
             pipeline=pipeline,
             cache_key='teams:cached',
             cache_func=caching.cache_teams,
             cache_args=(pipeline,),
+            read=lambda p: p.smembers('teams'),
         )
-
-        teams, = pipeline.smembers('teams').execute()
         teams = list(models.Team.from_json(team) for team in teams)
 
     return teams
 
 
-async def get_teams_async(loop) -> List[models.Team]:
+async def _fetch_teams_async(loop) -> List[models.Team]:
     """Get list of teams registered in the database (asynchronous version)"""
 
     redis_aio = await storage.get_async_redis_storage(loop)
 
-    await async_cache_helper(
+    teams, = await async_cached_read(
         redis_aio=redis_aio,
         cache_key='teams:cached',
         cache_func=caching.cache_teams_async,
+        cache_args=(loop,),
+        read=lambda tr: tr.smembers('teams'),
     )
-
-    teams = await redis_aio.smembers('teams')
     teams = list(models.Team.from_json(team) for team in teams)
 
     return teams
@@ -48,13 +57,13 @@ def get_team_id_by_token(token: str) -> Optional[int]:
     """
 
     with storage.get_redis_storage().pipeline(transaction=True) as pipeline:
-        cache_helper(
+        team_id, = cached_read(
             pipeline=pipeline,
             cache_key='teams:cached',
             cache_func=caching.cache_teams,
             cache_args=(pipeline,),
+            read=lambda p: p.get(f'team:token:{token}'),
         )
-        team_id, = pipeline.get(f'team:token:{token}').execute()
 
     try:
         team_id = int(team_id)
@@ -64,37 +73,204 @@ def get_team_id_by_token(token: str) -> Optional[int]:
         return team_id
 
 
-def handle_attack(attacker_id: int, flag_str: str, round: int) -> float:
+async def get_team_id_by_token_async(token: str, loop) -> Optional[int]:
+    """Get team by token (asynchronous version)
+
+        :param token: token string
+        :param loop: event loop
+        :return: team id
+    """
+    redis_aio = await storage.get_async_redis_storage(loop)
+
+    team_id, = await async_cached_read(
+        redis_aio=redis_aio,
+        cache_key='teams:cached',
+        cache_func=caching.cache_teams_async,
+        cache_args=(loop,),
+        read=lambda tr: tr.get(f'team:token:{token}'),
+    )
+
+    try:
+        team_id = int(team_id)
+    except (ValueError, TypeError):
+        return None
+    else:
+        return team_id
+
+
+def _collect_attack_results(checked, deltas):
+    """Merge redis check results with rating changes returned by recalculate_rating_bulk
+
+        :param checked: list of (flag, error) pairs
+        :param deltas: dictionary flag_id -> (attacker_delta, victim_delta)
+        :return: tuple of results list (delta or exception for each flag) and
+                 list of (flag, attacker_delta, victim_delta) for accepted flags
+    """
+    results = []
+    accepted = []
+    for flag, error in checked:
+        if error is not None:
+            results.append(error)
+        elif flag.id not in deltas:
+            results.append(exceptions.FlagSubmitException('Flag already stolen'))
+        else:
+            attacker_delta, victim_delta = deltas.pop(flag.id)
+            results.append(attacker_delta)
+            accepted.append((flag, attacker_delta, victim_delta))
+
+    return results, accepted
+
+
+def handle_attack(attacker_id: int, flag_str: str, round: int) -> Optional[float]:
     """Check flag, lock team for update, call rating recalculation,
-        then publish redis message about stolen flag
+        then schedule publishing of stolen flag event
 
         :param attacker_id: id of the attacking team
         :param flag_str: flag to be checked
         :param round: round of the attack
 
         :raises FlagSubmitException: when flag check was failed
-        :return: attacker rating change
+        :return: attacker rating change, None in write-behind mode
     """
 
-    flag = flags.try_add_stolen_flag_by_str(flag_str=flag_str, attacker=attacker_id, round=round)
+    result, = handle_attacks_batch(attacker_id=attacker_id, flag_strs=[flag_str], round=round)
+    if isinstance(result, exceptions.FlagSubmitException):
+        raise result
 
+    return result
+
+
+def handle_attacks_batch(attacker_id: int,
+                         flag_strs: List[str],
+                         round: int) -> List[Union[Optional[float], exceptions.FlagSubmitException]]:
+    """Process multiple flags of one attacker at once: check all of them
+        in a redis pipeline, recalculate rating with a single bulk procedure call,
+        then schedule publishing of stolen flags events and record first bloods
+
+        In write-behind mode (see storage.write_behind) accepted flags are
+        added to the attacks stream by the redis check, and the result is returned
+        without waiting for the database, attack_writer applies them later.
+
+        :param attacker_id: id of the attacking team
+        :param flag_strs: flags to be checked
+        :param round: round of the attack
+
+        :return: list of the same length as "flag_strs", with attacker rating change
+                 (None in write-behind mode) for accepted flags and FlagSubmitException
+                 instance for rejected ones
+    """
+
+    write_behind = storage.write_behind.enabled()
+    checked = flags.try_add_stolen_flags_by_str_batch(
+        flag_strs=flag_strs,
+        attacker=attacker_id,
+        round=round,
+        write_behind=write_behind,
+    )
+    if write_behind:
+        return [error for _flag, error in checked]
+
+    to_apply = [flag for flag, error in checked if error is None]
+
+    deltas = {}
+    if to_apply:
+        with storage.db_cursor() as (conn, curs):
+            curs.callproc(
+                "recalculate_rating_bulk",
+                (
+                    [attacker_id] * len(to_apply),
+                    [flag.id for flag in to_apply],
+                ),
+            )
+            for flag_id, _attacker_id, attacker_delta, victim_delta in curs.fetchall():
+                deltas[flag_id] = (attacker_delta, victim_delta)
+            conn.commit()
+
+    results, accepted = _collect_attack_results(checked, deltas)
+    storage.ranking.apply_attacks(attacker_id, accepted)
+    storage.attack_events.add_attacks(attacker_id, accepted)
+    storage.first_bloods.record_attacks(attacker_id, accepted, round)
+
+    return results
+
+
+async def handle_attacks_batch_async(attacker_id: int,
+                                     flag_strs: List[str],
+                                     round: int,
+                                     loop) -> List[Union[Optional[float], exceptions.FlagSubmitException]]:
+    """Asynchronous version of handle_attacks_batch, uses aioredis and aiopg"""
+
+    write_behind = storage.write_behind.enabled()
+    checked = await flags.try_add_stolen_flags_by_str_batch_async(
+        flag_strs=flag_strs,
+        attacker=attacker_id,
+        round=round,
+        loop=loop,
+        write_behind=write_behind,
+    )
+    if write_behind:
+        return [error for _flag, error in checked]
+
+    to_apply = [flag for flag, error in checked if error is None]
+
+    deltas = {}
+    if to_apply:
+        async with storage.async_db_cursor(loop) as (conn, curs):
+            async with storage.async_db_transaction(curs):
+                await curs.callproc(
+                    "recalculate_rating_bulk",
+                    (
+                        [attacker_id] * len(to_apply),
+                        [flag.id for flag in to_apply],
+                    ),
+                )
+                for flag_id, _attacker_id, attacker_delta, victim_delta in await curs.fetchall():
+                    deltas[flag_id] = (attacker_delta, victim_delta)
+
+    results, accepted = _collect_attack_results(checked, deltas)
+    await storage.ranking.apply_attacks_async(attacker_id, accepted, loop)
+    storage.attack_events.add_attacks(attacker_id, accepted)
+    await storage.first_bloods.record_attacks_async(attacker_id, accepted, round, loop)
+
+    return results
+
+
+def apply_attacks_bulk(attacks: List[tuple]) -> int:
+    """Apply attacks accepted in write-behind mode: recalculate rating
+        with a single bulk procedure call in the order of "attacks", then update
+        the ranking, schedule publishing of stolen flags events and record first bloods
+
+        Attacks already present in the database are skipped by the procedure,
+        so applying the same attacks again after a crash has no effect.
+
+        :param attacks: list of (attacker_id, flag, round)
+        :return: number of applied attacks
+    """
+    if not attacks:
+        return 0
+
+    deltas = {}
     with storage.db_cursor() as (conn, curs):
-        curs.callproc("recalculate_rating", (attacker_id, flag.team_id, flag.task_id, flag.id))
-        attacker_delta, victim_delta = curs.fetchone()
+        curs.callproc(
+            "recalculate_rating_bulk",
+            (
+                [attacker_id for attacker_id, _flag, _round in attacks],
+                [flag.id for _attacker_id, flag, _round in attacks],
+            ),
+        )
+        for flag_id, attacker_id, attacker_delta, victim_delta in curs.fetchall():
+            deltas[(flag_id, attacker_id)] = (attacker_delta, victim_delta)
         conn.commit()
 
-    flag_data = {
-        'attacker_id': attacker_id,
-        'victim_id': flag.team_id,
-        'task_id': flag.task_id,
-        'attacker_delta': attacker_delta,
-        'victim_delta': victim_delta,
-    }
-
-    storage.get_wro_sio_manager().emit(
-        event='flag_stolen',
-        data={'data': json.dumps(flag_data)},
-        namespace='/game_events',
-    )
+    applied = defaultdict(list)
+    for attacker_id, flag, round in attacks:
+        delta = deltas.pop((flag.id, attacker_id), None)
+        if delta is not None:
+            applied[(attacker_id, round)].append((flag, *delta))
+
+    for (attacker_id, round), accepted in applied.items():
+        storage.ranking.apply_attacks(attacker_id, accepted)
+        storage.attack_events.add_attacks(attacker_id, accepted)
+        storage.first_bloods.record_attacks(attacker_id, accepted, round)
 
-    return attacker_delta
+    return sum(len(accepted) for accepted in applied.values())
@@ -0,0 +1,93 @@
+import time
+from typing import Optional
+
+import aioredis
+import redis
+
+import config
+import storage
+
+# Attacks accepted in write-behind mode are appended here by storage.flags,
+# one entry per submitted batch with fields "attacker_id", "round" and "flags",
+# where "flags" is json list of [id, team_id, task_id, round]
+ATTACKS_STREAM = 'attacks:stream'
+
+# Consumer group of attack_writer instances, entries are deleted after they're applied
+WRITERS_GROUP = 'attack_writers'
+
+# Hash with counters of attack_writer and the id of the last applied entry
+WRITER_STATS_KEY = 'attacks:writer:stats'
+
+_enabled = None
+
+
+def enabled() -> bool:
+    """Check if the write-behind mode is enabled for this process"""
+    global _enabled
+
+    if _enabled is None:
+        _enabled = config.get_write_behind_config()['enabled']
+
+    return _enabled
+
+
+def entry_time(entry_id) -> float:
+    """Get the time entry was added to the stream as unix timestamp"""
+    if isinstance(entry_id, bytes):
+        entry_id = entry_id.decode()
+    return int(entry_id.split('-', 1)[0]) / 1000
+
+
+def _make_lag(length: int, pending: int, oldest_id: Optional[str], stats: dict) -> dict:
+    return {
+        'length': length,
+        'pending': pending,
+        'lag': time.time() - entry_time(oldest_id) if oldest_id is not None else 0.0,
+        'applied': int(stats.get('applied', 0)),
+        'batches': int(stats.get('batches', 0)),
+        'replayed': int(stats.get('replayed', 0)),
+    }
+
+
+def get_lag() -> dict:
+    """Get write-behind lag metrics
+
+        :return: dict with number of entries not yet applied ("length"), entries
+                 delivered to writers but not applied ("pending"), age of the oldest
+                 not applied entry in seconds ("lag") and writer counters
+    """
+    with storage.get_redis_storage().pipeline(transaction=True) as pipeline:
+        pipeline.xlen(ATTACKS_STREAM)
+        pipeline.xrange(ATTACKS_STREAM, count=1)
+        pipeline.hgetall(WRITER_STATS_KEY)
+        length, oldest, stats = pipeline.execute()
+
+    # group doesn't exist until the first writer starts
+    pending = 0
+    if length:
+        try:
+            pending = storage.get_redis_storage().xpending(ATTACKS_STREAM, WRITERS_GROUP)['pending']
+        except redis.ResponseError:
+            pass
+
+    return _make_lag(length, pending, oldest[0][0] if oldest else None, stats)
+
+
+async def get_lag_async(loop) -> dict:
+    """Asynchronous version of get_lag"""
+    redis_aio = await storage.get_async_redis_storage(loop)
+
+    tr = redis_aio.multi_exec()
+    tr.xlen(ATTACKS_STREAM)
+    tr.xrange(ATTACKS_STREAM, count=1)
+    tr.hgetall(WRITER_STATS_KEY, encoding='utf-8')
+    length, oldest, stats = await tr.execute()
+
+    pending = 0
+    if length:
+        try:
+            pending, *_ = await redis_aio.xpending(ATTACKS_STREAM, WRITERS_GROUP)
+        except aioredis.errors.ReplyError:
+            pass
+
+    return _make_lag(length, pending, oldest[0][0] if oldest else None, stats)
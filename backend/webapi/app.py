@@ -6,14 +6,31 @@ BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.insert(0, BASE_DIR)
 
 import asyncio
+import gzip
+from typing import NamedTuple, Optional
+from urllib.parse import parse_qs
+
 from kombu.utils import json
 
 from sanic import Sanic
-from sanic.response import json as json_response, html
+from sanic.response import json as json_response, html, raw
 from sanic_cors import CORS
 
 import storage
 import socketio
+from helplib import exceptions, flags
+
+# Maximum number of flags accepted in a single PUT /api/flags/ request
+MAX_FLAGS_PER_REQUEST = 100
+
+DEFAULT_RANKING_LIMIT = 10
+MAX_RANKING_LIMIT = 1000
+
+MAX_HISTORY_LIMIT = 1000
+
+# Game state encoding requested with "format" query parameter,
+# "columnar" is GameState.to_columnar_dict, anything else is the default
+COLUMNAR_FORMAT = 'columnar'
 
 sio_manager = storage.get_async_sio_manager()
 sio = socketio.AsyncServer(
@@ -28,10 +45,105 @@ CORS(app, supports_credentials=True, automatic_options=True)
 
 sio.attach(app)
 
+rate_limiter = storage.rate_limit.get_team_rate_limiter()
 
-@sio.on('connect', namespace='/game_events')
-async def handle_connect(sid, _environ):
+# Latest scoreboard snapshot seen by this worker
+_scoreboard_snapshot = None
+
+
+class CachedResponse(NamedTuple):
+    """Pre-encoded response body of an endpoint for a single data version"""
+    version: Optional[int]
+    etag: Optional[str]
+    body: bytes
+    gzip: bytes
+
+
+# Cached responses by endpoint name, see get_cached_response
+_response_cache = {}
+
+
+def make_encoded_response(request, etag: Optional[str], body: bytes, compressed: bytes):
+    """Respond with a pre-encoded json body, answering If-None-Match with 304
+    and sending the gzipped body to clients that accept it"""
+    headers = {'Vary': 'Accept-Encoding'}
+    if etag is not None:
+        headers['ETag'] = etag
+        if request.headers.get('If-None-Match') == etag:
+            return raw(b'', status=304, headers=headers)
+
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        headers['Content-Encoding'] = 'gzip'
+        return raw(compressed, content_type='application/json', headers=headers)
+
+    return raw(body, content_type='application/json', headers=headers)
+
+
+async def get_cached_response(endpoint: str, data_name: str, build, loop) -> CachedResponse:
+    """Get response of the endpoint for the current version of the cached data
+
+        Body is rebuilt only when the version set by storage.caching changes,
+        the local cache entry of the data is dropped before that.
+        If the data is not cached in redis yet, the response is built without
+        being stored, the next request will see the version.
+
+        :param endpoint: name of the endpoint, part of the ETag
+        :param data_name: name of the cached data, see storage.caching.get_cache_version_async
+        :param build: coroutine function of loop, returning the response data
+    """
+    version = await storage.caching.get_cache_version_async(data_name, loop)
+    cached = _response_cache.get(endpoint)
+    if version is not None and cached is not None and cached.version == version:
+        return cached
+
+    # the local cache may not have received the invalidation for this version yet,
+    # drop its entry so a stale body isn't stored under the new ETag
+    if version is not None:
+        storage.local_cache.get_local_cache().invalidate(data_name)
+
+    body = json.dumps(await build(loop)).encode()
+    cached = CachedResponse(
+        version=version,
+        etag=f'"{endpoint}-{version}"' if version is not None else None,
+        body=body,
+        gzip=gzip.compress(body, compresslevel=6),
+    )
+    if version is not None:
+        _response_cache[endpoint] = cached
+
+    return cached
+
+
+async def get_scoreboard_snapshot(loop):
+    """Get current scoreboard snapshot, fetching the payload
+    from redis only when its version changes"""
+    global _scoreboard_snapshot
+
+    version = await storage.game.get_scoreboard_version_async(loop)
+    if not version:
+        return None
+
+    if _scoreboard_snapshot is None or _scoreboard_snapshot.version != version:
+        _scoreboard_snapshot = await storage.game.get_scoreboard_snapshot_async(loop)
+
+    return _scoreboard_snapshot
+
+
+async def send_init_scoreboard(sid):
     loop = asyncio.get_event_loop()
+    session = await sio.get_session(sid, namespace='/game_events')
+    columnar = session.get('format') == COLUMNAR_FORMAT
+
+    snapshot = await get_scoreboard_snapshot(loop)
+    if snapshot is not None:
+        await sio.emit(
+            'init_scoreboard',
+            {'data': snapshot.columnar if columnar else snapshot.data, 'version': snapshot.version},
+            namespace='/game_events',
+            room=sid,
+        )
+        return
+
     game_state = await storage.game.get_game_state_async(loop)
 
     teams = await storage.teams.get_teams_async(loop)
@@ -40,10 +152,12 @@ async def handle_connect(sid, _environ):
     tasks = [task.to_dict_for_participants() for task in tasks]
     if not game_state:
         state = ''
+    elif columnar:
+        state = game_state.to_columnar_dict()
     else:
         state = game_state.to_dict()
 
-    game_config = storage.game.get_current_global_config()
+    game_config = await storage.game.get_current_global_config_async(loop)
     game_config = game_config.to_dict()
 
     data_to_send = {
@@ -61,34 +175,184 @@ async def handle_connect(sid, _environ):
     )
 
 
+@sio.on('connect', namespace='/game_events')
+async def handle_connect(sid, environ):
+    query = parse_qs(environ.get('QUERY_STRING', ''))
+    await sio.save_session(sid, {'format': query.get('format', [''])[0]}, namespace='/game_events')
+
+    sio.enter_room(sid, storage.game.SCOREBOARD_FULL_ROOM, namespace='/game_events')
+    await send_init_scoreboard(sid)
+
+
+@sio.on('subscribe_deltas', namespace='/game_events')
+async def handle_subscribe_deltas(sid):
+    """Switch the client from full game state updates to "update_scoreboard_delta" events"""
+    sio.leave_room(sid, storage.game.SCOREBOARD_FULL_ROOM, namespace='/game_events')
+    sio.enter_room(sid, storage.game.SCOREBOARD_DELTA_ROOM, namespace='/game_events')
+
+
+@sio.on('resync', namespace='/game_events')
+async def handle_resync(sid):
+    """Client missed a delta version and asks for the full scoreboard"""
+    await send_init_scoreboard(sid)
+
+
+@app.route('/api/scoreboard/')
+async def get_scoreboard(request):
+    snapshot = await get_scoreboard_snapshot(asyncio.get_event_loop())
+    if snapshot is None:
+        return json_response({'error': 'Scoreboard is not available yet'}, status=503)
+
+    if request.args.get('format') == COLUMNAR_FORMAT:
+        etag = f'"{snapshot.version}-{COLUMNAR_FORMAT}"'
+        data, compressed = snapshot.columnar, snapshot.columnar_gzip
+    else:
+        etag = f'"{snapshot.version}"'
+        data, compressed = snapshot.data, snapshot.gzip
+
+    return make_encoded_response(request, etag, data.encode(), compressed)
+
+
+@app.route('/api/ranking/')
+async def get_ranking(request):
+    try:
+        limit = int(request.args.get('limit', DEFAULT_RANKING_LIMIT))
+    except ValueError:
+        return json_response({'error': 'Invalid limit'}, status=400)
+
+    limit = min(max(limit, 1), MAX_RANKING_LIMIT)
+    ranking = await storage.ranking.get_ranking_async(limit, asyncio.get_event_loop())
+    return json_response(ranking)
+
+
+async def build_teams(loop):
+    teams = await storage.teams.get_teams_async(loop)
+    return [team.to_dict_for_participants() for team in teams]
+
+
+async def build_tasks(loop):
+    tasks = await storage.tasks.get_tasks_async(loop)
+    return [task.to_dict_for_participants() for task in tasks]
+
+
+async def build_game_config(loop):
+    game_config = await storage.game.get_current_global_config_async(loop)
+    return game_config.to_dict()
+
+
+@app.route('/api/first_bloods/')
+async def get_first_bloods(_request):
+    first_bloods = await storage.first_bloods.get_first_bloods_async(asyncio.get_event_loop())
+    return json_response([first_blood.to_dict() for first_blood in first_bloods])
+
+
 @app.route('/api/teams/')
-async def get_teams(_request):
-    teams = await storage.teams.get_teams_async(asyncio.get_event_loop())
-    teams = [team.to_dict_for_participants() for team in teams]
-    return json_response(teams)
+async def get_teams(request):
+    cached = await get_cached_response('teams', 'teams', build_teams, asyncio.get_event_loop())
+    return make_encoded_response(request, cached.etag, cached.body, cached.gzip)
 
 
 @app.route('/api/tasks/')
-async def get_tasks(_request):
-    tasks = await storage.tasks.get_tasks_async(asyncio.get_event_loop())
-    tasks = [task.to_dict_for_participants() for task in tasks]
-    return json_response(tasks)
+async def get_tasks(request):
+    cached = await get_cached_response('tasks', 'tasks', build_tasks, asyncio.get_event_loop())
+    return make_encoded_response(request, cached.etag, cached.body, cached.gzip)
 
 
 @app.route('/api/config/')
-async def get_game_config(_request):
-    game_config = storage.game.get_current_global_config()
-    return json_response(game_config.to_dict())
+async def get_game_config(request):
+    cached = await get_cached_response('config', 'global_config', build_game_config, asyncio.get_event_loop())
+    return make_encoded_response(request, cached.etag, cached.body, cached.gzip)
 
 
 # noinspection PyUnresolvedReferences
 @app.route('/api/teams/<team_id:int>/')
 async def get_team_history(_request, team_id):
-    teamtasks = storage.tasks.get_teamtasks_of_team(team_id=team_id)
+    teamtasks = await storage.tasks.get_teamtasks_of_team_async(team_id=team_id, loop=asyncio.get_event_loop())
     teamtasks = storage.tasks.filter_teamtasks_for_participants(teamtasks)
     return json_response(teamtasks)
 
 
+@app.route('/api/flags/', methods=['PUT'])
+async def submit_flags(request):
+    loop = asyncio.get_event_loop()
+
+    token = request.headers.get('X-Team-Token')
+    team_id = None
+    if token:
+        team_id = await storage.teams.get_team_id_by_token_async(token, loop)
+
+    if not team_id:
+        return json_response({'error': 'Invalid team token'}, status=403)
+
+    flag_strs = request.json
+    if not isinstance(flag_strs, list) or not all(isinstance(flag_str, str) for flag_str in flag_strs):
+        return json_response({'error': 'Expected JSON array of flags'}, status=400)
+
+    if len(flag_strs) > MAX_FLAGS_PER_REQUEST:
+        return json_response({'error': f'Too many flags, maximum is {MAX_FLAGS_PER_REQUEST}'}, status=400)
+
+    round = await storage.game.get_real_round_async(loop)
+    if round == -1:
+        return json_response({'error': 'Game is unavailable'}, status=503)
+
+    flag_strs = [flag_str.strip() for flag_str in flag_strs]
+    await rate_limiter.wait_async(team_id, len(flag_strs), loop)
+
+    results = await storage.teams.handle_attacks_batch_async(
+        attacker_id=team_id,
+        flag_strs=flag_strs,
+        round=round,
+        loop=loop,
+    )
+
+    response = []
+    for flag_str, result in zip(flag_strs, results):
+        if isinstance(result, exceptions.FlagSubmitException):
+            response.append({'flag': flag_str, 'accepted': False, 'msg': str(result)})
+        else:
+            response.append({
+                'flag': flag_str,
+                'accepted': True,
+                'points': result,
+                'msg': flags.accepted_message(result),
+            })
+
+    return json_response(response)
+
+
+# noinspection PyUnresolvedReferences
+@app.route('/api/teams/<team_id:int>/history/')
+async def get_team_history_page(request, team_id):
+    try:
+        task_id = request.args.get('task_id')
+        to_round = request.args.get('to_round')
+        page = await storage.tasks.get_team_history_async(
+            team_id=team_id,
+            loop=asyncio.get_event_loop(),
+            task_id=int(task_id) if task_id is not None else None,
+            from_round=int(request.args.get('from_round', 0)),
+            to_round=int(to_round) if to_round is not None else None,
+            cursor=request.args.get('cursor'),
+            limit=min(max(int(request.args.get('limit', storage.tasks.HISTORY_PAGE_SIZE)), 1), MAX_HISTORY_LIMIT),
+        )
+    except ValueError:
+        return json_response({'error': 'Invalid parameters'}, status=400)
+
+    return json_response(page)
+
+
+@app.route('/api/write_behind/')
+async def get_write_behind_lag(_request):
+    lag = await storage.write_behind.get_lag_async(asyncio.get_event_loop())
+    return json_response(lag)
+
+
+@app.route('/api/flag_submitter/rejections/')
+async def get_flag_rejections(_request):
+    stats = await storage.flag_cache.get_rejection_stats_async(asyncio.get_event_loop())
+    return json_response(stats)
+
+
 @app.route('/api/status/')
 async def status(_request):
     return html("OK")
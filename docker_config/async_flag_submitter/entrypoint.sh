@@ -0,0 +1,9 @@
+#!/bin/bash
+
+/await_start.sh
+
+set -e
+
+cd /app/flag_submitter/async_tcp
+echo "[*] Starting async flag submitter"
+python3 server.py
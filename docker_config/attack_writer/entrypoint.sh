@@ -0,0 +1,9 @@
+#!/bin/sh
+
+/await_start.sh
+
+set -e
+
+cd /app/attack_writer
+echo "[*] Starting attack writer"
+python3 writer.py
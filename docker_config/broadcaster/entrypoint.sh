@@ -0,0 +1,9 @@
+#!/bin/sh
+
+/await_start.sh
+
+set -e
+
+cd /app/broadcaster
+echo "[*] Starting broadcaster"
+python3 server.py
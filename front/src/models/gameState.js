@@ -0,0 +1,28 @@
+const COLUMNS = [
+    'id',
+    'team_id',
+    'task_id',
+    'score',
+    'status',
+    'stolen',
+    'lost',
+    'checks',
+    'checks_passed',
+];
+
+function getTeamTasks(state) {
+    if (!state.columns) {
+        return state.team_tasks;
+    }
+
+    const { columns, messages } = state;
+    return columns.message.map((message, index) => {
+        const teamTask = { message: messages[message] };
+        COLUMNS.forEach(name => {
+            teamTask[name] = columns[name][index];
+        });
+        return teamTask;
+    });
+}
+
+export { getTeamTasks };
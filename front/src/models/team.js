@@ -13,6 +13,24 @@ class Team {
             .filter(({ team_id: teamId }) => teamId === this.id)
             .map(teamTask => new TeamTask(teamTask))
             .sort(TeamTask.comp);
+        this.updateScore();
+    }
+
+    applyDelta(teamTasks) {
+        const changed = teamTasks
+            .filter(({ team_id: teamId }) => teamId === this.id)
+            .map(teamTask => new TeamTask(teamTask));
+        if (changed.length === 0) {
+            return;
+        }
+
+        const byTask = new Map(this.tasks.map(task => [task.taskId, task]));
+        changed.forEach(task => byTask.set(task.taskId, task));
+        this.tasks = Array.from(byTask.values()).sort(TeamTask.comp);
+        this.updateScore();
+    }
+
+    updateScore() {
         this.score = this.tasks.reduce(
             (acc, { score, sla }) => acc + score * (sla / 100.0),
             0
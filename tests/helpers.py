@@ -1,6 +1,42 @@
+import os
 import time
 
+from psycopg2 import extras
+
 
 def wait_rounds(rounds):
     round_time = 20
     time.sleep(rounds * round_time)
+
+
+def use_local_services():
+    """Point backend storage to the services of test deployment exposed on localhost"""
+    for name in ('REDIS_HOST', 'POSTGRES_HOST', 'RABBITMQ_HOST'):
+        os.environ[name] = '127.0.0.1'
+
+
+def get_working_team_ids(curs):
+    curs.execute("SELECT id FROM teams WHERE name LIKE '%%working%%' ORDER BY id")
+    return [team_id for team_id, in curs.fetchall()]
+
+
+def get_real_round(curs):
+    curs.execute('SELECT real_round FROM globalconfig WHERE id = 1')
+    real_round, = curs.fetchone()
+    return real_round
+
+
+def get_unstolen_flags(curs, attacker_id, victim_id, count, since_round):
+    """Get recent flags of the victim the attacker hasn't stolen yet, oldest first"""
+    dict_curs = curs.connection.cursor(cursor_factory=extras.RealDictCursor)
+    dict_curs.execute(
+        '''
+        SELECT * FROM flags F
+        WHERE F.team_id = %s AND F.round >= %s
+          AND NOT EXISTS (SELECT 1 FROM stolenflags S WHERE S.flag_id = F.id AND S.attacker_id = %s)
+        ORDER BY F.id
+        LIMIT %s
+        ''',
+        (victim_id, since_round, attacker_id, count),
+    )
+    return dict_curs.fetchall()
@@ -0,0 +1,67 @@
+from unittest import TestCase
+
+import requests
+
+
+class TeamHistoryPaginationTestCase(TestCase):
+    @property
+    def url(self):
+        return 'http://127.0.0.1:8080'
+
+    def get_page(self, team_id, **params):
+        r = requests.get(f'{self.url}/api/teams/{team_id}/history/', params=params)
+        self.assertTrue(r.ok)
+
+        data = r.json()
+        self.assertIn('items', data)
+        self.assertIn('next_cursor', data)
+        return data
+
+    def test_cursor_pagination(self):
+        latest = self.get_page(1, limit=1)['items']
+        self.assertEqual(len(latest), 1)
+
+        # past rounds don't change while the pages are fetched
+        to_round = latest[0]['round'] - 1
+        expected = self.get_page(1, to_round=to_round, limit=1000)['items']
+        self.assertGreater(len(expected), 3)
+
+        items = []
+        pages = 0
+        params = {'to_round': to_round, 'limit': 3}
+        while True:
+            page = self.get_page(1, **params)
+            self.assertLessEqual(len(page['items']), 3)
+            items += page['items']
+            pages += 1
+            if page['next_cursor'] is None:
+                break
+            params['cursor'] = page['next_cursor']
+
+        self.assertGreaterEqual(pages, len(expected) // 3)
+        self.assertEqual([item['id'] for item in items], [item['id'] for item in expected])
+
+        keys = [(item['round'], item['id']) for item in items]
+        self.assertEqual(keys, sorted(keys, reverse=True))
+        self.assertEqual(len(set(keys)), len(keys))
+
+        for item in items:
+            self.assertEqual(int(item['team_id']), 1)
+            self.assertLessEqual(item['round'], to_round)
+            self.assertIn('message', item)
+            self.assertNotIn('private_message', item)
+            self.assertNotIn('command', item)
+
+    def test_task_filter(self):
+        page = self.get_page(1, task_id=1, limit=50)
+        self.assertGreater(len(page['items']), 0)
+        for item in page['items']:
+            self.assertEqual(int(item['task_id']), 1)
+
+    def test_empty_ranges(self):
+        self.assertEqual(self.get_page(1, to_round=-1), {'items': [], 'next_cursor': None})
+        self.assertEqual(self.get_page(1, from_round=5, to_round=2), {'items': [], 'next_cursor': None})
+
+    def test_invalid_cursor(self):
+        r = requests.get(f'{self.url}/api/teams/1/history/', params={'cursor': 'invalid'})
+        self.assertEqual(r.status_code, 400)
@@ -0,0 +1,80 @@
+import os
+import sys
+import time
+from unittest import TestCase
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKEND_DIR = os.path.join(PROJECT_DIR, 'backend')
+TESTS_DIR = os.path.join(PROJECT_DIR, 'tests')
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, TESTS_DIR)
+
+from helpers import use_local_services
+
+use_local_services()
+
+import storage
+from storage.rate_limit import LocalTokenBucket, TeamRateLimiter
+
+# not a real team, so the buckets don't throttle submissions of other tests
+TEAM_ID = 1000000
+
+
+class TokenBucketTestCase(TestCase):
+    def setUp(self) -> None:
+        storage.get_redis_storage().delete(f'team:{TEAM_ID}:flag_bucket')
+
+    def test_local_bucket(self):
+        bucket = LocalTokenBucket(rate=10, burst=5)
+
+        granted, wait = bucket.acquire(8)
+        self.assertEqual(granted, 5)
+        self.assertGreater(wait, 0)
+        self.assertLessEqual(wait, 0.1)
+
+        granted, _wait = bucket.acquire(1)
+        self.assertEqual(granted, 0)
+
+        time.sleep(0.25)
+        granted, _wait = bucket.acquire(5)
+        self.assertIn(granted, [2, 3])
+
+    def test_shared_bucket(self):
+        limiter = TeamRateLimiter(rate=10, burst=5, shared=True)
+        other_replica = TeamRateLimiter(rate=10, burst=5, shared=True)
+
+        granted, wait = limiter.acquire(TEAM_ID, 8)
+        self.assertEqual(granted, 5)
+        self.assertGreater(wait, 0)
+
+        # replicas take tokens from the same bucket
+        granted, wait = other_replica.acquire(TEAM_ID, 1)
+        self.assertEqual(granted, 0)
+        self.assertGreater(wait, 0)
+
+        time.sleep(0.25)
+        granted, _wait = other_replica.acquire(TEAM_ID, 5)
+        self.assertIn(granted, [2, 3])
+
+    def test_local_buckets_split_rate(self):
+        limiter = TeamRateLimiter(rate=10, burst=6, shared=False, replicas=2)
+
+        granted, _wait = limiter.acquire(TEAM_ID, 6)
+        self.assertEqual(granted, 3)
+
+    def test_disabled_limit(self):
+        limiter = TeamRateLimiter(rate=0, burst=5)
+
+        self.assertEqual(limiter.acquire(TEAM_ID, 100), (100, 0.0))
+
+    def test_wait_throttles(self):
+        limiter = TeamRateLimiter(rate=50, burst=5, shared=True)
+
+        started = time.monotonic()
+        limiter.wait(TEAM_ID, 10)
+        elapsed = time.monotonic() - started
+
+        # 5 flags over the burst at 50 per second
+        self.assertGreaterEqual(elapsed, 0.08)
+        self.assertEqual(limiter.queue_depth[TEAM_ID], 0)
+        self.assertGreater(limiter.throttled_time[TEAM_ID], 0)
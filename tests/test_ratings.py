@@ -0,0 +1,109 @@
+import os
+import sys
+from unittest import TestCase
+
+from psycopg2 import pool
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKEND_DIR = os.path.join(PROJECT_DIR, 'backend')
+TESTS_DIR = os.path.join(PROJECT_DIR, 'tests')
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, TESTS_DIR)
+
+import config
+from helpers import get_working_team_ids, get_real_round, get_unstolen_flags
+
+
+class RatingRecalculationTestCase(TestCase):
+    """Compares bulk rating recalculation with the per-flag procedure,
+    every test runs in a transaction that is rolled back"""
+
+    def setUp(self) -> None:
+        database_config = config.get_db_config()
+        database_config['host'] = '127.0.0.1'
+        self.db_pool = pool.SimpleConnectionPool(minconn=1, maxconn=2, **database_config)
+        self.conn = self.db_pool.getconn()
+        self.curs = self.conn.cursor()
+
+        self.attacker_id, self.victim_id, self.other_id = get_working_team_ids(self.curs)[:3]
+        self.since_round = max(get_real_round(self.curs) - 2, 0)
+
+    def tearDown(self) -> None:
+        self.conn.rollback()
+        self.db_pool.putconn(self.conn)
+        self.db_pool.closeall()
+
+    def get_teamtasks(self):
+        self.curs.execute('SELECT team_id, task_id, score, stolen, lost FROM teamtasks ORDER BY team_id, task_id')
+        return self.curs.fetchall()
+
+    def call_bulk(self, attacker_ids, flag_ids):
+        self.curs.callproc('recalculate_rating_bulk', (attacker_ids, flag_ids))
+        return self.curs.fetchall()
+
+    def test_bulk_matches_sequential(self):
+        attacks = []
+        for attacker_id, victim_id in [
+            (self.attacker_id, self.victim_id),
+            (self.attacker_id, self.other_id),
+            (self.other_id, self.victim_id),
+        ]:
+            flags = get_unstolen_flags(self.curs, attacker_id, victim_id, 4, self.since_round)
+            attacks += [(attacker_id, flag) for flag in flags]
+        self.assertGreater(len(attacks), 6)
+
+        # interleave attacks of both attackers on the same teamtasks, the order matters for the rating
+        attacks.sort(key=lambda attack: attack[1]['id'])
+
+        self.curs.execute('SAVEPOINT sequential')
+        sequential = []
+        for attacker_id, flag in attacks:
+            self.curs.execute(
+                'SELECT * FROM recalculate_rating(%s, %s, %s, %s)',
+                (attacker_id, flag['team_id'], flag['task_id'], flag['id']),
+            )
+            sequential.append(self.curs.fetchone())
+        sequential_teamtasks = self.get_teamtasks()
+        self.curs.execute('ROLLBACK TO SAVEPOINT sequential')
+
+        bulk = self.call_bulk(
+            [attacker_id for attacker_id, _flag in attacks],
+            [flag['id'] for _attacker_id, flag in attacks],
+        )
+        bulk_teamtasks = self.get_teamtasks()
+
+        self.assertEqual(len(bulk), len(attacks))
+        for (attacker_id, flag), row, (attacker_delta, victim_delta) in zip(attacks, bulk, sequential):
+            self.assertEqual(row[0], flag['id'])
+            self.assertEqual(row[1], attacker_id)
+            self.assertAlmostEqual(row[2], attacker_delta)
+            self.assertAlmostEqual(row[3], victim_delta)
+
+        self.assertEqual(len(bulk_teamtasks), len(sequential_teamtasks))
+        for bulk_tt, sequential_tt in zip(bulk_teamtasks, sequential_teamtasks):
+            self.assertEqual(bulk_tt[:2], sequential_tt[:2])
+            self.assertAlmostEqual(float(bulk_tt[2]), float(sequential_tt[2]))
+            self.assertEqual(bulk_tt[3:], sequential_tt[3:])
+
+    def test_bulk_skips_duplicate_and_stolen_flags(self):
+        flags = get_unstolen_flags(self.curs, self.attacker_id, self.victim_id, 3, self.since_round)
+        self.assertEqual(len(flags), 3)
+        first, second, third = [flag['id'] for flag in flags]
+
+        before = self.get_teamtasks()
+
+        result = self.call_bulk([self.attacker_id] * 3, [first, first, second])
+        self.assertEqual([row[0] for row in result], [first, second])
+
+        result = self.call_bulk([self.attacker_id] * 3, [second, third, first])
+        self.assertEqual([row[0] for row in result], [third])
+
+        self.curs.execute(
+            'SELECT flag_id, COUNT(*) FROM stolenflags WHERE attacker_id = %s AND flag_id = ANY(%s) GROUP BY flag_id',
+            (self.attacker_id, [first, second, third]),
+        )
+        self.assertEqual(sorted(self.curs.fetchall()), sorted([(first, 1), (second, 1), (third, 1)]))
+
+        stolen_before = sum(tt[3] for tt in before if tt[0] == self.attacker_id)
+        stolen_after = sum(tt[3] for tt in self.get_teamtasks() if tt[0] == self.attacker_id)
+        self.assertEqual(stolen_after - stolen_before, 3)
@@ -0,0 +1,94 @@
+import asyncio
+import os
+import sys
+from unittest import TestCase
+
+from psycopg2 import pool
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKEND_DIR = os.path.join(PROJECT_DIR, 'backend')
+TESTS_DIR = os.path.join(PROJECT_DIR, 'tests')
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, TESTS_DIR)
+
+from helpers import use_local_services, get_working_team_ids, get_real_round, get_unstolen_flags
+
+use_local_services()
+
+import config
+import storage
+from helplib import exceptions
+
+
+class AttacksBatchTestCase(TestCase):
+    """Submits mixed batches through storage.teams.handle_attacks_batch(_async),
+    only working teams attack each other"""
+
+    def setUp(self) -> None:
+        self.db_pool = pool.SimpleConnectionPool(minconn=1, maxconn=2, **config.get_db_config())
+        self.conn = self.db_pool.getconn()
+        self.curs = self.conn.cursor()
+
+        self.team_ids = get_working_team_ids(self.curs)
+        self.round = get_real_round(self.curs)
+        self.since_round = max(self.round - 2, 0)
+
+    def tearDown(self) -> None:
+        self.db_pool.putconn(self.conn)
+        self.db_pool.closeall()
+
+    def get_stolen_count(self, attacker_id, flag_ids):
+        self.conn.rollback()
+        self.curs.execute(
+            'SELECT COUNT(*) FROM stolenflags WHERE attacker_id = %s AND flag_id = ANY(%s)',
+            (attacker_id, flag_ids),
+        )
+        count, = self.curs.fetchone()
+        return count
+
+    def make_batch(self, attacker_id, victim_id):
+        first, second = get_unstolen_flags(self.curs, attacker_id, victim_id, 2, self.since_round)
+        # any recent flag of the attacker itself
+        own, = get_unstolen_flags(self.curs, victim_id, attacker_id, 1, self.since_round)
+        flag_strs = [first['flag'], 'A' * 31 + '=', own['flag'], first['flag'], second['flag']]
+        return flag_strs, [first['id'], second['id']]
+
+    def check_results(self, results):
+        self.assertEqual(len(results), 5)
+
+        accepted, invalid, own, duplicate, accepted_last = results
+        self.assertIsInstance(accepted, float)
+        self.assertIsInstance(accepted_last, float)
+
+        for result, reason in [(invalid, 'invalid'), (own, 'own'), (duplicate, 'already stolen')]:
+            self.assertIsInstance(result, exceptions.FlagSubmitException)
+            self.assertIn(reason, str(result).lower())
+
+    def test_batch_results_in_order(self):
+        attacker_id, victim_id = self.team_ids[0], self.team_ids[1]
+        flag_strs, flag_ids = self.make_batch(attacker_id, victim_id)
+
+        results = storage.teams.handle_attacks_batch(attacker_id=attacker_id, flag_strs=flag_strs, round=self.round)
+
+        self.check_results(results)
+        self.assertEqual(self.get_stolen_count(attacker_id, flag_ids), 2)
+
+        results = storage.teams.handle_attacks_batch(attacker_id=attacker_id, flag_strs=flag_strs, round=self.round)
+        for result in results:
+            self.assertIsInstance(result, exceptions.FlagSubmitException)
+        self.assertEqual(self.get_stolen_count(attacker_id, flag_ids), 2)
+
+    def test_async_batch_results_in_order(self):
+        attacker_id, victim_id = self.team_ids[0], self.team_ids[2]
+        flag_strs, flag_ids = self.make_batch(attacker_id, victim_id)
+
+        loop = asyncio.get_event_loop()
+        results = loop.run_until_complete(storage.teams.handle_attacks_batch_async(
+            attacker_id=attacker_id,
+            flag_strs=flag_strs,
+            round=self.round,
+            loop=loop,
+        ))
+
+        self.check_results(results)
+        self.assertEqual(self.get_stolen_count(attacker_id, flag_ids), 2)
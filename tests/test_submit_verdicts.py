@@ -0,0 +1,118 @@
+import os
+import sys
+from unittest import TestCase
+
+from psycopg2 import pool
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKEND_DIR = os.path.join(PROJECT_DIR, 'backend')
+TESTS_DIR = os.path.join(PROJECT_DIR, 'tests')
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, TESTS_DIR)
+
+from helpers import use_local_services, get_working_team_ids, get_real_round, get_unstolen_flags
+
+use_local_services()
+
+import config
+import storage
+from storage.flags import FLAG_COUNTERS_KEY
+
+
+class AcceptScriptTestCase(TestCase):
+    """Checks every verdict of the flag accept script, flags accepted
+    in redis are applied to the database as attack_writer would do"""
+
+    def setUp(self) -> None:
+        self.db_pool = pool.SimpleConnectionPool(minconn=1, maxconn=2, **config.get_db_config())
+        self.conn = self.db_pool.getconn()
+        self.curs = self.conn.cursor()
+
+        team_ids = get_working_team_ids(self.curs)
+        self.attacker_id, self.victim_id = team_ids[1], team_ids[2]
+        self.round = get_real_round(self.curs)
+        self.flags = get_unstolen_flags(self.curs, self.attacker_id, self.victim_id, 3, max(self.round - 2, 0))
+        self.own, = get_unstolen_flags(self.curs, self.victim_id, self.attacker_id, 1, max(self.round - 2, 0))
+        self.conn.rollback()
+
+        self.redis = storage.get_redis_storage()
+        self.flag_lifetime = storage.game.get_current_global_config().flag_lifetime
+
+    def tearDown(self) -> None:
+        self.db_pool.putconn(self.conn)
+        self.db_pool.closeall()
+
+    def accept(self, flag_strs, round=None):
+        return storage.flags.accept_flags_by_str_batch(
+            flag_strs=flag_strs,
+            attacker=self.attacker_id,
+            round=round if round is not None else self.round,
+        )
+
+    def apply(self, checked):
+        storage.teams.apply_attacks_bulk([
+            (self.attacker_id, flag, self.round)
+            for flag, error in checked
+            if error is None
+        ])
+
+    def assertRejected(self, result, reason):
+        _flag, error = result
+        self.assertIsNotNone(error)
+        self.assertIn(reason, str(error).lower())
+
+    def get_counters(self, flag):
+        stolen, lost = self.redis.hmget(
+            FLAG_COUNTERS_KEY,
+            f'team:{self.attacker_id}:task:{flag["task_id"]}:stolen',
+            f'team:{self.victim_id}:task:{flag["task_id"]}:lost',
+        )
+        return int(stolen or 0), int(lost or 0)
+
+    def test_verdicts(self):
+        first, second, _third = self.flags
+        counters = self.get_counters(first)
+
+        checked = self.accept([first['flag'], 'INVALID_FLAG', self.own['flag'], first['flag']])
+        self.assertEqual(len(checked), 4)
+
+        flag, error = checked[0]
+        self.assertIsNone(error)
+        self.assertEqual(flag.id, first['id'])
+        self.assertEqual(flag.team_id, self.victim_id)
+
+        invalid_flag, _error = checked[1]
+        self.assertIsNone(invalid_flag)
+        self.assertRejected(checked[1], 'invalid')
+        self.assertRejected(checked[2], 'own')
+        self.assertRejected(checked[3], 'already stolen')
+
+        stolen, lost = self.get_counters(first)
+        self.assertEqual((stolen, lost), (counters[0] + 1, counters[1] + 1))
+
+        self.apply(checked)
+
+        result, = self.accept([first['flag']])
+        self.assertRejected(result, 'already stolen')
+
+        # too old flags are not added to the stolen flags
+        result, = self.accept([second['flag']], round=second['round'] + self.flag_lifetime + 1)
+        self.assertRejected(result, 'too old')
+
+        checked = self.accept([second['flag']])
+        self.assertIsNone(checked[0][1])
+        self.apply(checked)
+
+    def test_verdicts_after_cache_fill(self):
+        _first, _second, third = self.flags
+
+        checked = self.accept([third['flag']])
+        self.assertIsNone(checked[0][1])
+        self.apply(checked)
+
+        # stolen flags are reloaded from the database when the cache is dropped
+        self.redis.delete(f'team:{self.attacker_id}:stolen_flags:cached')
+        result, = self.accept([third['flag']])
+        self.assertRejected(result, 'already stolen')
+
+        self.assertTrue(self.redis.exists(f'team:{self.attacker_id}:stolen_flags:cached'))
@@ -0,0 +1,93 @@
+import json
+import os
+import sys
+import time
+from unittest import TestCase
+
+from psycopg2 import pool
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKEND_DIR = os.path.join(PROJECT_DIR, 'backend')
+TESTS_DIR = os.path.join(PROJECT_DIR, 'tests')
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, TESTS_DIR)
+
+from helpers import use_local_services, get_working_team_ids, get_real_round, get_unstolen_flags
+
+use_local_services()
+
+import config
+import storage
+from attack_writer.writer import AttackWriter
+
+
+class AttackWriterReplayTestCase(TestCase):
+    """Applies the same attacks stream entries twice, as the writer does
+    when it's restarted before acknowledging them"""
+
+    def setUp(self) -> None:
+        self.db_pool = pool.SimpleConnectionPool(minconn=1, maxconn=2, **config.get_db_config())
+        self.conn = self.db_pool.getconn()
+        self.curs = self.conn.cursor()
+
+        team_ids = get_working_team_ids(self.curs)
+        self.attacker_id, self.victim_id = team_ids[2], team_ids[0]
+        self.round = get_real_round(self.curs)
+        self.since_round = max(self.round - 2, 0)
+
+    def tearDown(self) -> None:
+        self.db_pool.putconn(self.conn)
+        self.db_pool.closeall()
+
+    def get_attacker_state(self, flag_ids):
+        self.conn.rollback()
+        self.curs.execute(
+            'SELECT COUNT(*) FROM stolenflags WHERE attacker_id = %s AND flag_id = ANY(%s)',
+            (self.attacker_id, flag_ids),
+        )
+        stolen_flags, = self.curs.fetchone()
+
+        self.curs.execute('SELECT SUM(stolen) FROM teamtasks WHERE team_id = %s', (self.attacker_id,))
+        stolen, = self.curs.fetchone()
+        return stolen_flags, stolen
+
+    def test_replay_applies_once(self):
+        flags = get_unstolen_flags(self.curs, self.attacker_id, self.victim_id, 3, self.since_round)
+        self.assertEqual(len(flags), 3)
+        flag_ids = [flag['id'] for flag in flags]
+
+        # accept in redis as a submitter in write-behind mode would, the entries
+        # are built here instead of read from the stream, so the running writer doesn't take them
+        checked = storage.flags.accept_flags_by_str_batch(
+            flag_strs=[flag['flag'] for flag in flags],
+            attacker=self.attacker_id,
+            round=self.round,
+        )
+        for _flag, error in checked:
+            self.assertIsNone(error)
+
+        entry_id = f'{int(time.time() * 1000)}-0'
+        entries = [(entry_id, {
+            'attacker_id': str(self.attacker_id),
+            'round': str(self.round),
+            'flags': json.dumps([[flag.id, flag.team_id, flag.task_id, flag.round] for flag, _error in checked]),
+        })]
+
+        writer = AttackWriter(consumer='tests', batch_size=10)
+        stats_before = storage.write_behind.get_lag()
+        _stolen_flags, stolen_before = self.get_attacker_state(flag_ids)
+
+        writer.apply(entries)
+        stolen_flags, stolen_applied = self.get_attacker_state(flag_ids)
+        self.assertEqual(stolen_flags, 3)
+        self.assertEqual(stolen_applied - stolen_before, 3)
+
+        writer.apply(entries, replayed=True)
+        stolen_flags, stolen_replayed = self.get_attacker_state(flag_ids)
+        self.assertEqual(stolen_flags, 3)
+        self.assertEqual(stolen_replayed, stolen_applied)
+
+        stats = storage.write_behind.get_lag()
+        self.assertEqual(stats['applied'] - stats_before['applied'], 3)
+        self.assertEqual(stats['batches'] - stats_before['batches'], 2)
+        self.assertEqual(stats['replayed'] - stats_before['replayed'], 1)